@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KoemojiAuto - 文字起こし速度・精度ベンチマーク
+固定のコーパス（音声ファイルのフォルダ）を推論モード・デコードプロファイルごとに文字起こしし、
+処理時間と実時間比（RTF = 処理時間 / 音声の長さ）、参照テキストに対する誤り率を比較する
+
+参照テキストは音声ファイルと同じ名前の.txt（例: meeting.mp3 -> meeting.txt）を
+コーパスフォルダ（または--references）に置く。日本語・中国語は文字誤り率（CER）、
+それ以外は単語誤り率（WER）を計算する。
+
+使い方:
+    python3 benchmark.py コーパスフォルダ --modes sequential batched --batch-size 8
+    python3 benchmark.py コーパスフォルダ --profiles fast balanced accurate
+"""
+
+import os
+import sys
+import time
+import argparse
+import unicodedata
+
+from main import KoemojiProcessor, MEDIA_EXTENSIONS, DEFAULT_DECODE_PROFILES, probe_duration
+
+# 文字単位で誤り率を計算する言語（単語を空白で区切らない）
+CHARACTER_LANGUAGES = ("ja", "zh")
+
+
+def list_corpus(corpus_folder):
+    """コーパス内のメディアファイルを名前順に返す"""
+    return [
+        os.path.join(corpus_folder, name)
+        for name in sorted(os.listdir(corpus_folder))
+        if name.lower().endswith(MEDIA_EXTENSIONS)
+    ]
+
+
+def load_reference(reference_folder, file_path):
+    """音声ファイルに対応する参照テキストを読む（なければNone）"""
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    path = os.path.join(reference_folder, f"{stem}.txt")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def tokenize(text, by_character):
+    """句読点・空白を除いてトークンに分割（by_characterなら文字単位）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    cleaned = "".join(
+        " " if unicodedata.category(ch)[0] in ("P", "Z", "C") else ch
+        for ch in text
+    )
+    if by_character:
+        return [ch for ch in cleaned if not ch.isspace()]
+    return cleaned.split()
+
+
+def edit_distance(reference, hypothesis):
+    """トークン列の編集距離（置換・挿入・削除）"""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_token in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_token in enumerate(hypothesis, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_token != hyp_token)
+            ))
+        previous = current
+    return previous[-1]
+
+
+def run_mode(processor, files, mode, profile=None, reference_folder=None):
+    """1つの推論モード・プロファイルでコーパス全体を処理する
+
+    (音声秒数, 処理秒数, 失敗数, 誤り数, 参照トークン数)を返す。
+    """
+    processor.config["inference_mode"] = mode
+    if profile:
+        processor.config["decode_profile"] = profile
+    label = f"{mode}/{profile}" if profile else mode
+    by_character = processor.config.get("language", "ja") in CHARACTER_LANGUAGES
+
+    # モデルのロード時間は計測に含めない
+    processor._get_transcriber()
+
+    audio_seconds = 0.0
+    elapsed = 0.0
+    failures = 0
+    errors = 0
+    reference_tokens = 0
+    for file_path in files:
+        start = time.perf_counter()
+        text = processor.transcribe_audio(file_path)
+        took = time.perf_counter() - start
+        duration = probe_duration(file_path) or 0.0
+
+        if text is None:
+            failures += 1
+        audio_seconds += duration
+        elapsed += took
+        rtf = took / duration if duration else float("nan")
+
+        accuracy = ""
+        reference = load_reference(reference_folder, file_path) if reference_folder else None
+        if reference is not None:
+            ref = tokenize(reference, by_character)
+            distance = edit_distance(ref, tokenize(text or "", by_character))
+            errors += distance
+            reference_tokens += len(ref)
+            accuracy = f", 誤り率 {distance / len(ref):.3f}" if ref else ""
+        print(f"  [{label}] {os.path.basename(file_path)}: {took:.2f}秒 / 音声{duration:.1f}秒 "
+              f"(RTF {rtf:.3f}{accuracy})")
+
+    return audio_seconds, elapsed, failures, errors, reference_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推論モード・デコードプロファイル別の文字起こし速度と精度を比較します")
+    parser.add_argument("corpus", help="ベンチマークに使う音声・動画ファイルのフォルダ")
+    parser.add_argument("--config", default="config.json", help="設定ファイル（モデル・言語などを使用）")
+    parser.add_argument("--modes", nargs="+", default=["sequential", "batched"],
+                        choices=["sequential", "batched"], help="比較する推論モード")
+    parser.add_argument("--profiles", nargs="+",
+                        help=f"比較するデコードプロファイル（例: {' '.join(DEFAULT_DECODE_PROFILES)}）。"
+                             "省略時は設定ファイルのdecode_profileのみ")
+    parser.add_argument("--references", help="参照テキスト（.txt）のフォルダ（既定はコーパスフォルダ）")
+    parser.add_argument("--batch-size", type=int, help="batchedモードのバッチサイズ")
+    parser.add_argument("--model", help="whisper_modelを上書き")
+    parser.add_argument("--long-file-mode", action="store_true",
+                        help="長時間ファイルの分割処理を有効にする（既定では無効にして推論モードだけを比較）")
+    args = parser.parse_args()
+
+    files = list_corpus(args.corpus)
+    if not files:
+        print(f"メディアファイルが見つかりません: {args.corpus}")
+        return 1
+
+    processor = KoemojiProcessor(args.config)
+    processor.config["long_file_mode"] = args.long_file_mode
+    # コーパス全体に同じプロファイルを適用する
+    processor.config["decode_profile_patterns"] = {}
+    processor.config["decode_profile_folders"] = {}
+    if args.batch_size:
+        processor.config["batch_size"] = args.batch_size
+    if args.model:
+        processor.config["whisper_model"] = args.model
+    reference_folder = args.references or args.corpus
+    metric = "CER" if processor.config.get("language", "ja") in CHARACTER_LANGUAGES else "WER"
+
+    print(f"コーパス: {args.corpus} ({len(files)}ファイル)")
+    print(f"モデル: {processor.config.get('whisper_model')} / {processor.config.get('compute_type', 'int8')}")
+
+    results = []
+    for mode in args.modes:
+        for profile in args.profiles or [None]:
+            label = f"{mode}/{profile}" if profile else mode
+            results.append((label, *run_mode(processor, files, mode, profile, reference_folder)))
+
+    print("")
+    print(f"{'モード':<22}{'音声(秒)':>10}{'処理(秒)':>10}{'RTF':>8}{'速度比':>8}{metric:>8}{'失敗':>6}")
+    baseline = results[0][2] if results else None
+    for label, audio_seconds, elapsed, failures, errors, reference_tokens in results:
+        rtf = elapsed / audio_seconds if audio_seconds else float("nan")
+        speedup = baseline / elapsed if elapsed else float("nan")
+        error_rate = f"{errors / reference_tokens:.3f}" if reference_tokens else "-"
+        print(f"{label:<22}{audio_seconds:>10.1f}{elapsed:>10.2f}{rtf:>8.3f}{speedup:>7.2f}x"
+              f"{error_rate:>8}{failures:>6}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
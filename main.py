@@ -11,15 +11,85 @@ import time
 import json
 import logging
 import shutil
+import stat
+import sqlite3
+import hashlib
+import gc
+import copy
+import fnmatch
+import heapq
+import itertools
+import functools
+import cProfile
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, namedtuple, deque
 from pathlib import Path
 from datetime import datetime, time as datetime_time
 import psutil
 import signal
 import sys
 import platform
+import threading
+import select
+import socket
+import struct
+import ctypes
+import ctypes.util
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # OS判定  
 IS_WINDOWS = platform.system() == 'Windows'
+IS_LINUX = platform.system() == 'Linux'
+
+# 単一インスタンスのロック（InstanceLock）
+if IS_WINDOWS:
+    import msvcrt
+else:
+    import fcntl
+
+# メディアファイルの拡張子
+MEDIA_EXTENSIONS = ('.mp3', '.mp4', '.wav', '.m4a', '.mov', '.avi', '.flac', '.ogg', '.aac')
+
+# 音声トラックを抜き出してから処理する動画ファイルの拡張子
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi')
+
+# Whisperの入力サンプリングレート
+SAMPLE_RATE = 16000
+
+# 制御APIのlistで既定で返すキューの件数（"limit": nullで全件）
+CONTROL_LIST_LIMIT = 100
+
+# デコードプロファイル（config.jsonのdecode_profilesで上書き・追加できる）
+#   fast     - 貪欲法・温度フォールバックなし（留守電などの精度を問わない入力向け）
+#   balanced - 従来の既定値（beam_size=5, best_of=5）
+#   accurate - ビーム幅を広げ、VADの余白も長めにとる
+DEFAULT_DECODE_PROFILES = {
+    "fast": {
+        "beam_size": 1,
+        "best_of": 1,
+        "temperature": [0.0],
+        "condition_on_previous_text": False,
+        "vad_filter": True,
+        "vad_parameters": {"min_silence_duration_ms": 1000}
+    },
+    "balanced": {
+        "beam_size": 5,
+        "best_of": 5,
+        "vad_filter": True
+    },
+    "accurate": {
+        "beam_size": 10,
+        "best_of": 5,
+        "patience": 1.5,
+        "temperature": [0.0, 0.2, 0.4, 0.6, 0.8, 1.0],
+        "condition_on_previous_text": True,
+        "vad_filter": True,
+        "vad_parameters": {"min_silence_duration_ms": 500, "speech_pad_ms": 600}
+    }
+}
+
+# ファイル先頭からの時刻に補正した文字起こしセグメント
+TranscriptSegment = namedtuple("TranscriptSegment", ["start", "end", "text"])
 
 # ロギング設定
 logging.basicConfig(
@@ -30,19 +100,1923 @@ logging.basicConfig(
 )
 logger = logging.getLogger("KoemojiAuto")
 
+
+class InotifyWatcher:
+    """inotifyで入力フォルダを監視し、書き込み完了・移動されたファイルを通知する（Linux専用）
+    
+    subfoldersに指定した入力フォルダ直下のサブフォルダも同じinotifyインスタンスで監視する。
+    """
+    
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    
+    _EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, folder, on_file, on_overflow, subfolders=()):
+        self.folder = folder
+        self.subfolders = list(subfolders)
+        self.on_file = on_file
+        self.on_overflow = on_overflow
+        self._dirs = {}
+        self._fd = None
+        self._stop_r = None
+        self._stop_w = None
+        self._thread = None
+    
+    @staticmethod
+    def _libc():
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotifyが利用できません")
+        return libc
+    
+    @classmethod
+    def is_supported(cls):
+        """inotifyが利用可能か確認"""
+        if not IS_LINUX:
+            return False
+        try:
+            cls._libc()
+            return True
+        except OSError:
+            return False
+    
+    def start(self):
+        """監視を開始"""
+        libc = self._libc()
+        fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1に失敗しました")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_DELETE_SELF | self.IN_MOVE_SELF
+        wd = libc.inotify_add_watch(fd, os.fsencode(self.folder), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, f"inotify_add_watchに失敗しました: {self.folder}")
+        self._dirs = {wd: self.folder}
+        
+        # サブフォルダは存在するものだけ監視（後から作られたものは定期スキャンで拾う）
+        for subfolder in self.subfolders:
+            path = os.path.join(self.folder, subfolder)
+            if not os.path.isdir(path):
+                continue
+            sub_wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+            if sub_wd < 0:
+                logger.warning(f"⚠️  サブフォルダを監視できません: {path}")
+                continue
+            self._dirs[sub_wd] = path
+        
+        self._fd = fd
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._loop, name="koemoji-watcher", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """監視を停止"""
+        if self._thread is None:
+            return
+        os.write(self._stop_w, b"x")
+        self._thread.join(timeout=5)
+        for fd in (self._fd, self._stop_r, self._stop_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._thread = None
+    
+    def _loop(self):
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                logger.error(f"❌ フォルダ監視の読み込みに失敗しました: {e}")
+                return
+            if not self._dispatch(data):
+                return
+    
+    def _dispatch(self, data):
+        """イベントバッファを解析してコールバックを呼ぶ（監視対象が消えたらFalse）"""
+        offset = 0
+        header_size = self._EVENT_HEADER.size
+        while offset + header_size <= len(data):
+            wd, mask, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + header_size:offset + header_size + name_len].rstrip(b"\0")
+            offset += header_size + name_len
+            directory = self._dirs.get(wd)
+            
+            if mask & self.IN_Q_OVERFLOW:
+                logger.warning("⚠️  フォルダ監視のイベントが溢れたため、全体を再スキャンします")
+                self.on_overflow()
+            elif mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                if directory == self.folder:
+                    logger.warning(f"⚠️  監視中の入力フォルダが削除または移動されました: {self.folder}")
+                    self.on_overflow()
+                    return False
+                self._dirs.pop(wd, None)
+            elif name and directory and not mask & self.IN_ISDIR:
+                self.on_file(os.path.join(directory, os.fsdecode(name)))
+        return True
+
+
+class QueueEntry:
+    """キュー内の1ファイル分の情報（__slots__で省メモリ）"""
+    
+    __slots__ = ("path", "size", "queued_at", "duration", "codec", "stage")
+    
+    # 長さが取得できないファイルはこのビットレート（128kbps）と仮定してサイズから見積もる
+    ASSUMED_BYTES_PER_SECOND = 16000
+    
+    def __init__(self, path, size=0, queued_at=None, duration=None, codec=None, stage=None):
+        self.path = path
+        self.size = size
+        self.queued_at = queued_at if queued_at is not None else time.time()
+        self.duration = duration
+        self.codec = codec
+        # 下書き→本番の2段階処理での段階（"draft" / "final"、単段処理ならNone）
+        self.stage = stage
+    
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+    
+    @property
+    def estimated_duration(self):
+        """音声の長さ（秒）。プローブできなかった場合はサイズからの見積もり"""
+        if self.duration is not None:
+            return self.duration
+        return self.size / self.ASSUMED_BYTES_PER_SECOND
+    
+    def __getitem__(self, key):
+        # 旧来のdict形式（entry["path"]）でも参照できるようにする
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+    
+    def __repr__(self):
+        return f"QueueEntry({self.path!r}, size={self.size}, duration={self.duration}, stage={self.stage})"
+
+
+class FileQueue:
+    """パスで索引付けしたスケジューリングキュー
+    
+    取り出し順はpolicyで決まる:
+      fifo  - 到着順
+      sjf   - 音声の短い順（最短ジョブ優先）
+      aging - 短い順だが、待ち時間1秒ごとにaging_weight秒ぶん優先度を上げる（長いファイルの飢餓を防ぐ）
+    
+    agingの優先度「長さ - weight × 待ち時間」は時間の項が全エントリで共通なので、
+    「長さ + weight × 到着時刻」を追加時に一度計算すればヒープ内の順序は変わらない。
+    本番（final）段階のエントリは、方式にかかわらず下書き・単段のエントリの後に回す。
+    追加・取り出しはO(log n)、存在確認・削除はO(1)（ヒープからの削除は取り出し時に遅延処理）。
+    """
+    
+    POLICIES = ("fifo", "sjf", "aging")
+    
+    def __init__(self, policy="fifo", aging_weight=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"不明なスケジューリング方式です: {policy}")
+        self.policy = policy
+        self.aging_weight = aging_weight
+        self._entries = {}
+        self._seqs = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._epoch = time.time()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __bool__(self):
+        return bool(self._entries)
+    
+    def __iter__(self):
+        """取り出し順に列挙（その時点のスナップショット）"""
+        live = sorted(item for item in self._heap if self._is_live(item))
+        return iter([self._entries[item[3]] for item in live])
+    
+    def __contains__(self, path):
+        return path in self._entries
+    
+    def __getitem__(self, index):
+        try:
+            return list(self)[index]
+        except IndexError:
+            raise IndexError("キューの範囲外です")
+    
+    def _rank(self, entry):
+        if self.policy == "sjf":
+            return entry.estimated_duration
+        if self.policy == "aging":
+            return entry.estimated_duration + self.aging_weight * (entry.queued_at - self._epoch)
+        return 0.0
+    
+    def _is_live(self, item):
+        return self._seqs.get(item[3]) == item[2]
+    
+    def push(self, entry):
+        """追加（既にキュー済みならFalse）"""
+        if entry.path in self._entries:
+            return False
+        seq = next(self._counter)
+        self._entries[entry.path] = entry
+        self._seqs[entry.path] = seq
+        tier = 1 if entry.stage == "final" else 0
+        heapq.heappush(self._heap, (tier, self._rank(entry), seq, entry.path))
+        return True
+    
+    def peek(self, count):
+        """取り出し順で先頭からcount件を返す（取り出さない）
+        
+        先頭のcount件だけを取り出して戻すのでO(count log n)。途中の削除済みの項目は捨てる。
+        """
+        items = []
+        while self._heap and len(items) < count:
+            item = heapq.heappop(self._heap)
+            if self._is_live(item):
+                items.append(item)
+        for item in items:
+            heapq.heappush(self._heap, item)
+        return [self._entries[item[3]] for item in items]
+    
+    def first(self):
+        """次に取り出されるエントリ（取り出さない。空ならNone）"""
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._entries[self._heap[0][3]] if self._heap else None
+    
+    def popleft(self):
+        """次に処理すべきエントリを取り出す"""
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            if self._is_live(item):
+                del self._seqs[item[3]]
+                return self._entries.pop(item[3])
+        raise IndexError("キューが空です")
+    
+    def remove(self, path):
+        """指定パスを取り除く（なければNone）"""
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            del self._seqs[path]
+            # 削除済みの要素がヒープの大半を占めたら詰め直す
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [item for item in self._heap if self._is_live(item)]
+                heapq.heapify(self._heap)
+        return entry
+    
+    def prioritize(self, path):
+        """指定パスを方式にかかわらず先頭に移す（後から移したものほど先。なければFalse）"""
+        if path not in self._entries:
+            return False
+        seq = next(self._counter)
+        self._seqs[path] = seq
+        heapq.heappush(self._heap, (-1, -seq, seq, path))
+        return True
+    
+    def get(self, path):
+        return self._entries.get(path)
+    
+    def clear(self):
+        self._entries.clear()
+        self._seqs.clear()
+        self._heap.clear()
+
+
+class JobStore:
+    """ジョブの状態（queued/running/done/failed/cancelled）をSQLite（WALモード）に永続化する
+    
+    状態の書き込みはメモリ上に溜めて専用スレッドがまとめてコミットするため、
+    呼び出し側（スキャン・ワーカー）はディスクI/Oを待たない。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            queued_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            error TEXT,
+            profile TEXT
+        )
+    """
+    
+    def __init__(self, db_path, flush_interval=1.0):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        # 未完了・失敗ジョブの状態キャッシュ {path: [state, attempts, size]}
+        self._jobs = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._queued_seq = 0
+        self._committed_seq = 0
+        self._dirty_event = threading.Event()
+        self._urgent_event = threading.Event()
+        self._closing = False
+        self._thread = None
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def open(self):
+        """DBを開いて未完了ジョブを読み込み、書き込みスレッドを開始"""
+        conn = self._connect()
+        try:
+            conn.execute(self.SCHEMA)
+            # 段階別プロファイルの列がない古いDBには追加する
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "profile" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN profile TEXT")
+            conn.commit()
+            rows = conn.execute(
+                "SELECT path, state, attempts, size FROM jobs WHERE state != 'done'"
+            ).fetchall()
+        finally:
+            conn.close()
+        self._jobs = {path: [state, attempts, size] for path, state, attempts, size in rows}
+        
+        self._closing = False
+        self._thread = threading.Thread(target=self._writer_loop, name="koemoji-jobstore", daemon=True)
+        self._thread.start()
+    
+    def close(self):
+        """溜まっている書き込みをコミットして閉じる"""
+        if self._thread is None:
+            return
+        self._closing = True
+        self._urgent_event.set()
+        self._dirty_event.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+    
+    def pending_jobs(self):
+        """再開すべきジョブ（queued/running）をキュー投入順に返す"""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT path, size, state, attempts, queued_at FROM jobs "
+                "WHERE state IN ('queued', 'running') ORDER BY queued_at"
+            ).fetchall()
+        finally:
+            conn.close()
+    
+    def get(self, path):
+        """未完了・失敗ジョブの(state, attempts, size)を返す（なければNone）"""
+        with self._lock:
+            job = self._jobs.get(path)
+            return tuple(job) if job else None
+    
+    def _append(self, sql, params):
+        # ロック保持中に呼ぶこと
+        self._pending.append((sql, params))
+        self._queued_seq += 1
+        self._dirty_event.set()
+    
+    def mark_queued(self, path, size, queued_at):
+        with self._lock:
+            # 内容（サイズ）が変わったファイルは試行回数をリセット
+            prev = self._jobs.get(path)
+            attempts = prev[1] if prev and prev[2] == size else 0
+            self._jobs[path] = ["queued", attempts, size]
+            self._append(
+                "INSERT INTO jobs (path, size, state, attempts, queued_at) VALUES (?, ?, 'queued', 0, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state = 'queued', size = excluded.size, "
+                "queued_at = excluded.queued_at, started_at = NULL, finished_at = NULL, error = NULL, "
+                "attempts = CASE WHEN jobs.state = 'done' OR jobs.size != excluded.size "
+                "THEN 0 ELSE jobs.attempts END",
+                (path, size, queued_at)
+            )
+    
+    def mark_running(self, path):
+        with self._lock:
+            job = self._jobs.setdefault(path, ["queued", 0, 0])
+            job[0] = "running"
+            job[1] += 1
+            self._append(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, started_at = ? WHERE path = ?",
+                (time.time(), path)
+            )
+    
+    def mark_finished(self, path, state, error=None):
+        """完了（done）・失敗（failed）・取り消し（cancelled）を記録"""
+        with self._lock:
+            if state == "done":
+                self._jobs.pop(path, None)
+            elif path in self._jobs:
+                self._jobs[path][0] = state
+            self._append(
+                "UPDATE jobs SET state = ?, finished_at = ?, error = ? WHERE path = ?",
+                (state, time.time(), error, path)
+            )
+    
+    def set_profile(self, path, profile):
+        """ジョブの段階別プロファイル（JSON文字列）を記録"""
+        with self._lock:
+            self._append("UPDATE jobs SET profile = ? WHERE path = ?", (profile, path))
+    
+    def get_profile(self, path):
+        """コミット済みの段階別プロファイル（辞書。なければNone）"""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT profile FROM jobs WHERE path = ?", (path,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row and row[0] else None
+    
+    def flush(self, timeout=10):
+        """ここまでの書き込みがコミットされるまで待つ"""
+        with self._lock:
+            if self._thread is None:
+                return
+            target = self._queued_seq
+            self._urgent_event.set()
+            self._committed.wait_for(lambda: self._committed_seq >= target, timeout=timeout)
+    
+    def _writer_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                self._dirty_event.wait()
+                # 書き込みをまとめるため、急ぎでなければ少し待ってから一括コミット
+                self._urgent_event.wait(self.flush_interval)
+                self._urgent_event.clear()
+                self._dirty_event.clear()
+                
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    batch_seq = self._queued_seq
+                if batch:
+                    try:
+                        with conn:
+                            for sql, params in batch:
+                                conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        logger.error(f"❌ ジョブ状態の保存に失敗しました: {e}")
+                with self._lock:
+                    self._committed_seq = batch_seq
+                    self._committed.notify_all()
+                    if self._closing and not self._pending:
+                        return
+        finally:
+            conn.close()
+
+
+class TranscriptWriter:
+    """文字起こしを一時ファイル（.part）へ逐次書き込み、完了時に最終ファイルへ置き換える
+    
+    .partは一定間隔でフラッシュされるため、処理中でもtail等で途中結果を確認できる。
+    checkpoint_keyを渡すと、フラッシュのたびに最後のセグメントの終了時刻と
+    .partの長さをチェックポイント（.ckpt）に記録し、同じキーで再作成したときに
+    その位置から書き込みを再開する（resume_fromに再開位置の秒数が入る）。
+    """
+    
+    def __init__(self, output_path, flush_interval=5, checkpoint_key=None):
+        self.output_path = output_path
+        self.part_path = f"{output_path}.part"
+        self.checkpoint_path = f"{output_path}.ckpt"
+        self.flush_interval = flush_interval
+        self.checkpoint_key = checkpoint_key
+        self.length = 0
+        self.segments = 0
+        self.resume_from = 0.0
+        self._bytes = 0
+        self._last_end = None
+        
+        mode = 'w'
+        checkpoint = self._load_checkpoint() if checkpoint_key is not None else None
+        if checkpoint:
+            # チェックポイント以降に書かれた中途半端な部分を切り捨てて追記
+            with open(self.part_path, 'r+b') as f:
+                f.truncate(checkpoint["part_bytes"])
+            mode = 'a'
+            self.resume_from = checkpoint["end"]
+            self.segments = checkpoint["segments"]
+            self.length = checkpoint["length"]
+            self._bytes = checkpoint["part_bytes"]
+            self._last_end = checkpoint["end"]
+        
+        self._file = open(self.part_path, mode, encoding='utf-8')
+        self._last_flush = time.time()
+    
+    @property
+    def position(self):
+        """書き込み済みの最後のセグメントの終了時刻（秒）"""
+        return self._last_end or 0.0
+    
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            if (checkpoint.get("key") != self.checkpoint_key or
+                    os.path.getsize(self.part_path) < checkpoint["part_bytes"]):
+                return None
+            return checkpoint
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def _write(self, text):
+        self._file.write(text)
+        self._bytes += len(text.encode('utf-8'))
+    
+    def write(self, text):
+        """テキストをそのまま書き込む"""
+        self._write(text)
+        self.length += len(text)
+        self._maybe_flush()
+    
+    def write_segment(self, text, end=None):
+        """セグメントを1行として書き込む（従来の改行区切りと同じ形式）"""
+        text = text.strip()
+        if self.segments:
+            self._write("\n")
+        self._write(text)
+        self.segments += 1
+        self.length += len(text)
+        if end is not None:
+            self._last_end = float(end)
+        self._maybe_flush()
+    
+    def _maybe_flush(self):
+        now = time.time()
+        if now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            self._save_checkpoint()
+            self._last_flush = now
+    
+    def _save_checkpoint(self):
+        if self.checkpoint_key is None or self._last_end is None:
+            return
+        checkpoint = {
+            "key": self.checkpoint_key,
+            "end": self._last_end,
+            "segments": self.segments,
+            "length": self.length,
+            "part_bytes": self._bytes
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            logger.warning(f"⚠️  チェックポイントの保存に失敗しました: {e}")
+    
+    def _remove_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+    
+    def reset(self):
+        """書き込んだ内容（チェックポイントから再開した分も含む）を捨てて先頭から書き直す"""
+        self._file.close()
+        self._file = open(self.part_path, 'w', encoding='utf-8')
+        self.length = 0
+        self.segments = 0
+        self.resume_from = 0.0
+        self._bytes = 0
+        self._last_end = None
+        self._remove_checkpoint()
+    
+    def commit(self):
+        """書き込みを確定し、最終ファイルへアトミックに置き換える"""
+        self._file.close()
+        os.replace(self.part_path, self.output_path)
+        self._remove_checkpoint()
+    
+    def discard(self):
+        """確定前なら一時ファイルとチェックポイントを削除（確定後は何もしない）"""
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.part_path)
+        except FileNotFoundError:
+            pass
+        self._remove_checkpoint()
+
+
+class TranscriptCache:
+    """メディアの内容ハッシュと文字起こし設定をキーにした文字起こし結果のキャッシュ
+    
+    容量が上限を超えたら最終利用時刻（mtime）の古いものから削除する。
+    """
+    
+    HASH_CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+    
+    @classmethod
+    def hash_file(cls, file_path):
+        """ファイル全体を読み込まずにストリーミングでハッシュを計算"""
+        digest = hashlib.sha256()
+        buf = bytearray(cls.HASH_CHUNK_SIZE)
+        view = memoryview(buf)
+        with open(file_path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digest.update(view[:n])
+        return digest.hexdigest()
+    
+    @classmethod
+    def make_key(cls, file_path, params):
+        """内容ハッシュと設定（モデル・精度・言語・デコードオプション）からキーを作成"""
+        params_json = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha256(cls.hash_file(file_path).encode())
+        digest.update(params_json.encode("utf-8"))
+        return digest.hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.txt")
+    
+    def _entries(self):
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+    
+    def get(self, key):
+        """キャッシュ済みの文字起こしを返す（なければNone）"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # 利用時刻を更新して削除対象から遠ざける
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+    
+    def put(self, key, text):
+        """文字起こし結果を保存し、容量上限を超えた分を削除"""
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        self._commit(key, tmp_path)
+    
+    def put_file(self, key, source_path):
+        """出力済みの文字起こしファイルをコピーして保存"""
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source_path, tmp_path)
+        self._commit(key, tmp_path)
+    
+    def _commit(self, key, tmp_path):
+        path = self._path(key)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            try:
+                self._total_bytes -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+            self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        # ロック保持中に呼ぶこと
+        evicted = 0
+        for _, path, size in sorted(self._entries()):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"🧹 文字起こしキャッシュを{evicted}件削除しました")
+    
+    def stats(self):
+        with self._lock:
+            return self.hits, self.misses
+
+
+def extract_audio_track(source_path, output_path):
+    """動画から音声トラックだけを抜き出す（音声がなければFalse）
+    
+    まずデコードせずにパケットをそのままm4aへコピーし、m4aに入らないコーデックの場合は
+    16kHzモノラルのFLACに変換する。いずれもコンテナは先頭から1回だけ順に読む。
+    """
+    import av
+    
+    with av.open(source_path) as container:
+        stream = next(iter(container.streams.audio), None)
+        if stream is None:
+            return False
+        try:
+            with av.open(output_path, "w", format="mp4") as output:
+                if hasattr(output, "add_stream_from_template"):
+                    output_stream = output.add_stream_from_template(stream)
+                else:
+                    output_stream = output.add_stream(template=stream)
+                for packet in container.demux(stream):
+                    # デマルチプレクサの終端を示す空パケットは書き込まない
+                    if packet.dts is None:
+                        continue
+                    packet.stream = output_stream
+                    output.mux(packet)
+            return True
+        except (av.error.FFmpegError, ValueError) as e:
+            logger.debug(f"音声のストリームコピーができないため変換します: {os.path.basename(source_path)} - {e}")
+    
+    with av.open(source_path) as container, av.open(output_path, "w", format="flac") as output:
+        stream = container.streams.audio[0]
+        output_stream = output.add_stream("flac", rate=SAMPLE_RATE)
+        output_stream.layout = "mono"
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+        for frame in container.decode(stream):
+            for resampled in resampler.resample(frame):
+                for packet in output_stream.encode(resampled):
+                    output.mux(packet)
+        for resampled in resampler.resample(None):
+            for packet in output_stream.encode(resampled):
+                output.mux(packet)
+        for packet in output_stream.encode(None):
+            output.mux(packet)
+    return True
+
+
+class AudioTrackCache:
+    """動画から抜き出した音声トラックのキャッシュ
+    
+    キーは動画のパス・サイズ・更新時刻（動画本体は読まない）。
+    容量が上限を超えたら最終利用時刻（mtime）の古いものから削除する。
+    """
+    
+    SUFFIX = ".audio"
+    
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._extract_locks = {}
+        os.makedirs(folder, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+    
+    def _path(self, source_path):
+        st = os.stat(source_path)
+        key = f"{os.path.abspath(source_path)}\0{st.st_size}\0{st.st_mtime_ns}"
+        return os.path.join(self.folder, hashlib.sha256(key.encode("utf-8")).hexdigest() + self.SUFFIX)
+    
+    def _entries(self):
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX) and entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+    
+    def get(self, source_path):
+        """抜き出し済みの音声のパスを返す（未作成ならNone）"""
+        path = self._path(source_path)
+        try:
+            # 利用時刻を更新して削除対象から遠ざける
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+    
+    def extract(self, source_path):
+        """音声トラックのパスを返す（未作成なら抜き出す。音声がなければNone）
+        
+        同じ動画を先読みとワーカーが同時に処理しても抜き出しは1回だけ行う。
+        """
+        path = self._path(source_path)
+        with self._lock:
+            lock = self._extract_locks.setdefault(path, threading.Lock())
+        with lock:
+            cached = self.get(source_path)
+            if cached is not None:
+                return cached
+            
+            start_time = time.time()
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                if not extract_audio_track(source_path, tmp_path):
+                    return None
+                size = os.path.getsize(tmp_path)
+                with self._lock:
+                    os.replace(tmp_path, path)
+                    self._total_bytes += size
+                    if self._total_bytes > self.max_bytes:
+                        self._evict(keep=path)
+            finally:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    self._extract_locks.pop(path, None)
+        
+        source_size = os.path.getsize(source_path)
+        logger.info(f"🎞️  動画から音声を抜き出しました: {os.path.basename(source_path)} "
+                    f"({source_size / 1024 / 1024:.1f}MB -> {size / 1024 / 1024:.1f}MB, "
+                    f"{time.time() - start_time:.2f}秒)")
+        return path
+    
+    def _evict(self, keep=None):
+        # ロック保持中に呼ぶこと
+        evicted = 0
+        for _, path, size in sorted(self._entries()):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"🧹 音声トラックのキャッシュを{evicted}件削除しました")
+
+
+def probe_media(file_path):
+    """メディアの長さ（秒）と音声コーデック名をヘッダから取得（デコードしない）
+    
+    取得できなかった値はNoneになる。
+    """
+    try:
+        import av
+    except ImportError:
+        return None, None
+    duration = None
+    codec = None
+    try:
+        with av.open(file_path) as container:
+            stream = next(iter(container.streams.audio), None)
+            if stream is not None:
+                codec = stream.codec_context.name
+            if container.duration:
+                duration = container.duration / av.time_base
+            elif stream is not None and stream.duration and stream.time_base:
+                duration = float(stream.duration * stream.time_base)
+    except Exception:
+        pass
+    return duration, codec
+
+
+def probe_duration(file_path):
+    """メディアの長さ（秒）をヘッダから取得（デコードしない。取得できなければNone）"""
+    return probe_media(file_path)[0]
+
+
+def detect_speech_bounds(audio, threshold_db=-50.0, frame_ms=30, padding_seconds=0.5):
+    """フレームごとのRMSで無音でない範囲を求める（NumPyでベクトル化、音声全体を1回なめるだけ）
+    
+    threshold_dbはフルスケール基準のdB。前後にpadding_secondsの余白を付けた
+    (開始サンプル, 終了サンプル)を返す。全体が無音ならNone。
+    """
+    import numpy as np
+    
+    frame_length = max(1, int(SAMPLE_RATE * frame_ms / 1000))
+    frame_count = len(audio) // frame_length
+    if frame_count == 0:
+        return None
+    frames = audio[:frame_count * frame_length].reshape(frame_count, frame_length)
+    # 二乗の一時配列を作らずにフレームごとの二乗和を求める
+    energy = np.einsum("ij,ij->i", frames, frames) / frame_length
+    threshold = (10 ** (threshold_db / 20)) ** 2
+    voiced = np.flatnonzero(energy > threshold)
+    # 端数のフレームも判定に含める
+    tail = audio[frame_count * frame_length:]
+    tail_voiced = len(tail) > 0 and float(np.dot(tail, tail)) / len(tail) > threshold
+    if len(voiced) == 0 and not tail_voiced:
+        return None
+    
+    padding = int(padding_seconds * SAMPLE_RATE)
+    first = voiced[0] * frame_length if len(voiced) else frame_count * frame_length
+    last = len(audio) if tail_voiced else (voiced[-1] + 1) * frame_length
+    return max(0, first - padding), min(len(audio), last + padding)
+
+
+def plan_chunks(speech_timestamps, total_samples, target_samples):
+    """無音区間の中央で区切り、目標長以下のチャンク境界[(開始, 終了), ...]を返す
+    
+    speech_timestampsは発話区間（サンプル単位の{"start", "end"}）のリスト。
+    目標長を超えても切れ目となる無音がなければ、次の無音まで延ばす。
+    """
+    candidates = [
+        (prev["end"] + cur["start"]) // 2
+        for prev, cur in zip(speech_timestamps, speech_timestamps[1:])
+        if cur["start"] > prev["end"]
+    ]
+    
+    cuts = []
+    start = 0
+    last_fit = None
+    for cut in candidates:
+        if cut - start > target_samples:
+            # 目標長に収まる最後の切れ目、なければこの切れ目で区切る
+            chosen = last_fit if last_fit is not None else cut
+            cuts.append(chosen)
+            start = chosen
+            last_fit = None
+            if cut - start > target_samples:
+                cuts.append(cut)
+                start = cut
+                continue
+        if cut > start:
+            last_fit = cut
+    
+    # 残りが目標長を超える場合は最後の切れ目でもう一度区切る
+    if total_samples - start > target_samples and last_fit is not None:
+        cuts.append(last_fit)
+    
+    bounds = [0] + cuts + [total_samples]
+    return [(s, e) for s, e in zip(bounds, bounds[1:]) if e > s]
+
+
+class AudioPrefetcher:
+    """次に処理するファイルを専用スレッドで16kHzモノラルfloat32にデコードしておく
+    
+    推論中はデコーダが、デコード中はモデルが遊ばないよう、推論と次のファイルのデコードを重ねる。
+    デコード済み音声（デコード中の見積もりを含む）の合計がmemory_budget_bytesを超える場合は着手を待つ。
+    デコードした結果が見積もりより大きく予算を超える場合は保持せず、ワーカーに直接デコードさせる。
+    """
+    
+    # float32モノラル1秒あたりのバイト数
+    BYTES_PER_SECOND = SAMPLE_RATE * 4
+    
+    def __init__(self, decode, memory_budget_bytes):
+        self._decode = decode
+        self.memory_budget_bytes = memory_budget_bytes
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # パス -> 見積もりバイト数（着手順）
+        self._ready = {}               # パス -> デコード済み音声
+        self._decoding = None
+        self._drop_decoding = False
+        self._used = 0
+        self._thread = None
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+    
+    def prefetch(self, upcoming, keep=()):
+        """先読み対象を更新する
+        
+        upcomingは(パス, 見積もりバイト数)を処理順に並べたもの。
+        upcomingにもkeepにもないデコード済み音声は破棄する。
+        """
+        with self._cond:
+            wanted = set(keep)
+            wanted.update(path for path, _ in upcoming)
+            for path in [path for path in self._ready if path not in wanted]:
+                self._used -= self._ready.pop(path).nbytes
+            if self._decoding is not None and self._decoding not in wanted:
+                self._drop_decoding = True
+            
+            # 単体で予算を超えるファイルは先読みしない（ワーカーが直接デコード）
+            self._pending = OrderedDict(
+                (path, estimate) for path, estimate in upcoming
+                if path not in self._ready and path != self._decoding
+                and estimate <= self.memory_budget_bytes
+            )
+            if self._pending and self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="koemoji-prefetch", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+    
+    def take(self, path):
+        """デコード済み音声を取り出す（デコード中なら完了を待つ。未着手ならNone）"""
+        with self._cond:
+            self._pending.pop(path, None)
+            if self._decoding == path:
+                self._drop_decoding = False
+                while self._decoding == path:
+                    self._cond.wait()
+            audio = self._ready.pop(path, None)
+            if audio is None:
+                self.misses += 1
+                return None
+            self._used -= audio.nbytes
+            self.hits += 1
+            self._cond.notify_all()
+            return audio
+    
+    def discard(self, path):
+        """先読みした音声を使わずに破棄"""
+        with self._cond:
+            self._pending.pop(path, None)
+            if self._decoding == path:
+                self._drop_decoding = True
+            audio = self._ready.pop(path, None)
+            if audio is not None:
+                self._used -= audio.nbytes
+                self._cond.notify_all()
+    
+    def memory_used(self):
+        with self._cond:
+            return self._used
+    
+    def stop(self):
+        """デコードスレッドを止めて先読み済みの音声を解放"""
+        with self._cond:
+            self._stopped = True
+            self._pending.clear()
+            self._ready.clear()
+            self._used = 0
+            self._cond.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join(timeout=5)
+    
+    def _can_start(self):
+        if not self._pending:
+            return False
+        estimate = next(iter(self._pending.values()))
+        return self._used + estimate <= self.memory_budget_bytes
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._can_start():
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                path, estimate = self._pending.popitem(last=False)
+                self._decoding = path
+                self._drop_decoding = False
+                self._used += estimate
+            
+            audio = None
+            try:
+                audio = self._decode(path)
+            except Exception as e:
+                logger.debug(f"先読みデコードに失敗しました: {os.path.basename(path)} - {e}")
+            
+            with self._cond:
+                self._used -= estimate
+                # 見積もりより大きかった場合も予算を超えては保持しない（ワーカーが直接デコード）
+                if audio is not None and self._used + audio.nbytes > self.memory_budget_bytes:
+                    logger.debug(f"先読みした音声が予算を超えるため破棄します: {os.path.basename(path)}")
+                    audio = None
+                if audio is not None and not self._drop_decoding and not self._stopped:
+                    self._ready[path] = audio
+                    self._used += audio.nbytes
+                self._decoding = None
+                self._cond.notify_all()
+
+
+def detect_cpu_topology():
+    """NUMAノードごとの物理コアを返す: {ノード番号: [[論理CPU, ...], ...]}
+    
+    Linuxではsysfsのトポロジ情報を読み、現在のアフィニティ（taskset・cgroup）で
+    使えるCPUだけを対象にする。それ以外のOSでは物理コア数から推定する。
+    """
+    if hasattr(os, "sched_getaffinity") and os.path.isdir("/sys/devices/system/cpu"):
+        cores = {}
+        nodes = {}
+        for cpu in sorted(os.sched_getaffinity(0)):
+            base = f"/sys/devices/system/cpu/cpu{cpu}"
+            try:
+                with open(f"{base}/topology/physical_package_id") as f:
+                    package = int(f.read())
+                with open(f"{base}/topology/core_id") as f:
+                    core = int(f.read())
+                key = (package, core)
+            except (OSError, ValueError):
+                key = ("cpu", cpu)
+            cores.setdefault(key, []).append(cpu)
+            try:
+                node = next((int(name[4:]) for name in os.listdir(base)
+                             if name.startswith("node") and name[4:].isdigit()), 0)
+            except OSError:
+                node = 0
+            nodes[cpu] = node
+        
+        topology = {}
+        for core_cpus in sorted(cores.values()):
+            topology.setdefault(nodes[core_cpus[0]], []).append(core_cpus)
+        return topology
+    
+    logical = os.cpu_count() or 1
+    physical = psutil.cpu_count(logical=False) or logical
+    per_core = max(1, logical // physical)
+    return {0: [list(range(i * per_core, (i + 1) * per_core)) for i in range(physical)]}
+
+
+def plan_cpu_allocation(topology, workers, use_smt=False):
+    """物理コアをワーカー数で分割し、ワーカーごとの論理CPUのリストを返す
+    
+    コアはNUMAノード順に並べて連続した範囲で割り当てるため、ワーカーがノードを
+    またぐのは割り切れない場合だけになる。use_smtがFalseならコアごとに1スレッド
+    （SMTの兄弟スレッドは使わない）。コアがワーカー数より少なければコアを共有する。
+    """
+    cores = [core for node in sorted(topology) for core in topology[node]]
+    workers = max(1, workers)
+    if not cores:
+        return [[] for _ in range(workers)]
+    if len(cores) < workers:
+        groups = [[cores[i % len(cores)]] for i in range(workers)]
+    else:
+        base, extra = divmod(len(cores), workers)
+        groups = []
+        start = 0
+        for i in range(workers):
+            size = base + (1 if i < extra else 0)
+            groups.append(cores[start:start + size])
+            start += size
+    return [sorted(cpu for core in group for cpu in (core if use_smt else core[:1])) for group in groups]
+
+
+# モデル生成時のスレッドの固定は同時に1つだけ行う（同時にロードすると新しいスレッドを区別できない）
+_pin_lock = threading.Lock()
+
+
+def _thread_ids():
+    try:
+        return set(os.listdir("/proc/self/task"))
+    except OSError:
+        return set()
+
+
+def pin_threads_created_by(func, allocation):
+    """funcの実行中にこのスレッドから作られたスレッドを割り当てどおりにCPUへ固定してfuncの戻り値を返す
+    
+    CTranslate2はモデル生成時にワーカー（レプリカ）ごとのスレッドを作り、その後の演算スレッドは
+    各ワーカーから生成されてアフィニティを引き継ぐ。funcの実行中はこのスレッドを最初の割り当てに
+    固定して新しいスレッドに引き継がせ、その割り当てを持つスレッドだけを対象にする
+    （同じ時間に他のワーカー・先読み・PyAVなどが作ったスレッドは固定しない）。
+    複数のモデルを同時にロードすると区別できないため、固定を伴うfuncの実行は1つずつ行う。
+    対象のスレッド数が割り当て数と一致しない場合は個別に固定せず、全体の割り当て範囲にだけ固定する。
+    """
+    if not hasattr(os, "sched_setaffinity") or not allocation:
+        return func()
+    marker = set(allocation[0])
+    with _pin_lock:
+        try:
+            original = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, marker)
+        except OSError as e:
+            logger.debug(f"スレッドのCPU固定に失敗しました: {e}")
+            return func()
+        before = _thread_ids()
+        try:
+            result = func()
+        finally:
+            try:
+                os.sched_setaffinity(0, original)
+            except OSError as e:
+                logger.debug(f"ロード後のCPU割り当てを戻せませんでした: {e}")
+        
+        created = []
+        for tid in sorted(_thread_ids() - before, key=int):
+            try:
+                if os.sched_getaffinity(int(tid)) == marker:
+                    created.append(tid)
+            except OSError:
+                # 既に終了したスレッド
+                pass
+    if len(created) == len(allocation):
+        pairs = zip(created, allocation)
+    else:
+        union = sorted({cpu for cpus in allocation for cpu in cpus})
+        logger.info(f"🧩 モデルのスレッド数({len(created)})がワーカー数({len(allocation)})と一致しないため、"
+                    f"ワーカーごとには固定せず割り当て範囲全体に固定します")
+        pairs = ((tid, union) for tid in created)
+    for tid, cpus in pairs:
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError as e:
+            logger.debug(f"スレッドのCPU固定に失敗しました: {tid} - {e}")
+    return result
+
+
+def release_memory_to_os():
+    """解放済みのヒープをOSに返す（glibcのmalloc_trim。対応していなければFalse）"""
+    if not IS_LINUX:
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        libc.malloc_trim(0)
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class ModelPool:
+    """ロード済みWhisperモデルのLRUプール
+    
+    (モデルサイズ, 計算精度, CPUスレッド数, ワーカー数)をキーに保持し、
+    件数またはメモリ予算を超えたら最も長く使われていないモデルから解放する。
+    モデルごとのメモリ量はロード前後の常駐メモリ（RSS）の差で見積もる。
+    ロードはロックの外で行うため、ロード中も他のキーのモデルはすぐに返る
+    （同じキーを同時に要求した場合は最初のロードの完了を待つ）。
+    """
+    
+    def __init__(self, max_models=2, memory_budget_bytes=0):
+        self.max_models = max(1, max_models)
+        self.memory_budget_bytes = memory_budget_bytes
+        self._models = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _rss():
+        try:
+            return psutil.Process().memory_info().rss
+        except Exception:
+            return 0
+    
+    def get(self, key, loader):
+        """キーに対応するモデルを返す（なければloaderでロードしてプールに追加）"""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            loading = self._loading.get(key)
+            if loading is None:
+                self._loading[key] = future = Future()
+        if loading is not None:
+            # 別のスレッドが同じモデルをロード中（失敗した場合は同じ例外を送出）
+            return loading.result()
+        
+        logger.info(f"🧠 Whisperモデルをロード中: {key[0]} ({key[1]}, {key[2]}スレッド)")
+        rss_before = self._rss()
+        start_time = time.time()
+        try:
+            model = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        load_time = time.time() - start_time
+        model_bytes = max(0, self._rss() - rss_before)
+        
+        with self._lock:
+            del self._loading[key]
+            self._models[key] = (model, model_bytes)
+            self._evict(keep=key)
+            pooled = len(self._models)
+        future.set_result(model)
+        logger.info(f"🧠 モデルのロード完了: {key[0]} ({load_time:.1f}秒, 約{model_bytes / 1024 / 1024:.0f}MB, "
+                    f"プール{pooled}件)")
+        return model
+    
+    def _evict(self, keep):
+        # ロック保持中に呼ぶこと
+        while len(self._models) > 1:
+            total = sum(size for _, size in self._models.values())
+            over_budget = self.memory_budget_bytes and total > self.memory_budget_bytes
+            if len(self._models) <= self.max_models and not over_budget:
+                return
+            oldest = next(iter(self._models))
+            if oldest == keep:
+                return
+            _, size = self._models.pop(oldest)
+            logger.info(f"♻️  モデルをプールから解放: {oldest[0]} ({oldest[1]}, 約{size / 1024 / 1024:.0f}MB)")
+    
+    def clear(self):
+        """すべてのモデルを解放し、解放した件数を返す"""
+        with self._lock:
+            count = len(self._models)
+            self._models.clear()
+            return count
+    
+    def keys(self):
+        with self._lock:
+            return list(self._models)
+    
+    def __len__(self):
+        return len(self._models)
+
+
+class ConcurrencyController:
+    """CPU使用率・空きメモリ・負荷平均の時間窓平均と、ジョブごとの実測RTFから同時実行数を調整する
+    
+    同時実行数nでのRTF（処理時間÷音声の長さ）の移動平均から全体のスループットn/RTFを推定し、
+    nを増やしてもスループットが伸びなければ減らす。空きメモリ不足やスワップ発生時も減らす。
+    """
+    
+    RTF_SMOOTHING = 0.3
+    
+    def __init__(self, max_workers, max_cpu_percent=95, min_free_memory_mb=1024, window_seconds=60):
+        self.max_workers = max(1, max_workers)
+        self.max_cpu_percent = max_cpu_percent
+        self.min_free_bytes = min_free_memory_mb * 1024 * 1024
+        self.window_seconds = window_seconds
+        self.limit = self.max_workers
+        self._samples = deque()
+        self._rtf = {}
+        self._last_swap = self._swap_total()
+        self._lock = threading.Lock()
+        # 初回のcpu_percent()は常に0.0を返すため、ここで計測を開始しておく
+        psutil.cpu_percent(interval=None)
+    
+    @staticmethod
+    def _swap_total():
+        try:
+            swap = psutil.swap_memory()
+            return swap.sin + swap.sout
+        except Exception:
+            return 0
+    
+    def sample(self):
+        """前回のサンプルからの平均CPU使用率・空きメモリ・負荷平均・スワップ量を記録"""
+        now = time.time()
+        cpu = psutil.cpu_percent(interval=None)
+        available = psutil.virtual_memory().available
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            load = None
+        swap_total = self._swap_total()
+        swapped = max(0, swap_total - self._last_swap)
+        self._last_swap = swap_total
+        
+        with self._lock:
+            self._samples.append((now, cpu, available, load, swapped))
+            while self._samples and now - self._samples[0][0] > self.window_seconds:
+                self._samples.popleft()
+    
+    def cpu_average(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(s[1] for s in self._samples) / len(self._samples)
+    
+    def record_job(self, workers, audio_seconds, elapsed):
+        """同時実行数workersで処理したジョブの実測RTFを記録（RTFを返す）"""
+        if not audio_seconds or elapsed <= 0:
+            return None
+        rtf = elapsed / audio_seconds
+        with self._lock:
+            prev = self._rtf.get(workers)
+            self._rtf[workers] = rtf if prev is None else prev + self.RTF_SMOOTHING * (rtf - prev)
+        return rtf
+    
+    def _throughput(self, workers):
+        # ロック保持中に呼ぶこと。音声秒数/実時間秒数の推定値（未計測ならNone）
+        rtf = self._rtf.get(workers)
+        return workers / rtf if rtf else None
+    
+    def update(self, running, queued):
+        """直近の計測から同時実行数の上限を決めて返す"""
+        with self._lock:
+            samples = list(self._samples)
+            limit = min(self.limit, self.max_workers)
+            reason = None
+            
+            if samples:
+                latest_available = samples[-1][2]
+                swapped = sum(s[4] for s in samples[-3:])
+                cpu = sum(s[1] for s in samples) / len(samples)
+                loads = [s[3] for s in samples if s[3] is not None]
+                load = sum(loads) / len(loads) if loads else 0.0
+                
+                current = self._throughput(limit)
+                lower = self._throughput(limit - 1) if limit > 1 else None
+                higher = self._throughput(limit + 1)
+                
+                if latest_available < self.min_free_bytes and limit > 1:
+                    limit -= 1
+                    reason = f"空きメモリ不足 ({latest_available / 1024 / 1024:.0f}MB)"
+                elif swapped and limit > 1:
+                    limit -= 1
+                    reason = f"スワップ発生 ({swapped / 1024 / 1024:.1f}MB)"
+                elif current and lower and current < lower * 0.95:
+                    limit -= 1
+                    reason = f"並列数を増やしてもスループットが伸びない ({lower:.2f} → {current:.2f}倍速)"
+                elif (queued and running >= limit and limit < self.max_workers and
+                      cpu < self.max_cpu_percent and load < 1.0 and
+                      latest_available >= self.min_free_bytes * 2 and
+                      not (current and higher and higher < current * 1.05)):
+                    limit += 1
+                    reason = f"余力あり (CPU {cpu:.0f}%, 負荷 {load:.2f}/コア)"
+            
+            if limit != self.limit:
+                logger.info(f"🎛️  同時実行数を変更: {self.limit} → {limit} ({reason})")
+                self.limit = limit
+            return self.limit
+    
+    def snapshot(self):
+        """現在の判断材料（ログ・状態表示用）"""
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "cpu_percent": round(sum(s[1] for s in self._samples) / len(self._samples), 1) if self._samples else None,
+                "throughput": {n: round(n / rtf, 2) for n, rtf in sorted(self._rtf.items())}
+            }
+
+
+# 段階計測中のタイマーと入れ子の段階ごとの子の時間（スレッドごと）
+_stage_context = threading.local()
+
+
+class StageTimer:
+    """ジョブの段階（decode / vad / encoder / beam / write / archiveなど）ごとの所要時間
+    
+    計測中のスレッドでtimed_stage()を通った時間を段階ごとに加算する。入れ子の段階は内側の時間を
+    外側から差し引くため、各段階の時間は重複しない。並列に処理したチャンクは各スレッドの合計になる。
+    """
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def add(self, stage, seconds):
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+    
+    def elapsed(self):
+        return time.perf_counter() - self.started
+    
+    def attach(self):
+        """このスレッドの計測をこのタイマーに記録する（戻り値はdetach()に渡す）"""
+        previous = (getattr(_stage_context, "timer", None), getattr(_stage_context, "stack", None))
+        _stage_context.timer, _stage_context.stack = self, []
+        return previous
+    
+    @staticmethod
+    def detach(previous):
+        _stage_context.timer, _stage_context.stack = previous
+    
+    @contextmanager
+    def bind(self):
+        previous = self.attach()
+        try:
+            yield self
+        finally:
+            self.detach(previous)
+    
+    @staticmethod
+    def current():
+        """このスレッドで計測中のタイマー（なければNone）"""
+        return getattr(_stage_context, "timer", None)
+
+
+@contextmanager
+def timed_stage(stage):
+    """計測中のジョブがあれば、このブロックの時間を段階stageに加算する（なければ何もしない）"""
+    timer = getattr(_stage_context, "timer", None)
+    if timer is None:
+        yield
+        return
+    stack = _stage_context.stack
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timer.add(stage, elapsed - children)
+
+
+def _timed(stage, func):
+    """関数の呼び出しを段階stageとして計測するラッパー"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed_stage(stage):
+            return func(*args, **kwargs)
+    wrapper._koemoji_stage = stage
+    return wrapper
+
+
+def instrument_transcriber(transcriber):
+    """faster-whisperのエンコーダ・ビームサーチ・VADを段階計測の対象にする（同じ対象には1回だけ）
+    
+    計測中でないスレッドからの呼び出しはそのまま素通りする。
+    """
+    targets = [(transcriber, "encode", "encoder"), (transcriber, "generate_with_fallback", "beam")]
+    if hasattr(transcriber, "generate_segment_batched"):
+        # BatchedInferencePipelineはまとめてエンコードしてからビームサーチする
+        targets = [(transcriber, "generate_segment_batched", "beam"), (transcriber.model, "encode", "encoder")]
+    for target, name, stage in targets:
+        func = getattr(target, name, None)
+        if callable(func) and not hasattr(func, "_koemoji_stage"):
+            setattr(target, name, _timed(stage, func))
+    
+    # transcribe()の内部で呼ばれるデコード（パスを渡した場合）とVAD
+    try:
+        import faster_whisper.transcribe as fw_transcribe
+    except ImportError:
+        return
+    for name, stage in (("decode_audio", "decode"), ("get_speech_timestamps", "vad")):
+        func = getattr(fw_transcribe, name, None)
+        if callable(func) and not hasattr(func, "_koemoji_stage"):
+            setattr(fw_transcribe, name, _timed(stage, func))
+
+
+class InstanceLock:
+    """単一インスタンス用のロック付きPIDファイル
+    
+    ロックはプロセスが生きている間だけOS（flock / msvcrt.locking）が保持し、異常終了しても自動で外れる。
+    ファイルには1行目にPID、2行目にプロセスの開始時刻を書くため、他のプロセスはロックを取らずに
+    ファイルを読むだけで実行中か確認できる（開始時刻の一致でPIDの再利用と区別する）。
+    """
+    
+    # Windowsではファイル内容の読み取りを妨げないよう、内容より先のバイトをロックする
+    _WINDOWS_LOCK_OFFSET = 0x10000
+    
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+    
+    def acquire(self):
+        """ロックを取得してPIDを書き込む（他のプロセスが保持していればFalse）"""
+        if self._fd is not None:
+            return True
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if IS_WINDOWS:
+                    os.lseek(fd, self._WINDOWS_LOCK_OFFSET, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            if IS_WINDOWS or self._is_current_file(fd):
+                break
+            # 開いてからロックするまでの間に前の保持者が削除したファイルをロックした。
+            # 新しく作られるファイルのロックと重複しないよう開き直す
+            os.close(fd)
+        
+        started_at = psutil.Process().create_time()
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, f"{os.getpid()}\n{started_at}\n".encode())
+        self._fd = fd
+        return True
+    
+    def _is_current_file(self, fd):
+        """ロックしたファイルが削除・置き換えられていない（パスが同じファイルを指す）か"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(fd)
+        return (st.st_dev, st.st_ino) == (opened.st_dev, opened.st_ino)
+    
+    def release(self):
+        """ロックを外してPIDファイルを削除"""
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        if not IS_WINDOWS:
+            # ロック中に削除し、次に起動したプロセスのファイルを消さないようにする
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        try:
+            if IS_WINDOWS:
+                os.lseek(fd, self._WINDOWS_LOCK_OFFSET, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        if IS_WINDOWS:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+    
+    @staticmethod
+    def running_pid(path):
+        """PIDファイルのプロセスが実行中ならそのPID（なければNone）"""
+        try:
+            with open(path, 'r') as f:
+                pid, started_at = (float(value) for value in f.read().split()[:2])
+            process = psutil.Process(int(pid))
+            if abs(process.create_time() - started_at) < 1:
+                return int(pid)
+        except (OSError, ValueError, psutil.Error):
+            pass
+        return None
+
+
+class JobCancelled(Exception):
+    """制御APIから処理中のジョブの取り消しが要求された"""
+
+
+class ControlServer:
+    """Unixドメインソケットで制御コマンドを受け付ける
+    
+    1接続につきJSON1行のリクエスト（例: {"command": "list"}）を読み、handlerの戻り値を
+    JSON1行で返す。ソケットは所有者だけが読み書きできるようにする。
+    """
+    
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        self._sock = None
+        self._stop_r = None
+        self._stop_w = None
+        self._thread = None
+    
+    @staticmethod
+    def is_supported():
+        return hasattr(socket, "AF_UNIX")
+    
+    def start(self):
+        """待ち受けを開始"""
+        # 前回の異常終了で残ったソケット（インスタンスのロック取得後に呼ぶので削除してよい）
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            sock.listen(8)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._loop, name="koemoji-control", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """待ち受けを停止してソケットを削除"""
+        if self._thread is None:
+            return
+        os.write(self._stop_w, b"x")
+        self._thread.join(timeout=5)
+        for fd in (self._stop_r, self._stop_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._sock.close()
+        self._thread = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+    
+    def _loop(self):
+        while True:
+            readable, _, _ = select.select([self._sock, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                continue
+            with conn:
+                self._handle(conn)
+    
+    def _handle(self, conn):
+        conn.settimeout(5)
+        try:
+            with conn.makefile('rb') as reader:
+                line = reader.readline(64 * 1024)
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("JSONオブジェクトではありません")
+                response = self.handler(request)
+            except ValueError as e:
+                response = {"ok": False, "error": f"不正なリクエストです: {e}"}
+            except Exception as e:
+                logger.error(f"❌ 制御コマンドの処理中にエラーが発生しました: {e}")
+                response = {"ok": False, "error": str(e)}
+            conn.sendall((json.dumps(response, ensure_ascii=False) + "\n").encode('utf-8'))
+        except OSError as e:
+            logger.debug(f"制御接続を処理できませんでした: {e}")
+
+
+class MetricsRegistry:
+    """Prometheus形式のメトリクス（カウンター・ゲージ・ヒストグラム）
+    
+    記録は辞書の値を更新するだけにし、テキスト形式への変換はpublish()で公開するときだけ行う。
+    """
+    
+    def __init__(self):
+        self._definitions = OrderedDict()
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def counter(self, name, help_text):
+        self._definitions[name] = ("counter", help_text, None)
+    
+    def gauge(self, name, help_text):
+        self._definitions[name] = ("gauge", help_text, None)
+    
+    def histogram(self, name, help_text, buckets):
+        self._definitions[name] = ("histogram", help_text, tuple(sorted(buckets)))
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        """カウンターを加算"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        """ゲージを設定"""
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+    
+    def observe(self, name, value, **labels):
+        """ヒストグラムに観測値を追加（[バケットごとの件数..., 合計, 件数]で保持）"""
+        buckets = self._definitions[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+    
+    def get(self, name, **labels):
+        """現在の値（カウンター・ゲージは数値、ヒストグラムは(合計, 件数)。未記録はNone）"""
+        with self._lock:
+            value = self._values.get(self._key(name, labels))
+        if isinstance(value, list):
+            return value[-2], value[-1]
+        return value
+    
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+    
+    @staticmethod
+    def _format_value(value):
+        return str(value) if isinstance(value, int) else repr(float(value))
+    
+    def render(self):
+        """Prometheusのテキスト形式に変換"""
+        with self._lock:
+            values = {key: list(value) if isinstance(value, list) else value
+                      for key, value in self._values.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in self._definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series_name, labels), value in sorted(values.items()):
+                if series_name != name:
+                    continue
+                if kind != "histogram":
+                    lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', self._format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(value[-2])}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+    
+    def publish(self, path):
+        """テキスト形式をファイルに書き出す（読み手が書きかけを読まないよう置き換えで更新）"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
 class KoemojiProcessor:
     def __init__(self, config_path="config.json"):
         """初期化"""
         self.config_path = config_path
         self.load_config()
-        self.processing_queue = []
+        self.processing_queue = self._create_queue()
+        
+        # 処理中のファイル
+        self.files_in_process = set()
+        self._state_lock = threading.RLock()
+        
+        # 文字起こしワーカー（初回ディスパッチ時に生成）
+        self._executor = None
+        self._futures = {}
+        
+        # メインループを起こすイベント（理由は_pending_eventsに積む）
+        self._wake_event = threading.Event()
+        self._pending_events = set()
+        self._shutdown_requested = False
+        # CPU使用率が高くて延期したディスパッチの再試行時刻
+        self._dispatch_retry_at = None
+        # 実行中の本番（final）段階のジョブ数
+        self._running_finals = 0
+        
+        # 制御API（control_socket）からの操作：ディスパッチの一時停止・ドレイン（実行中のジョブの完了後に停止）・取り消し
+        self._paused = False
+        self._draining = False
+        self._cancel_requested = set()
+        # 取り消したファイルのサイズ（内容が変わるか置き直されるまで再投入しない）
+        self._cancelled = {}
+        # 実行中のジョブの進捗 {path: {"stage", "started_at", "duration", "writer"}}
+        self._active_jobs = {}
+        self._control_server = None
+        
+        # 同時実行数の調整
+        self._controller = ConcurrencyController(
+            self.config.get("max_concurrent_files", 3),
+            self.config.get("max_cpu_percent", 95),
+            self.config.get("min_free_memory_mb", 1024),
+            self.config.get("controller_window_seconds", 60)
+        )
+        
+        # メトリクス（run()のループで起床ごとにファイルへ公開し、webuiの/metricsが読む）
+        self.metrics = self._create_metrics()
+        
+        # 単一インスタンスのロック付きPIDファイルと生存確認用のハートビート（webuiの/statusが読む）
+        self._instance_lock = InstanceLock(self.config.get("pid_file", "koemoji.pid"))
+        self._last_heartbeat = 0.0
+        
+        # ジョブ状態の永続化（run()で開く）
+        self.job_store = None
+        
+        # 入力フォルダ・設定ファイルの監視
+        self._watcher = None
+        self._config_watcher = None
+        self._config_mtime = self._read_config_mtime()
         
-        # 処理中のファイル
-        self.files_in_process = set()
+        # 文字起こし結果のキャッシュ（初回利用時に生成）
+        self._transcript_cache = None
+        
+        # 動画から抜き出した音声トラックのキャッシュ（初回利用時に生成）
+        self._audio_track_cache = None
+        
+        # ロード済みWhisperモデルのプール
+        memory_budget_mb = self.config.get("model_pool_memory_mb", 0)
+        if not memory_budget_mb:
+            # 既定では物理メモリの半分まで
+            memory_budget_mb = psutil.virtual_memory().total / 1024 / 1024 / 2
+        self._model_pool = ModelPool(
+            self.config.get("model_pool_size", 2),
+            int(memory_budget_mb * 1024 * 1024)
+        )
+        self._batched_pipeline = None
+        self._model_lock = threading.Lock()
         
-        # Whisperモデルのキャッシュ
-        self._whisper_model = None
-        self._model_config = None
+        # 最後にジョブの開始・終了やファイルの検出があった時刻（アイドル時のモデル解放用）
+        self._last_activity = time.time()
+        self._preload_thread = None
+        
+        # 検出したCPUトポロジ（初回利用時に検出）
+        self._cpu_topology = None
+        
+        # 次に処理するファイルの先読みデコード（初回利用時に生成）
+        self._prefetcher = None
+        
+        # 無音の事前判定で推論を省いた音声の累計（秒）
+        self.silence_skipped_seconds = 0.0
     
     
     def load_config(self):
@@ -139,6 +2113,7 @@ class KoemojiProcessor:
     
     def scan_and_queue_files(self):
         """入力フォルダをスキャンしてファイルをキューに追加"""
+        scan_start = time.perf_counter()
         try:
             logger.debug("入力フォルダのスキャンを開始します")
             
@@ -148,139 +2123,763 @@ class KoemojiProcessor:
                 os.makedirs(input_folder, exist_ok=True)
                 return
             
-            # メディアファイルの拡張子
-            media_extensions = ('.mp3', '.mp4', '.wav', '.m4a', '.mov', '.avi', '.flac', '.ogg', '.aac')
-            
-            # 新しいファイルを検出
-            new_files = []
-            for file in os.listdir(input_folder):
-                file_path = os.path.join(input_folder, file)
-                
-                # ディレクトリはスキップ
-                if os.path.isdir(file_path):
-                    continue
-                
-                # 対象拡張子のファイルのみ処理
-                if not file.lower().endswith(media_extensions):
-                    continue
-                
-                # 既に処理中またはキュー済みのファイルはスキップ
-                if file_path in self.files_in_process or any(f["path"] == file_path for f in self.processing_queue):
+            # 新しいファイルを検出してキューに追加（プロファイルを割り当てたサブフォルダも対象）
+            added = 0
+            folders = [input_folder] + [
+                os.path.join(input_folder, subfolder) for subfolder in self._profile_subfolders()
+            ]
+            for folder in folders:
+                if folder != input_folder and not os.path.isdir(folder):
                     continue
-                
-                new_files.append(file_path)
+                for file in os.listdir(folder):
+                    file_path = os.path.join(folder, file)
+                    if self.queue_file(file_path):
+                        added += 1
             
-            if not new_files:
+            if not added:
                 logger.debug("新しいファイルはありません")
                 return
             
-            # キューに追加
-            for file_path in new_files:
-                file_name = os.path.basename(file_path)
-                file_size = os.path.getsize(file_path)
-                
-                # ファイル情報のメタデータを作成
-                file_info = {
-                    "path": file_path,
-                    "name": file_name,
-                    "size": file_size,
-                    "queued_at": datetime.now().isoformat()
-                }
-                
-                self.processing_queue.append(file_info)
-                logger.info(f"➕ キューに追加: {file_name}")
-                
+            # モデルが解放されていれば、ジョブの開始を待たずにロードを始める
+            self._last_activity = time.time()
+            self.request_preload()
             
             logger.info(f"📋 現在のキュー: {len(self.processing_queue)}件")
             
         except Exception as e:
             logger.error(f"❌ キュースキャン中にエラーが発生しました: {e}")
+        finally:
+            self.metrics.observe("koemoji_scan_duration_seconds", time.perf_counter() - scan_start)
+    
+    def _profile_subfolders(self):
+        """デコードプロファイルを割り当てた入力フォルダ直下のサブフォルダ名"""
+        return [folder for folder in self.config.get("decode_profile_folders", {}) if folder not in ("", ".")]
+    
+    def _create_queue(self):
+        """設定のスケジューリング方式でキューを作成"""
+        policy = self.config.get("scheduler_policy", "aging")
+        if policy not in FileQueue.POLICIES:
+            logger.warning(f"⚠️  不明なscheduler_policyです。agingを使用します: {policy}")
+            policy = "aging"
+        return FileQueue(policy, self.config.get("aging_weight", 1.0))
+    
+    def _create_metrics(self):
+        """メトリクスの定義"""
+        metrics = MetricsRegistry()
+        metrics.gauge("koemoji_queue_depth", "キューで待機中のファイル数")
+        metrics.gauge("koemoji_jobs_in_flight", "処理中のファイル数")
+        metrics.gauge("koemoji_models_loaded", "ロード済みのWhisperモデル数")
+        metrics.counter("koemoji_jobs_total", "終了したジョブ数（result: completed / draft / failed / cancelled）")
+        metrics.counter("koemoji_audio_seconds_total", "文字起こしした音声の長さ（秒）")
+        metrics.histogram("koemoji_rtf", "ファイルごとの実時間比（処理時間÷音声の長さ）",
+                          (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5))
+        metrics.histogram("koemoji_model_load_seconds", "Whisperモデルのロード時間（秒）",
+                          (1, 2, 5, 10, 20, 30, 60, 120))
+        metrics.histogram("koemoji_scan_duration_seconds", "入力フォルダのスキャン時間（秒）",
+                          (0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10))
+        metrics.gauge("koemoji_metrics_published_timestamp_seconds", "メトリクスを公開した時刻（UNIX時間）")
+        return metrics
+    
+    def publish_metrics(self):
+        """現在のメトリクスをmetrics_pathに書き出す（空なら公開しない）"""
+        path = self.config.get("metrics_path", "koemoji_metrics.prom")
+        if not path:
+            return False
+        with self._state_lock:
+            self.metrics.set("koemoji_queue_depth", len(self.processing_queue))
+            self.metrics.set("koemoji_jobs_in_flight", len(self.files_in_process))
+        self.metrics.set("koemoji_models_loaded", len(self._model_pool))
+        self.metrics.set("koemoji_metrics_published_timestamp_seconds", round(time.time(), 3))
+        try:
+            self.metrics.publish(path)
+            return True
+        except OSError as e:
+            logger.debug(f"メトリクスを書き出せませんでした: {e}")
+            return False
+    
+    def _relative_name(self, file_path):
+        """入力フォルダからの相対パス（入力フォルダの外のファイルはファイル名）
+        
+        出力・アーカイブでもサブフォルダを保ち、別のサブフォルダにある同名のファイルが上書きし合わないようにする。
+        """
+        try:
+            relpath = os.path.relpath(file_path, self.config.get("input_folder", "input"))
+        except ValueError:
+            # Windowsで入力フォルダと別のドライブ
+            return os.path.basename(file_path)
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep) or os.path.isabs(relpath):
+            return os.path.basename(file_path)
+        return relpath
+    
+    def _output_paths(self, file_path):
+        """(本番の出力ファイル, 下書きの出力ファイル)のパス"""
+        stem = os.path.splitext(self._relative_name(file_path))[0]
+        output_folder = self.config.get("output_folder", "output")
+        return os.path.join(output_folder, f"{stem}.txt"), os.path.join(output_folder, f"{stem}.draft.txt")
+    
+    def _initial_stage(self, file_path):
+        """キュー投入時の段階（draft_model設定時は下書きから。下書き済みなら本番から）"""
+        if not self.config.get("draft_model"):
+            return None
+        _, draft_file = self._output_paths(file_path)
+        return "final" if os.path.exists(draft_file) else "draft"
+    
+    def queue_file(self, file_path, redetected=False):
+        """1ファイルをキューに追加（追加した場合True）
+        
+        取り消したファイルは内容が変わるまで再投入しない。redetectedなら（監視で置き直しを検出した）
+        取り消しを解除して追加する。
+        """
+        file_name = os.path.basename(file_path)
+        
+        # 対象拡張子のファイルのみ処理
+        if not file_name.lower().endswith(MEDIA_EXTENSIONS):
+            return False
+        
+        # 既に処理中またはキュー済みのファイルはstatせずにスキップ
+        with self._state_lock:
+            if file_path in self.files_in_process or file_path in self.processing_queue:
+                return False
+        
+        # ディレクトリ・消えたファイルはスキップ
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        
+        # 規定回数失敗した（内容が変わっていない）ファイルは再投入しない
+        if self.job_store:
+            job = self.job_store.get(file_path)
+            if (job and job[0] == "failed" and job[2] == st.st_size and
+                    job[1] >= self.config.get("max_attempts", 3)):
+                logger.debug(f"失敗上限に達したためスキップ: {file_name}")
+                return False
+        
+        # 取り消したファイルはスキャンでは再投入しない
+        if redetected:
+            with self._state_lock:
+                self._cancelled.pop(file_path, None)
+        else:
+            with self._state_lock:
+                cancelled_size = self._cancelled.get(file_path)
+            if cancelled_size is None and self.job_store:
+                job = self.job_store.get(file_path)
+                if job and job[0] == "cancelled":
+                    cancelled_size = job[2]
+            if cancelled_size == st.st_size:
+                logger.debug(f"取り消し済みのためスキップ: {file_name}")
+                return False
+        
+        # 長さとコーデックはヘッダだけ読んで取得（スケジューリングに使う）
+        duration, codec = probe_media(file_path)
+        entry = QueueEntry(file_path, st.st_size, duration=duration, codec=codec,
+                           stage=self._initial_stage(file_path))
+        with self._state_lock:
+            if file_path in self.files_in_process:
+                return False
+            if not self.processing_queue.push(entry):
+                return False
+        
+        if self.job_store:
+            self.job_store.mark_queued(file_path, entry.size, entry.queued_at)
+        
+        if duration is not None:
+            logger.info(f"➕ キューに追加: {file_name} ({duration / 60:.1f}分, {codec or '不明'})")
+        else:
+            logger.info(f"➕ キューに追加: {file_name}")
+        return True
+    
+    def open_job_store(self):
+        """ジョブストアを開き、前回中断されたジョブをキューに復元"""
+        db_path = self.config.get("job_store_path", "koemoji_jobs.db")
+        try:
+            self.job_store = JobStore(db_path)
+            self.job_store.open()
+        except sqlite3.Error as e:
+            logger.error(f"❌ ジョブストアを開けませんでした。永続化なしで継続します: {e}")
+            self.job_store = None
+            return 0
+        
+        max_attempts = self.config.get("max_attempts", 3)
+        resumed = 0
+        for path, size, state, attempts, queued_at in self.job_store.pending_jobs():
+            if not os.path.exists(path):
+                self.job_store.mark_finished(path, "failed", "再開時にファイルが見つかりません")
+                continue
+            if state == "running" and attempts >= max_attempts:
+                logger.warning(f"⚠️  処理中の中断が繰り返されたため失敗扱いにします: {os.path.basename(path)}")
+                self.job_store.mark_finished(path, "failed", "処理中に繰り返し中断されました")
+                continue
+            duration, codec = probe_media(path)
+            with self._state_lock:
+                entry = QueueEntry(path, size, queued_at, duration, codec, self._initial_stage(path))
+                if self.processing_queue.push(entry):
+                    resumed += 1
+        
+        if resumed:
+            logger.info(f"♻️  前回のキューを復元しました: {resumed}件")
+        return resumed
+    
+    def close_job_store(self):
+        """ジョブストアを閉じる（未コミットの状態を書き込む）"""
+        if self.job_store is not None:
+            self.job_store.close()
+            self.job_store = None
+    
+    def _on_file_detected(self, file_path):
+        """監視スレッドからの通知：キューに追加してメインループを起こす"""
+        try:
+            if self.queue_file(file_path, redetected=True):
+                self._last_activity = time.time()
+                self.request_preload()
+                self._notify("file")
+        except Exception as e:
+            logger.error(f"❌ 検出ファイルの追加中にエラーが発生しました: {file_path} - {e}")
+    
+    def _on_watch_overflow(self):
+        """監視イベントの取りこぼし時は次のループで全体を再スキャン"""
+        self._notify("rescan")
+    
+    def _notify(self, reason):
+        """メインループを起こす（reason: file / job / rescan / config / model / control / shutdown）"""
+        with self._state_lock:
+            self._pending_events.add(reason)
+        self._wake_event.set()
+    
+    def _take_events(self):
+        """起床理由を取り出す（クリアしてから取り出すので、直後の通知も取りこぼさない）"""
+        self._wake_event.clear()
+        with self._state_lock:
+            events = self._pending_events
+            self._pending_events = set()
+        return events
+    
+    def request_shutdown(self):
+        """メインループに停止を要求（シグナルハンドラーから呼ぶ）"""
+        self._shutdown_requested = True
+        self._notify("shutdown")
+    
+    def start_watcher(self):
+        """入力フォルダの監視を開始（利用できない場合はポーリングのみ）"""
+        watch_mode = self.config.get("watch_mode", "auto")
+        if watch_mode == "poll":
+            logger.info("🔁 ポーリングモードで入力フォルダを監視します")
+            return False
+        if not InotifyWatcher.is_supported():
+            logger.info("🔁 inotifyが利用できないため、ポーリングモードで監視します")
+            return False
+        try:
+            self._watcher = InotifyWatcher(
+                self.config.get("input_folder"),
+                self._on_file_detected,
+                self._on_watch_overflow,
+                self._profile_subfolders()
+            )
+            self._watcher.start()
+            logger.info(f"👀 inotifyで入力フォルダを監視します: {self.config.get('input_folder')}")
+            return True
+        except OSError as e:
+            logger.warning(f"⚠️  フォルダ監視を開始できませんでした。ポーリングで継続します: {e}")
+            self._watcher = None
+            return False
+    
+    def stop_watcher(self):
+        """入力フォルダの監視を停止"""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+    
+    def _read_config_mtime(self):
+        """設定ファイルの更新時刻（なければNone）"""
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def _on_config_file_event(self, path):
+        """設定ファイルのあるフォルダの監視通知：設定ファイルなら再読み込みを要求"""
+        if os.path.abspath(path) == os.path.abspath(self.config_path):
+            self._notify("config")
+    
+    def start_config_watcher(self):
+        """設定ファイルの変更監視を開始（inotifyが使えなければ起床ごとの更新時刻の確認のみ）"""
+        if self.config.get("watch_mode", "auto") == "poll" or not InotifyWatcher.is_supported():
+            return False
+        try:
+            self._config_watcher = InotifyWatcher(
+                os.path.dirname(os.path.abspath(self.config_path)),
+                self._on_config_file_event,
+                lambda: self._notify("config")
+            )
+            self._config_watcher.start()
+            return True
+        except OSError as e:
+            logger.warning(f"⚠️  設定ファイルを監視できませんでした: {e}")
+            self._config_watcher = None
+            return False
+    
+    def stop_config_watcher(self):
+        """設定ファイルの変更監視を停止"""
+        if self._config_watcher is not None:
+            self._config_watcher.stop()
+            self._config_watcher = None
+    
+    def reload_config(self):
+        """設定ファイルを読み直して実行中のサービスに反映（読めない・不正な場合は現在の設定を維持）"""
+        self._config_mtime = self._read_config_mtime()
+        old_config = self.config
+        try:
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                self.config = json.load(f)
+            self.validate_config()
+        except Exception as e:
+            self.config = old_config
+            logger.warning(f"⚠️  設定ファイルを再読み込みできませんでした。現在の設定で継続します: {e}")
+            return False
+        
+        changed = sorted(key for key in set(old_config) | set(self.config)
+                         if old_config.get(key) != self.config.get(key))
+        if not changed:
+            return False
+        
+        for folder_key in ["input_folder", "output_folder", "archive_folder"]:
+            os.makedirs(self.config.get(folder_key), exist_ok=True)
+        
+        # スケジューリング方式が変わったらキューを作り直す（投入時刻は引き継ぐ）
+        if {"scheduler_policy", "aging_weight"} & set(changed):
+            with self._state_lock:
+                queue = self._create_queue()
+                for entry in self.processing_queue:
+                    queue.push(entry)
+                self.processing_queue = queue
+        
+        # ワーカー数が変わったら次のディスパッチでプールを作り直す（実行中のジョブはそのまま完了させる）
+        if "max_concurrent_files" in changed and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        
+        controller = self._controller
+        controller.min_free_bytes = self.config.get("min_free_memory_mb", 1024) * 1024 * 1024
+        controller.window_seconds = self.config.get("controller_window_seconds", 60)
+        
+        memory_budget_mb = self.config.get("model_pool_memory_mb", 0)
+        if memory_budget_mb:
+            self._model_pool.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self._model_pool.max_models = max(1, self.config.get("model_pool_size", 2))
+        
+        # 先読みの予算が変わったら次のディスパッチで作り直す
+        if {"prefetch_memory_mb", "prefetch_files"} & set(changed):
+            with self._state_lock:
+                prefetcher, self._prefetcher = self._prefetcher, None
+            if prefetcher is not None:
+                prefetcher.stop()
+        
+        # 監視対象のフォルダが変わったら監視をやり直して全体をスキャン
+        if {"input_folder", "decode_profile_folders", "watch_mode"} & set(changed):
+            self.stop_watcher()
+            self.start_watcher()
+            self._notify("rescan")
+        
+        logger.info(f"🔧 設定ファイルの変更を反映しました: {', '.join(changed)}")
+        return True
+    
+    def _next_wakeup(self, last_scan_time):
+        """次にメインループが自発的に起きるまでの秒数
+        
+        安全網の定期スキャン、アイドル時のモデル解放、CPU使用率が高くて延期したディスパッチの
+        再試行、ハートビートの更新のうち最も早いもの。それ以外はファイル検出・ジョブ完了・設定変更・停止の通知を待つ。
+        """
+        now = time.time()
+        deadlines = [last_scan_time + self.config.get("scan_interval_minutes", 30) * 60]
+        
+        idle_minutes = self.config.get("idle_unload_minutes", 30)
+        if idle_minutes and len(self._model_pool):
+            with self._state_lock:
+                busy = bool(self.files_in_process or self.processing_queue)
+            if not busy:
+                # 解放を見送った直後に空回りしないよう最低1秒は待つ
+                deadlines.append(max(self._last_activity + idle_minutes * 60, now + 1))
+        
+        if self._dispatch_retry_at is not None:
+            deadlines.append(self._dispatch_retry_at)
+        
+        heartbeat_seconds = self.config.get("heartbeat_seconds", 60)
+        if heartbeat_seconds:
+            deadlines.append(self._last_heartbeat + heartbeat_seconds)
+        return max(0, min(deadlines) - now)
     
     def process_queued_files(self):
-        """キューにあるファイルを処理"""
+        """キューにあるファイルをワーカーに割り当てる"""
+        self._dispatch_retry_at = None
         try:
             if not self.processing_queue:
                 logger.debug("処理すべきファイルはありません")
                 return
             
-            # 同時処理数を確認
-            max_concurrent = self.config.get("max_concurrent_files", 3)
-            current_running = len(self.files_in_process)
-            available_slots = max(0, max_concurrent - current_running)
-            
-            if available_slots <= 0:
-                logger.debug("同時処理数の上限に達しています")
+            # 制御APIで一時停止・ドレイン中は新しいジョブを開始しない
+            if self._paused or self._draining:
+                logger.debug("ディスパッチは停止中です")
                 return
             
-            # リソース使用状況を確認
-            cpu_percent = psutil.cpu_percent()
-            max_cpu = self.config.get("max_cpu_percent", 95)
+            with self._state_lock:
+                current_running = len(self.files_in_process)
+                running_finals = self._running_finals
+                queued = len(self.processing_queue)
+            
+            # リソース使用状況を時間窓で計測
+            controller = self._controller
+            controller.max_workers = max(1, self.config.get("max_concurrent_files", 3))
+            controller.max_cpu_percent = self.config.get("max_cpu_percent", 95)
+            controller.sample()
             
-            if cpu_percent > max_cpu:
-                logger.info(f"⏸️  CPU使用率が高すぎるため、処理を延期します: {cpu_percent}%")
+            # 自分のジョブがないのにCPUが埋まっている場合は他のプロセスに譲る
+            cpu_percent = controller.cpu_average()
+            if current_running == 0 and cpu_percent > controller.max_cpu_percent:
+                logger.info(f"⏸️  CPU使用率が高すぎるため、処理を延期します: {cpu_percent:.1f}%")
+                self._dispatch_retry_at = time.time() + self.config.get("cpu_retry_seconds", 5)
                 return
             
-            # 処理するファイル数を決定
-            files_to_process = self.processing_queue[:available_slots]
+            # 同時処理数を確認
+            limit = controller.update(current_running, queued)
+            available_slots = max(0, limit - current_running)
+            
+            # 本番の処理だけでスロットが埋まっている（同時実行数が1の場合など）ときは、
+            # 下書き用に1つ空けて新しいファイルの下書きを待たせない
+            drafts_only = False
+            if available_slots <= 0 and current_running and running_finals >= current_running:
+                available_slots = 1
+                drafts_only = True
+            
+            if available_slots <= 0:
+                logger.debug("同時処理数の上限に達しています")
+                return
             
             # Whisperモデルを取得
             model_size = self.config.get("whisper_model", "large")
             
-            # ファイルを処理
-            for file_info in files_to_process:
-                file_path = file_info["path"]
-                # キューから削除
-                self.processing_queue = [f for f in self.processing_queue if f["path"] != file_path]
-                
-                # 処理開始
-                self.process_file(file_path, model_size)
+            # 本番の処理は1スロットを下書き用に空けておき、新しいファイルの下書きを待たせない
+            final_limit = max(1, limit - 1)
+            
+            # 先頭から空きスロット分をワーカーに投入（完了を待たずに戻る）
+            executor = self._get_executor()
+            for _ in range(available_slots):
+                with self._state_lock:
+                    entry = self.processing_queue.first()
+                    if entry is None:
+                        break
+                    if entry.stage == "final" and self._running_finals >= final_limit:
+                        logger.debug("下書き用のスロットを確保するため本番の処理を待機します")
+                        break
+                    if drafts_only and entry.stage != "draft":
+                        break
+                    # キューから取り出し、投入時点で処理中として扱う（再スキャンでの二重投入を防ぐ）
+                    self.processing_queue.popleft()
+                    file_path = entry.path
+                    self.files_in_process.add(file_path)
+                    self._active_jobs[file_path] = {
+                        "stage": entry.stage, "started_at": None, "duration": entry.duration, "writer": None
+                    }
+                    if entry.stage == "final":
+                        self._running_finals += 1
+                future = executor.submit(self.process_file, file_path, model_size, entry.stage)
+                self._futures[file_path] = future
+                future.add_done_callback(lambda f, p=file_path, st=entry.stage: self._on_job_done(p, st, f))
         
         except Exception as e:
             logger.error(f"❌ キュー処理中にエラーが発生しました: {e}")
+        finally:
+            # 空きスロットがなくても、次に処理するファイルのデコードは進めておく
+            self._schedule_prefetch()
+    
+    def _schedule_prefetch(self):
+        """キューの先頭数件を先読みデコードの対象にする"""
+        prefetcher = self._get_prefetcher()
+        if prefetcher is None:
+            return
+        with self._state_lock:
+            upcoming = [
+                (entry.path, int(entry.estimated_duration * AudioPrefetcher.BYTES_PER_SECOND))
+                for entry in self.processing_queue.peek(self.config.get("prefetch_files", 2))
+            ]
+            in_process = set(self.files_in_process)
+        prefetcher.prefetch(upcoming, keep=in_process)
+    
+    def _get_prefetcher(self):
+        """先読みデコーダを取得（prefetch_memory_mbが0なら無効でNone）"""
+        memory_mb = self.config.get("prefetch_memory_mb", 512)
+        if not memory_mb or not self.config.get("prefetch_files", 2):
+            return None
+        with self._state_lock:
+            if self._prefetcher is None:
+                self._prefetcher = AudioPrefetcher(self._decode_audio, int(memory_mb * 1024 * 1024))
+            return self._prefetcher
+    
+    def _decode_audio(self, file_path):
+        """ファイルを16kHzモノラルfloat32にデコード"""
+        from faster_whisper import decode_audio
+        source = self._audio_source(file_path)
+        with timed_stage("decode"):
+            return decode_audio(source, sampling_rate=SAMPLE_RATE)
+    
+    def _audio_source(self, file_path):
+        """文字起こしに使う音声のパス（動画なら抜き出した音声トラック、それ以外はそのまま）"""
+        if (not file_path.lower().endswith(VIDEO_EXTENSIONS) or
+                not self.config.get("video_audio_extraction", True)):
+            return file_path
+        try:
+            with self._state_lock:
+                if self._audio_track_cache is None:
+                    self._audio_track_cache = AudioTrackCache(
+                        self.config.get("audio_cache_folder", "audio_cache"),
+                        self.config.get("audio_cache_max_mb", 1024) * 1024 * 1024
+                    )
+            with timed_stage("decode"):
+                audio_path = self._audio_track_cache.extract(file_path)
+        except ImportError:
+            return file_path
+        except Exception as e:
+            logger.warning(f"⚠️  動画から音声を抜き出せませんでした。動画をそのまま処理します: "
+                           f"{os.path.basename(file_path)} - {e}")
+            return file_path
+        return audio_path or file_path
+    
+    def _get_executor(self):
+        """文字起こしワーカープールを取得（未生成なら作成）"""
+        if self._executor is None:
+            max_workers = max(1, self.config.get("max_concurrent_files", 3))
+            # 本番の処理でスロットが埋まっても下書きを実行できるよう、下書き用のワーカーを1つ足す
+            draft_workers = 1 if self.config.get("draft_model") else 0
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers + draft_workers,
+                thread_name_prefix="koemoji-worker"
+            )
+            logger.info(f"👷 ワーカーを起動しました: {max_workers}並列"
+                        f"{' (+下書き用1)' if draft_workers else ''} "
+                        f"(モデルあたり{self._get_cpu_threads()}スレッド)")
+        return self._executor
+    
+    def _get_cpu_threads(self):
+        """ワーカー1つあたりのCPUスレッド数（物理コアをワーカー数で分割）"""
+        cpu_threads = self.config.get("cpu_threads", 0)
+        if cpu_threads:
+            return cpu_threads
+        return max(1, min(len(cpus) for cpus in self._get_cpu_allocation()))
+    
+    def _get_model_workers(self):
+        """モデルのワーカー（レプリカ）数。長時間ファイルのチャンクも並列に推論できるよう確保"""
+        return max(1, self.config.get("max_concurrent_files", 3), self._get_long_file_workers())
     
-    def process_file(self, file_path, model_size=None):
-        """ファイルを処理する"""
+    def _get_cpu_allocation(self):
+        """ワーカーごとに割り当てる論理CPUのリスト（トポロジは初回のみ検出）"""
+        if self._cpu_topology is None:
+            self._cpu_topology = detect_cpu_topology()
+        topology = self._cpu_topology
+        
+        # cpu_listを指定した場合はそのCPUだけを使う
+        cpu_list = set(self.config.get("cpu_list", []))
+        if cpu_list:
+            topology = {}
+            for node, cores in self._cpu_topology.items():
+                for core in cores:
+                    selected = [cpu for cpu in core if cpu in cpu_list]
+                    if selected:
+                        topology.setdefault(node, []).append(selected)
+        return plan_cpu_allocation(topology, self._get_model_workers(),
+                                   self.config.get("cpu_use_smt", False))
+    
+    def log_cpu_allocation(self):
+        """検出したCPUトポロジとワーカーへの割り当てをログに記録（起動時に1回）"""
+        allocation = self._get_cpu_allocation()
+        topology = self._cpu_topology
+        physical = sum(len(cores) for cores in topology.values())
+        logical = sum(len(core) for cores in topology.values() for core in cores)
+        groups = " ".join("[" + ",".join(map(str, cpus)) + "]" for cpus in allocation)
+        pinning = "固定あり" if self.config.get("cpu_pinning", True) and hasattr(os, "sched_setaffinity") else "固定なし"
+        logger.info(f"🧩 CPU: 物理コア{physical} / 論理CPU{logical} / NUMAノード{len(topology)} -> "
+                    f"ワーカー{len(allocation)} × {self._get_cpu_threads()}スレッド {groups} ({pinning})")
+    
+    def _on_job_done(self, file_path, stage=None, future=None):
+        """ジョブ完了時にメインループを起こして空きスロットを即座に埋める"""
+        with self._state_lock:
+            # 下書きは終了前に同じパスを本番として再投入するため、
+            # 先に投入された本番のジョブを消さないよう自分のジョブのときだけ外す
+            if future is None or self._futures.get(file_path) is future:
+                self._futures.pop(file_path, None)
+            if stage == "final":
+                self._running_finals -= 1
+        self._notify("job")
+    
+    def wait_for_jobs(self, timeout=None):
+        """実行中のジョブがすべて完了するまで待機（timeout内に完了すればTrue）"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._futures:
+            for future in list(self._futures.values()):
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                try:
+                    future.result(timeout=remaining)
+                except Exception:
+                    pass
+            if deadline is not None and time.time() >= deadline:
+                break
+        return all(future.done() for future in list(self._futures.values()))
+    
+    def shutdown_workers(self):
+        """未着手のジョブを取り消してワーカーを停止（実行中のジョブは完了させる）"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+    
+    def process_file(self, file_path, model_size=None, stage=None):
+        """ファイルを処理する
+        
+        stageが"draft"なら軽量モデル（draft_model）で下書き（.draft.txt）を出力し、
+        本番の処理を低い優先度でキューに戻す。"final"の出力は下書きを置き換える。
+        """
         start_time = time.time()
+        job_state = "failed"
+        job_error = None
+        is_draft = stage == "draft"
+        if is_draft:
+            model_size = self.config.get("draft_model") or "tiny"
+        
+        # 段階別の計測（profile_stagesで有効。cProfileはprofile_cprofile_seconds以上かかったジョブだけ保存）
+        timer = StageTimer() if self.config.get("profile_stages", False) else None
+        timer_token = timer.attach() if timer else None
+        profiler = None
+        if timer and self.config.get("profile_cprofile_seconds", 0):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # 他のプロファイラが動作中
+                profiler = None
         try:
             # ファイルが存在するか確認
             if not os.path.exists(file_path):
                 logger.warning(f"⚠️  ファイルが存在しません: {file_path}")
+                job_error = "ファイルが存在しません"
                 return
             
-            # 処理中リストに追加
-            self.files_in_process.add(file_path)
+            # 処理中リストに追加（RTFの記録用に同時実行数も控える）
+            with self._state_lock:
+                self.files_in_process.add(file_path)
+                concurrency = len(self.files_in_process)
+                job = self._active_jobs.setdefault(file_path, {"stage": stage, "duration": None, "writer": None})
+                job["started_at"] = start_time
+            self._raise_if_cancelled(file_path)
+            self._last_activity = time.time()
+            if self.job_store:
+                self.job_store.mark_running(file_path)
             file_name = os.path.basename(file_path)
-            logger.info(f"🔄 ファイル処理開始: {file_name} (モデル: {model_size})")
+            logger.info(f"🔄 ファイル処理開始: {file_name} (モデル: {model_size}, "
+                        f"プロファイル: {self._decode_profile_name(file_path)}{', 下書き' if is_draft else ''})")
             
-            # 文字起こし処理を実行
-            transcription = self.transcribe_audio(file_path, model_size)
+            # 出力ファイルパスを生成（サブフォルダのファイルは出力フォルダの同じサブフォルダに出力）
+            output_file, draft_file = self._output_paths(file_path)
+            if is_draft:
+                output_file = draft_file
             
-            if transcription:
-                # 出力ファイルパスを生成
-                output_folder = self.config.get("output_folder")
-                output_file = os.path.join(
-                    output_folder, 
-                    f"{os.path.splitext(file_name)[0]}.txt"
+            # 出力ディレクトリが存在するか確認
+            os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+            
+            # 文字起こしは一時ファイル（.part）に逐次書き込み、完了時に置き換える
+            # 前回中断時のチェックポイントがあればその位置から再開
+            checkpoint_key = None
+            if self.config.get("checkpoint", True) and not is_draft:
+                checkpoint_key = json.dumps(
+                    [os.path.getsize(file_path), self._transcription_params(model_size, file_path)],
+                    sort_keys=True, ensure_ascii=False
                 )
+            writer = TranscriptWriter(output_file, self.config.get("output_flush_seconds", 5), checkpoint_key)
+            job["writer"] = writer
+            if writer.resume_from:
+                logger.info(f"⏯️  チェックポイントから再開: {file_name} ({writer.resume_from:.1f}秒から)")
+            try:
+                # 同一内容・同一設定の文字起こしがキャッシュにあれば推論を省略
+                # （動画は先に音声トラックを抜き出し、大きなコンテナではなく音声をハッシュする）
+                with timed_stage("cache"):
+                    cache, cache_key = self._lookup_transcript_cache(file_path, model_size,
+                                                                     self._audio_source(file_path))
+                    cached = cache.get(cache_key) if cache_key else None
+                if cached is not None:
+                    hits, misses = cache.stats()
+                    logger.info(f"💾 キャッシュヒット: {file_name} (ヒット: {hits} / ミス: {misses})")
+                    with timed_stage("write"):
+                        # チェックポイントから再開した途中までの内容に全文を追記しないよう書き直す
+                        if writer.resume_from:
+                            writer.reset()
+                        writer.write(cached)
+                    succeeded = True
+                else:
+                    if cache_key:
+                        hits, misses = cache.stats()
+                        logger.info(f"💾 キャッシュミス: {file_name} (ヒット: {hits} / ミス: {misses})")
+                    
+                    # 文字起こし処理を実行
+                    result = self.transcribe_audio(file_path, model_size, writer=writer,
+                                                   start=writer.resume_from)
+                    if isinstance(result, str):
+                        with timed_stage("write"):
+                            writer.write(result)
+                    succeeded = result is not None
                 
-                # 出力ディレクトリが存在するか確認
-                os.makedirs(output_folder, exist_ok=True)
-                
-                # 結果を保存
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(transcription)
-                
+                succeeded = succeeded and writer.length > 0
+                if succeeded:
+                    with timed_stage("write"):
+                        writer.commit()
+                    if cached is None and cache_key:
+                        with timed_stage("cache"):
+                            cache.put_file(cache_key, output_file)
+            finally:
+                writer.discard()
+            
+            # 推論した音声の長さとRTFを記録（キャッシュヒットは推論していないので除外）
+            # 長さはキュー投入時に取得した値を使い、取得できていなかった場合だけ読み直す
+            duration = None
+            if succeeded and cached is None:
+                duration = job["duration"]
+                if duration is None:
+                    duration = job["duration"] = probe_duration(file_path)
+            if duration:
+                model_label = model_size or self.config.get("whisper_model", "large")
+                self.metrics.inc("koemoji_audio_seconds_total", duration, model=model_label)
+                self.metrics.observe("koemoji_rtf", (time.time() - start_time) / duration, model=model_label)
+            
+            if succeeded and is_draft:
+                # 下書きは入力を残したまま、本番の処理を後でキューに戻す（finallyで実施）
+                logger.info(f"📝 下書きを出力: {file_name} -> {output_file} "
+                            f"(処理時間: {time.time() - start_time:.2f}秒)")
+                job_state = "draft"
+            elif succeeded:
                 # 処理時間を計算
                 processing_time = time.time() - start_time
                 logger.info(f"✅ 文字起こし完了: {file_name} -> {output_file} (処理時間: {processing_time:.2f}秒)")
                 
-                # アーカイブフォルダに移動
-                archive_folder = self.config.get("archive_folder", "archive")
-                os.makedirs(archive_folder, exist_ok=True)
+                # 本番の出力ができたので下書きは不要
+                try:
+                    os.remove(draft_file)
+                except FileNotFoundError:
+                    pass
+                
+                # 実測RTFを同時実行数の調整に使う（キャッシュヒットは推論していないので除外）
+                if cached is None:
+                    rtf = self._controller.record_job(concurrency, duration, processing_time)
+                    if rtf is not None:
+                        logger.info(f"⏱️  RTF: {rtf:.3f} (同時実行数: {concurrency})")
                 
-                archive_path = os.path.join(archive_folder, file_name)
-                shutil.move(file_path, archive_path)
+                # アーカイブフォルダに移動（サブフォルダのファイルは同じサブフォルダに）
+                archive_folder = self.config.get("archive_folder", "archive")
+                archive_path = os.path.join(archive_folder, self._relative_name(file_path))
+                os.makedirs(os.path.dirname(archive_path) or ".", exist_ok=True)
+                with timed_stage("archive"):
+                    shutil.move(file_path, archive_path)
                 logger.info(f"📦 アーカイブ: {file_name} -> {archive_path}")
+                job_state = "done"
                 
                 # 通知
                 self.send_notification(
@@ -289,7 +2888,7 @@ class KoemojiProcessor:
                 )
             else:
                 logger.error(f"❌ 文字起こし失敗: {file_name}")
-                
+                job_error = "文字起こし失敗"
                 
                 # エラー通知
                 self.send_notification(
@@ -297,9 +2896,12 @@ class KoemojiProcessor:
                     f"ファイル: {file_name}\n処理に失敗しました。"
                 )
         
+        except JobCancelled:
+            logger.info(f"🛑 ジョブを取り消しました: {os.path.basename(file_path)}")
+            job_state = "cancelled"
         except Exception as e:
             logger.error(f"❌ ファイル処理中にエラーが発生しました: {file_path} - {e}")
-            
+            job_error = str(e)
             
             # エラー通知
             self.send_notification(
@@ -307,98 +2909,668 @@ class KoemojiProcessor:
                 f"ファイル: {os.path.basename(file_path)}\nエラー: {e}"
             )
         finally:
-            # 処理中リストから削除
-            if file_path in self.files_in_process:
-                self.files_in_process.remove(file_path)
+            # 下書きが済んだら本番の処理を後ろの段階としてキューに戻す
+            final_entry = None
+            if job_state == "draft":
+                try:
+                    duration = job["duration"]
+                    if duration is None:
+                        duration = probe_duration(file_path)
+                    final_entry = QueueEntry(file_path, os.path.getsize(file_path),
+                                             duration=duration, stage="final")
+                except OSError as e:
+                    job_state, job_error = "failed", str(e)
+            
+            # 処理中リストから削除（キャッシュヒットなどで使わなかった先読み音声も解放）
+            self._last_activity = time.time()
+            with self._state_lock:
+                self.files_in_process.discard(file_path)
+                self._active_jobs.pop(file_path, None)
+                if file_path in self._cancel_requested:
+                    self._cancel_requested.discard(file_path)
+                    if job_state == "cancelled":
+                        try:
+                            self._cancelled[file_path] = os.path.getsize(file_path)
+                        except OSError:
+                            pass
+                if final_entry is not None:
+                    self.processing_queue.push(final_entry)
+            if self._prefetcher is not None:
+                self._prefetcher.discard(file_path)
+            self.metrics.inc("koemoji_jobs_total", result={"done": "completed"}.get(job_state, job_state))
+            if self.job_store:
+                if final_entry is not None:
+                    # 下書きと本番は別のジョブとして試行回数を数える
+                    self.job_store.mark_finished(file_path, "done")
+                    self.job_store.mark_queued(file_path, final_entry.size, final_entry.queued_at)
+                else:
+                    self.job_store.mark_finished(file_path, job_state, job_error)
+            if timer is not None:
+                StageTimer.detach(timer_token)
+                self._record_profile(file_path, model_size, stage, job_state, timer, profiler)
+            if final_entry is not None:
+                self._notify("job")
+    
+    def _record_profile(self, file_path, model_size, stage, job_state, timer, profiler=None):
+        """段階別の所要時間をジョブの記録に保存（cProfileはしきい値以上かかった場合だけファイルに保存）"""
+        total = timer.elapsed()
+        file_name = os.path.basename(file_path)
+        profile = {
+            "file": file_name,
+            "model": model_size or self.config.get("whisper_model", "large"),
+            "stage": stage,
+            "state": job_state,
+            "total": round(total, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in timer.durations.items()},
+            # どの段階にも含まれない時間（特徴量抽出・トークナイズ・待ち時間など）
+            "other": round(max(0.0, total - sum(timer.durations.values())), 3)
+        }
+        
+        if profiler is not None:
+            profiler.disable()
+            if total >= self.config.get("profile_cprofile_seconds", 0):
+                folder = self.config.get("profile_folder", "profiles")
+                stats_path = os.path.join(folder, f"{os.path.splitext(file_name)[0]}-{int(time.time())}.prof")
+                try:
+                    os.makedirs(folder, exist_ok=True)
+                    profiler.dump_stats(stats_path)
+                    profile["cprofile"] = stats_path
+                except OSError as e:
+                    logger.warning(f"⚠️  cProfileの結果を保存できませんでした: {e}")
+        
+        summary = " / ".join(f"{name} {seconds:.2f}秒" for name, seconds in profile["stages"].items())
+        logger.info(f"⏱️  段階別の処理時間: {file_name} (合計 {total:.2f}秒: {summary or 'なし'})")
+        if self.job_store:
+            self.job_store.set_profile(file_path, json.dumps(profile, ensure_ascii=False, separators=(",", ":")))
+        return profile
+    
+    def _decode_profile_name(self, file_path=None):
+        """ファイルに適用するデコードプロファイル名
+        
+        decode_profile_patterns（ファイル名のパターン）→ decode_profile_folders（入力フォルダ直下の
+        サブフォルダ名）→ decode_profileの順に決める。
+        """
+        if file_path:
+            file_name = os.path.basename(file_path).lower()
+            for pattern, profile in self.config.get("decode_profile_patterns", {}).items():
+                if fnmatch.fnmatch(file_name, pattern.lower()):
+                    return profile
+            
+            input_folder = self.config.get("input_folder")
+            if input_folder:
+                folder = os.path.relpath(os.path.dirname(os.path.abspath(file_path)),
+                                         os.path.abspath(input_folder))
+                profile = self.config.get("decode_profile_folders", {}).get(folder)
+                if profile:
+                    return profile
+        return self.config.get("decode_profile", "balanced")
+    
+    def _decode_options(self, file_path=None):
+        """文字起こしのデコードオプション（ファイルに適用するプロファイルの内容）"""
+        profiles = dict(DEFAULT_DECODE_PROFILES)
+        profiles.update(self.config.get("decode_profiles", {}))
+        name = self._decode_profile_name(file_path)
+        if name not in profiles:
+            logger.warning(f"⚠️  不明なデコードプロファイルです。balancedを使用します: {name}")
+            name = "balanced"
+        return copy.deepcopy(profiles[name])
     
-    def transcribe_audio(self, file_path, model_size=None):
-        """音声ファイルを文字起こし"""
+    def _transcription_params(self, model_size=None, file_path=None):
+        """文字起こし結果を左右する設定（キャッシュ・チェックポイントの照合用）"""
+        params = {
+            "whisper_model": model_size or self.config.get("whisper_model", "large"),
+            "compute_type": self.config.get("compute_type", "int8"),
+            "language": self.config.get("language", "ja"),
+            "decode_options": self._decode_options(file_path)
+        }
+        if self.config.get("inference_mode", "sequential") == "batched":
+            params["inference_mode"] = "batched"
+            params["batch_size"] = self.config.get("batch_size", 8)
+        return params
+    
+    def _lookup_transcript_cache(self, file_path, model_size=None, audio_path=None):
+        """文字起こしキャッシュとこのファイルのキーを返す（無効時は(None, None)）
+        
+        audio_pathを渡すと（動画から抜き出した音声など）その内容をハッシュする。
+        """
+        if not self.config.get("transcript_cache", True):
+            return None, None
         try:
+            with self._state_lock:
+                if self._transcript_cache is None:
+                    self._transcript_cache = TranscriptCache(
+                        self.config.get("transcript_cache_folder", "transcript_cache"),
+                        self.config.get("transcript_cache_max_mb", 500) * 1024 * 1024
+                    )
+            params = self._transcription_params(model_size, file_path)
+            return self._transcript_cache, TranscriptCache.make_key(audio_path or file_path, params)
+        except OSError as e:
+            logger.warning(f"⚠️  文字起こしキャッシュを利用できません: {e}")
+            return None, None
+    
+    def _get_whisper_model(self, model_size=None):
+        """Whisperモデルをプールから取得（未ロードの組み合わせのみロード）"""
+        # モデルサイズとコンピュートタイプを設定
+        model_size = model_size or self.config.get("whisper_model", "large")
+        compute_type = self.config.get("compute_type", "int8")
+        
+        cpu_threads = self._get_cpu_threads()
+        num_workers = self._get_model_workers()
+        allocation = None
+        if self.config.get("cpu_pinning", True) and not self.config.get("cpu_threads", 0):
+            allocation = self._get_cpu_allocation()
+        
+        def load():
+            # faster_whisperのimportはロード時のみ（推論のたびには行わない）
             from faster_whisper import WhisperModel
+            start_time = time.perf_counter()
+            # モデル生成時に作られるワーカースレッドをそれぞれのコアに固定
+            model = pin_threads_created_by(
+                lambda: WhisperModel(
+                    model_size,
+                    compute_type=compute_type,
+                    cpu_threads=cpu_threads,
+                    num_workers=num_workers
+                ),
+                allocation
+            )
+            self.metrics.observe("koemoji_model_load_seconds", time.perf_counter() - start_time, model=model_size)
+            return model
+        
+        return self._model_pool.get((model_size, compute_type, cpu_threads, num_workers), load)
+    
+    def preload_model(self):
+        """設定中のモデル（下書き用があればそれも）を事前にロードし、1秒の無音を推論して初期化を済ませる"""
+        try:
+            import numpy as np
+            model_sizes = [self.config.get("draft_model"), self.config.get("whisper_model", "large")]
+            for model_size in [size for size in model_sizes if size]:
+                model = self._get_whisper_model(model_size)
+                start_time = time.time()
+                segments, _ = model.transcribe(
+                    np.zeros(SAMPLE_RATE, dtype=np.float32),
+                    language=self.config.get("language", "ja"),
+                    beam_size=1,
+                    vad_filter=False
+                )
+                for _ in segments:
+                    pass
+                logger.info(f"🔥 モデルのウォームアップ完了: {model_size} ({time.time() - start_time:.2f}秒)")
         except ImportError:
             logger.error("faster_whisperがインストールされていません。pip install faster-whisperを実行してください。")
-            return None
+        except Exception as e:
+            logger.warning(f"⚠️  モデルの事前ロードに失敗しました: {e}")
+        finally:
+            # ロード完了後のアイドル解放の期限を計算し直させる
+            self._notify("model")
+    
+    def request_preload(self):
+        """モデルが未ロードならバックグラウンドでロードを始める（ロード中・ロード済みなら何もしない）"""
+        if not self.config.get("preload_model", True) or len(self._model_pool):
+            return False
+        with self._state_lock:
+            if self._preload_thread is not None and self._preload_thread.is_alive():
+                return False
+            self._preload_thread = threading.Thread(target=self.preload_model, name="koemoji-preload", daemon=True)
+            self._preload_thread.start()
+        return True
+    
+    def unload_idle_models(self):
+        """idle_unload_minutes以上ジョブがなければモデルを解放する（解放した場合True）"""
+        idle_minutes = self.config.get("idle_unload_minutes", 30)
+        if not idle_minutes or not len(self._model_pool):
+            return False
+        with self._state_lock:
+            busy = bool(self.files_in_process or self.processing_queue)
+            preloading = self._preload_thread is not None and self._preload_thread.is_alive()
+        if busy or preloading or time.time() - self._last_activity < idle_minutes * 60:
+            return False
+        
+        rss_before = ModelPool._rss()
+        with self._model_lock:
+            self._batched_pipeline = None
+        count = self._model_pool.clear()
+        # モデルへの参照を回収してからヒープの空きをOSに返す
+        gc.collect()
+        trimmed = release_memory_to_os()
+        rss_after = ModelPool._rss()
+        logger.info(f"💤 {idle_minutes}分間ジョブがないためモデルを解放しました: {count}件, "
+                    f"常駐メモリ {rss_before / 1024 / 1024:.0f}MB -> {rss_after / 1024 / 1024:.0f}MB"
+                    f"{'' if trimmed else '（malloc_trim未対応）'}")
+        return True
+    
+    def _get_transcriber(self, model_size=None, file_path=None):
+        """推論モードに応じた文字起こしオブジェクトとデコードオプションを返す
+        
+        inference_modeがbatchedなら、キャッシュ済みモデルを包んだBatchedInferencePipelineで
+        複数の30秒窓をまとめてエンコード・デコードする。オプションはfile_pathに適用する
+        デコードプロファイルの内容。
+        """
+        model = self._get_whisper_model(model_size)
+        options = self._decode_options(file_path)
+        if self.config.get("inference_mode", "sequential") != "batched":
+            return model, options
         
         try:
-            # モデルサイズとコンピュートタイプを設定
-            model_size = model_size or self.config.get("whisper_model", "large")
-            compute_type = self.config.get("compute_type", "int8")
-            
-            # モデルが未ロードか設定が変わった場合のみ再ロード
-            if (self._whisper_model is None or 
-                self._model_config != (model_size, compute_type)):
-                logger.info(f"🧠 Whisperモデルをロード中: {model_size}")
-                self._whisper_model = WhisperModel(model_size, compute_type=compute_type)
-                self._model_config = (model_size, compute_type)
-            
-            # 文字起こし実行
-            segments, info = self._whisper_model.transcribe(
-                file_path,
-                language=self.config.get("language", "ja"),
-                beam_size=5,
-                best_of=5,
-                vad_filter=True
-            )
+            from faster_whisper import BatchedInferencePipeline
+        except ImportError:
+            logger.warning("⚠️  インストール済みのfaster-whisperはバッチ推論に対応していません（1.1.0以上が必要）。逐次推論で処理します")
+            return model, options
+        
+        with self._model_lock:
+            if self._batched_pipeline is None or self._batched_pipeline[0] is not model:
+                self._batched_pipeline = (model, BatchedInferencePipeline(model=model))
+            pipeline = self._batched_pipeline[1]
+        options["batch_size"] = self.config.get("batch_size", 8)
+        return pipeline, options
+    
+    def _get_long_file_workers(self):
+        """長時間ファイルのチャンクを並列処理するワーカー数"""
+        workers = self.config.get("long_file_workers", 0)
+        if workers:
+            return workers
+        return max(1, self.config.get("max_concurrent_files", 3))
+    
+    def _is_long_file(self, file_path, start=0.0, audio=None):
+        """長時間ファイルモードで処理すべきか判定（startは再開位置の秒数）
+        
+        デコード済みの音声を渡した場合はその長さで判定する。
+        """
+        if not self.config.get("long_file_mode", True):
+            return False
+        threshold = self.config.get("long_file_threshold_minutes", 20) * 60
+        if audio is not None and not isinstance(audio, str):
+            return len(audio) / SAMPLE_RATE >= threshold
+        duration = probe_duration(file_path)
+        return duration is not None and duration - start >= threshold
+    
+    def _add_silence_skipped(self, seconds):
+        """無音で推論を省いた秒数を加算（複数のワーカーから呼ばれる）"""
+        with self._state_lock:
+            self.silence_skipped_seconds += seconds
+    
+    def _skip_silence(self, file_path, audio, offset):
+        """無音の事前判定：前後の長い無音を切り落とす
+        
+        (音声, オフセット秒, 全体が無音ならTrue)を返す。デコードできない場合はそのまま返す。
+        """
+        if not self.config.get("silence_prepass", True):
+            return audio, offset, False
+        try:
+            if isinstance(audio, str):
+                audio = self._decode_audio(file_path)
+            with timed_stage("vad"):
+                bounds = detect_speech_bounds(audio, self.config.get("silence_threshold_db", -50))
+        except Exception as e:
+            logger.debug(f"無音の事前判定をスキップします: {os.path.basename(file_path)} - {e}")
+            return audio, offset, False
+        
+        file_name = os.path.basename(file_path)
+        if bounds is None:
+            skipped = len(audio) / SAMPLE_RATE
+            self._add_silence_skipped(skipped)
+            logger.info(f"🔇 無音のため文字起こしをスキップ: {file_name} ({skipped:.1f}秒)")
+            return audio[:0], offset, True
+        
+        # 短い無音はVADに任せ、min_silence_seconds以上の前後の無音だけを切る
+        min_samples = int(self.config.get("min_silence_seconds", 2) * SAMPLE_RATE)
+        start, end = bounds
+        if start < min_samples:
+            start = 0
+        if len(audio) - end < min_samples:
+            end = len(audio)
+        skipped = (start + len(audio) - end) / SAMPLE_RATE
+        if skipped > 0:
+            self._add_silence_skipped(skipped)
+            logger.info(f"🔇 前後の無音をスキップ: {file_name} "
+                        f"(先頭{start / SAMPLE_RATE:.1f}秒 / 末尾{(len(audio) - end) / SAMPLE_RATE:.1f}秒)")
+            audio = audio[start:end]
+            offset += start / SAMPLE_RATE
+        return audio, offset, False
+    
+    def transcribe_audio(self, file_path, model_size=None, writer=None, start=0.0):
+        """音声ファイルを文字起こし
+        
+        writerを渡すとセグメントを逐次書き込みTrueを返す（失敗時はNone）。
+        省略時は全文を結合した文字列を返す。startを指定するとその秒数から処理する。
+        """
+        try:
+            with timed_stage("model"):
+                transcriber, options = self._get_transcriber(model_size, file_path)
+            if StageTimer.current() is not None:
+                instrument_transcriber(transcriber)
+            
+            # 先読みデコード済みの音声があればそれを使う
+            audio, offset = self._audio_source(file_path), 0.0
+            if self._prefetcher is not None:
+                prefetched = self._prefetcher.take(file_path)
+                if prefetched is not None:
+                    audio = prefetched
+                    logger.debug(f"先読み済みの音声を使用: {os.path.basename(file_path)}")
+            if start > 0:
+                # チェックポイント以降の音声だけを処理し、時刻を補正する
+                # （clip_timestampsはvad_filterと併用できないため音声を切り出す）
+                if isinstance(audio, str):
+                    audio = self._decode_audio(file_path)
+                audio = audio[int(start * SAMPLE_RATE):]
+                offset = start
+            
+            # 無音だけのファイルは推論せずに目印だけを出力
+            audio, offset, silent = self._skip_silence(file_path, audio, offset)
+            if silent:
+                marker = self.config.get("silence_marker", "[無音]") if start <= 0 else ""
+                if writer is not None:
+                    if marker:
+                        writer.write(marker)
+                    return True
+                return marker
+            
+            if self._is_long_file(file_path, offset, audio):
+                segments = self._transcribe_long_file(transcriber, file_path, audio, offset, options)
+            else:
+                # 文字起こし実行
+                segments, info = transcriber.transcribe(
+                    audio,
+                    language=self.config.get("language", "ja"),
+                    **options
+                )
+                if offset:
+                    segments = (
+                        TranscriptSegment(segment.start + offset, segment.end + offset, segment.text)
+                        for segment in segments
+                    )
+            
+            if writer is not None:
+                # デコードされた順に書き出す（セグメントごとに取り消しを確認）
+                for segment in segments:
+                    self._raise_if_cancelled(file_path)
+                    with timed_stage("write"):
+                        writer.write_segment(segment.text, segment.end)
+                return True
             
             # セグメントをテキストに結合
             transcription = []
             for segment in segments:
+                self._raise_if_cancelled(file_path)
                 transcription.append(segment.text.strip())
             
             return "\n".join(transcription)
         
+        except JobCancelled:
+            raise
+        except ImportError:
+            logger.error("faster_whisperがインストールされていません。pip install faster-whisperを実行してください。")
+            return None
         except Exception as e:
             logger.error(f"❌ 文字起こし処理中にエラーが発生しました: {e}")
             return None
     
+    def _transcribe_long_file(self, model, file_path, audio=None, offset=0.0, options=None):
+        """長時間ファイルを無音で区切ったチャンクに分け、並列に文字起こしして順に結合
+        
+        audioにデコード済みの音声を渡した場合はそれを使い、時刻にoffsetを加える。
+        """
+        from faster_whisper.vad import VadOptions, get_speech_timestamps
+        
+        file_name = os.path.basename(file_path)
+        if audio is None or isinstance(audio, str):
+            audio = self._decode_audio(file_path)
+        base_offset = offset
+        with timed_stage("vad"):
+            speech = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=500))
+        target_samples = int(self.config.get("long_file_chunk_minutes", 5) * 60 * SAMPLE_RATE)
+        chunks = plan_chunks(speech, len(audio), target_samples)
+        
+        workers = min(self._get_long_file_workers(), len(chunks))
+        logger.info(f"✂️  長時間ファイルを{len(chunks)}チャンクに分割して{workers}並列で処理: "
+                    f"{file_name} ({len(audio) / SAMPLE_RATE / 60:.1f}分)")
+        
+        language = self.config.get("language", "ja")
+        decode_options = options if options is not None else self._decode_options(file_path)
+        timer = StageTimer.current()
+        
+        def transcribe_chunk(bounds):
+            start, end = bounds
+            offset = base_offset + start / SAMPLE_RATE
+            # チャンクのスレッドでの処理もジョブの段階別計測に含める
+            with timer.bind() if timer else nullcontext():
+                self._raise_if_cancelled(file_path)
+                segments, _ = model.transcribe(audio[start:end], language=language, **decode_options)
+                # チャンク内の時刻をファイル先頭からの時刻に補正
+                results = []
+                for segment in segments:
+                    self._raise_if_cancelled(file_path)
+                    results.append(TranscriptSegment(segment.start + offset, segment.end + offset, segment.text))
+                return results
+        
+        # 先頭のチャンクから完了し次第順に返す
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="koemoji-chunk") as executor:
+            for chunk_segments in executor.map(transcribe_chunk, chunks):
+                yield from chunk_segments
+    
+    def _raise_if_cancelled(self, file_path):
+        """制御APIで取り消されたジョブならJobCancelledを送出"""
+        if file_path in self._cancel_requested:
+            raise JobCancelled(file_path)
+    
+    def list_jobs(self, limit=None):
+        """キュー（取り出し順）と実行中のジョブの一覧（実行中は書き込み済みの位置から進捗を計算）
+        
+        limitを指定するとキューは先頭のlimit件だけを返す（queuedに全件数が入る）。
+        """
+        now = time.time()
+        with self._state_lock:
+            entries = self.processing_queue.peek(limit) if limit is not None else list(self.processing_queue)
+            queue = [
+                {
+                    "path": entry.path,
+                    "name": entry.name,
+                    "stage": entry.stage,
+                    "duration": entry.duration,
+                    "waiting": round(now - entry.queued_at, 1)
+                }
+                for entry in entries
+            ]
+            queued = len(self.processing_queue)
+            in_flight = []
+            for path in sorted(self.files_in_process):
+                job = self._active_jobs.get(path, {})
+                writer = job.get("writer")
+                position = writer.position if writer is not None else 0.0
+                duration = job.get("duration")
+                started_at = job.get("started_at")
+                in_flight.append({
+                    "path": path,
+                    "name": os.path.basename(path),
+                    "stage": job.get("stage"),
+                    "elapsed": round(now - started_at, 1) if started_at else None,
+                    "position": round(position, 1),
+                    "duration": duration,
+                    "progress": round(min(1.0, position / duration), 3) if duration else None,
+                    "cancelling": path in self._cancel_requested
+                })
+        return {"paused": self._paused, "draining": self._draining, "queued": queued,
+                "queue": queue, "in_flight": in_flight}
+    
+    def pause_dispatch(self):
+        """新しいジョブの開始を一時停止（実行中のジョブは続行）"""
+        if not self._paused:
+            self._paused = True
+            logger.info("⏸️  ディスパッチを一時停止しました")
+        self._notify("control")
+    
+    def resume_dispatch(self):
+        """一時停止・ドレインを解除してディスパッチを再開"""
+        if self._paused or self._draining:
+            self._paused = False
+            self._draining = False
+            logger.info("▶️  ディスパッチを再開しました")
+        self._notify("control")
+    
+    def prioritize_job(self, path):
+        """キュー内のファイルを先頭に移す（キューになければFalse）"""
+        with self._state_lock:
+            moved = self.processing_queue.prioritize(path)
+        if moved:
+            logger.info(f"⏫ 優先して処理します: {os.path.basename(path)}")
+            self._schedule_prefetch()
+            self._notify("control")
+        return moved
+    
+    def cancel_job(self, path):
+        """ジョブを取り消す
+        
+        キュー内なら取り除き"queued"、実行中なら次のセグメントの境界で中断させて"running"、
+        どちらでもなければNoneを返す。取り消したファイルは置き直すまで再投入しない。
+        """
+        with self._state_lock:
+            entry = self.processing_queue.get(path)
+            if entry is not None:
+                self.processing_queue.remove(path)
+                self._cancelled[path] = entry.size
+                result = "queued"
+            elif path in self.files_in_process:
+                self._cancel_requested.add(path)
+                result = "running"
+            else:
+                return None
+        
+        if result == "queued":
+            if self._prefetcher is not None:
+                self._prefetcher.discard(path)
+            if self.job_store:
+                self.job_store.mark_finished(path, "cancelled")
+            self.metrics.inc("koemoji_jobs_total", result="cancelled")
+            logger.info(f"🛑 キューから取り消しました: {os.path.basename(path)}")
+        else:
+            logger.info(f"🛑 処理中のジョブの取り消しを要求しました: {os.path.basename(path)}")
+        self._notify("control")
+        return result
+    
+    def drain(self):
+        """新しいジョブを開始せず、実行中のジョブの完了後に停止する（キューは次回の起動時に復元）"""
+        if not self._draining:
+            self._draining = True
+            with self._state_lock:
+                running = len(self.files_in_process)
+            logger.info(f"🚰 ドレインを開始しました。実行中のジョブ{running}件の完了後に停止します")
+        self._notify("control")
+    
+    def handle_control(self, request):
+        """制御コマンドを処理して応答を返す（ControlServerのスレッドから呼ばれる）"""
+        command = request.get("command")
+        path = request.get("path")
+        if command in ("list", "status"):
+            # キューが大きくても応答とロックの保持時間が増えないよう、既定では先頭だけを返す
+            limit = request.get("limit", CONTROL_LIST_LIMIT)
+            if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+                return {"ok": False, "error": f"limitは0以上の整数で指定してください: {limit}"}
+            return {"ok": True, **self.list_jobs(limit)}
+        if command == "pause":
+            self.pause_dispatch()
+            return {"ok": True, "paused": True}
+        if command == "resume":
+            self.resume_dispatch()
+            return {"ok": True, "paused": False}
+        if command == "drain":
+            self.drain()
+            with self._state_lock:
+                in_flight = len(self.files_in_process)
+            return {"ok": True, "draining": True, "in_flight": in_flight}
+        if command in ("prioritize", "cancel"):
+            if not isinstance(path, str) or not path:
+                return {"ok": False, "error": "pathを指定してください"}
+            if command == "prioritize":
+                if self.prioritize_job(path):
+                    return {"ok": True}
+                return {"ok": False, "error": f"キューにありません: {path}"}
+            state = self.cancel_job(path)
+            if state is None:
+                return {"ok": False, "error": f"キューにも処理中にもありません: {path}"}
+            return {"ok": True, "state": state}
+        return {"ok": False, "error": f"不明なコマンドです: {command}"}
+    
+    def start_control_server(self):
+        """制御APIのソケットを開く（control_socketが空、またはUnixドメインソケット非対応なら開かない）"""
+        path = self.config.get("control_socket", "koemoji.sock")
+        if not path:
+            return False
+        if not ControlServer.is_supported():
+            logger.info("ℹ️  この環境ではUnixドメインソケットが使えないため、制御APIは無効です")
+            return False
+        server = ControlServer(path, self.handle_control)
+        try:
+            server.start()
+        except OSError as e:
+            logger.warning(f"⚠️  制御ソケットを開けませんでした: {path} - {e}")
+            return False
+        self._control_server = server
+        logger.info(f"🎛️  制御ソケットで待ち受けます: {path}")
+        return True
+    
+    def stop_control_server(self):
+        if self._control_server is not None:
+            self._control_server.stop()
+            self._control_server = None
+    
     def send_notification(self, title, message):
         """通知をログに記録する"""
         logger.info(f"{title} - {message}")
     
     def is_already_running(self):
-        """既に実行中かチェック"""
-        current_pid = os.getpid()
-        
-        for proc in psutil.process_iter(['pid', 'cmdline']):
-            try:
-                if proc.pid == current_pid:
-                    continue
-                    
-                cmdline = proc.info.get('cmdline')
-                if cmdline and len(cmdline) > 1:
-                    # PythonまたはPython3プロセスであることを確認
-                    if 'python' in cmdline[0].lower() or 'python3' in cmdline[0].lower():
-                        # main.pyを実行しているかチェック
-                        for arg in cmdline[1:]:
-                            if arg.endswith('main.py'):
-                                logger.debug(f"既存のプロセスを検出: PID={proc.pid}")
-                                return True
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-        
+        """既に実行中かチェック（PIDファイルを読むだけでプロセス一覧は走査しない）"""
+        pid = InstanceLock.running_pid(self.config.get("pid_file", "koemoji.pid"))
+        if pid is not None and pid != os.getpid():
+            logger.debug(f"既存のプロセスを検出: PID={pid}")
+            return True
         return False
     
+    def publish_heartbeat(self, state="running"):
+        """生存確認用のハートビートをheartbeat_pathに書き出す（空なら書き出さない）"""
+        path = self.config.get("heartbeat_path", "koemoji_heartbeat.json")
+        self._last_heartbeat = time.time()
+        if not path:
+            return False
+        with self._state_lock:
+            heartbeat = {
+                "pid": os.getpid(),
+                "state": state,
+                "updated_at": round(self._last_heartbeat, 3),
+                "interval": self.config.get("heartbeat_seconds", 60),
+                "queue": len(self.processing_queue),
+                "in_flight": len(self.files_in_process),
+                "paused": self._paused,
+                "draining": self._draining
+            }
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(heartbeat, f)
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            logger.debug(f"ハートビートを書き出せませんでした: {e}")
+            return False
+    
     
     def run(self):
         """メイン処理ループ"""
+        # 単一インスタンスのロックを取得（別のプロセスが保持していれば即座に終了）
+        try:
+            locked = self._instance_lock.acquire()
+        except OSError as e:
+            logger.warning(f"PIDファイルの作成に失敗しました: {e}")
+            locked = True
+        if not locked:
+            pid = InstanceLock.running_pid(self._instance_lock.path)
+            logger.error(f"⚠️  既に別のKoemojiAutoプロセスが実行中です。{f' (PID: {pid})' if pid else ''}")
+            self.send_notification(
+                "⚠️  KoemojiAutoエラー",
+                "既に別のプロセスが実行中です。"
+            )
+            return
+        
         try:
-            # Windows用PIDファイル作成
-            if IS_WINDOWS:
-                try:
-                    with open('koemoji.pid', 'w') as f:
-                        f.write(str(os.getpid()))
-                except Exception as e:
-                    logger.warning(f"PIDファイルの作成に失敗しました: {e}")
-            
-            # 既に実行中かチェック
-            if self.is_already_running():
-                logger.error("⚠️  既に別のKoemojiAutoプロセスが実行中です。")
-                self.send_notification(
-                    "⚠️  KoemojiAutoエラー",
-                    "既に別のプロセスが実行中です。"
-                )
-                return
-            
             logger.info("🚀 KoemojiAuto処理を開始しました")
             
             # 開始通知
@@ -410,41 +3582,98 @@ class KoemojiProcessor:
             # 24時間連続モードで動作
             logger.info("♾️  24時間連続モードで動作します")
             
-            scan_interval = self.config.get("scan_interval_minutes", 30) * 60  # 秒に変換
-            last_scan_time = 0
+            # 物理コアのワーカーへの割り当てを記録（固定はモデルのロード時に行う）
+            self.log_cpu_allocation()
+            
+            # 前回中断されたジョブを復元（直後のスキャンは停止中に置かれたファイルの追加のみ）
+            self.open_job_store()
+            
+            # モデルをバックグラウンドで事前ロード（最初のジョブはロード完了を待つ）
+            self.request_preload()
+            
+            # 監視を先に開始し、初回スキャンとの間に置かれたファイルも取りこぼさない
+            # （監視中の定期スキャンは取りこぼし対策の安全網）
+            self.start_watcher()
+            
+            # 設定ファイルの変更を監視（反映は次の起床時。起動処理中の変更もここで拾う）
+            self.start_config_watcher()
+            if self._read_config_mtime() != self._config_mtime:
+                self._notify("config")
             
             # 初回スキャン
             self.scan_and_queue_files()
-            self.process_queued_files()
+            last_scan_time = time.time()
             
-            # メインループ（24時間動作）
-            while True:
-                current_time = time.time()
+            # webuiなどからの操作を受け付ける制御ソケット
+            self.start_control_server()
+            
+            # メインループ（24時間動作）：ファイル検出・ジョブ完了・設定変更・停止の通知で起き、
+            # それ以外は安全網の定期スキャンなどの期限まで待機する
+            while not self._shutdown_requested:
+                # キューのファイルを処理
+                self.process_queued_files()
                 
+                # ドレイン中は実行中のジョブがなくなったら停止
+                with self._state_lock:
+                    drained = self._draining and not self.files_in_process
+                if drained:
+                    logger.info("🚰 ドレインが完了しました")
+                    self.request_shutdown()
+                    break
                 
+                # しばらくジョブがなければモデルを解放（次のファイルの検出時に再ロード）
+                self.unload_idle_models()
                 
-                # 定期的にファイルをスキャン
-                if current_time - last_scan_time >= scan_interval:
-                    self.scan_and_queue_files()
-                    last_scan_time = current_time
+                # 起床ごとにメトリクスとハートビートを公開（待機中はheartbeat_secondsごとのハートビートのみ）
+                self.publish_metrics()
+                self.publish_heartbeat()
                 
-                # キューのファイルを処理
-                self.process_queued_files()
+                self._wake_event.wait(self._next_wakeup(last_scan_time))
+                events = self._take_events()
+                if self._shutdown_requested:
+                    break
+                
+                # 設定ファイルの変更を反映（inotifyが使えない場合は更新時刻で検出）
+                if "config" in events or (self._config_watcher is None and
+                                          self._read_config_mtime() != self._config_mtime):
+                    self.reload_config()
                 
-                # 短い待機
-                time.sleep(5)
+                # 定期的にファイルをスキャン（監視イベント溢れ時は即時）
+                current_time = time.time()
+                scan_interval = self.config.get("scan_interval_minutes", 30) * 60  # 秒に変換
+                if "rescan" in events or current_time - last_scan_time >= scan_interval:
+                    self.scan_and_queue_files()
+                    last_scan_time = current_time
+            
+            logger.info("📛 停止要求を受け付けました。実行中のジョブの完了を待って終了します")
             
         except KeyboardInterrupt:
             logger.info("📛 停止シグナルを受信しました")
         except Exception as e:
             logger.error(f"❌ 処理中にエラーが発生しました: {e}")
         finally:
-            # Windows用PIDファイル削除
-            if IS_WINDOWS and os.path.exists('koemoji.pid'):
-                try:
-                    os.remove('koemoji.pid')
-                except Exception as e:
-                    logger.warning(f"PIDファイルの削除に失敗しました: {e}")
+            # 制御ソケット・監視を停止し、未着手のジョブを取り消し
+            self.stop_control_server()
+            self.stop_watcher()
+            self.stop_config_watcher()
+            self.shutdown_workers()
+            
+            # 実行中のジョブの完了を待ってからジョブストア・ハートビート・ロックを閉じる
+            # （先に閉じるとジョブの結果が記録されず、終了前に別のインスタンスが起動できてしまう）
+            try:
+                finished = self.wait_for_jobs(self.config.get("shutdown_timeout_seconds") or None)
+            except SystemExit:
+                # 2回目のシグナルでは待たない
+                finished = False
+            if not finished:
+                logger.warning("⚠️  完了していないジョブがあります。次回の起動時に再開します")
+            self.close_job_store()
+            self.publish_metrics()
+            self.publish_heartbeat("stopped")
+            
+            # ロックを外してPIDファイルを削除（ジョブが残っていればプロセスの終了時にOSが外す）
+            if finished:
+                self._instance_lock.release()
             
             logger.info("👋 KoemojiAutoを終了しました")
 
@@ -456,7 +3685,10 @@ if __name__ == "__main__":
     # シグナルハンドラーの設定
     def signal_handler(sig, frame):
         logger.info("📛 停止シグナルを受信しました")
-        sys.exit(0)
+        # 2回目のシグナルでは待たずに終了
+        if processor._shutdown_requested:
+            sys.exit(0)
+        processor.request_shutdown()
     
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
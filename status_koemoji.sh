@@ -1,10 +1,21 @@
 #!/bin/bash
+cd "$(dirname "$0")"
 
 echo "KoemojiAuto Status"
 echo "=================="
 
-# より正確なプロセス検出（python3も含む）
-PIDS=$(ps aux | grep -E "[Pp]ython[3]*.*main\.py$" | grep -v grep | awk '{print $2}')
+# PIDファイル（実行中はKoemojiAutoがロックして保持）から確認し、プロセス一覧は走査しない
+# （設定のpid_fileを使い、PIDの再利用と区別するためプロセスの開始時刻も照合する）
+PIDS=$(python3 -c '
+import json
+from main import InstanceLock
+try:
+    with open("config.json", encoding="utf-8") as f:
+        pid_file = json.load(f).get("pid_file", "koemoji.pid")
+except (OSError, ValueError, AttributeError):
+    pid_file = "koemoji.pid"
+print(InstanceLock.running_pid(pid_file) or "")
+' 2>/dev/null)
 
 if [ -n "$PIDS" ]; then
     echo "Status: Running"
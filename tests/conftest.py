@@ -0,0 +1,13 @@
+"""pytestの共通設定"""
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    """各テストを一時ディレクトリで実行する
+    
+    設定ファイルなしで作ったKoemojiProcessorは既定の相対パス（output/、transcript_cache/、
+    koemoji_jobs.dbなど）に書き込むため、リポジトリ直下を汚さず、テスト間で
+    文字起こしキャッシュが共有されないようにする。
+    """
+    monkeypatch.chdir(tmp_path)
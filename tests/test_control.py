@@ -0,0 +1,219 @@
+"""制御API（キューの一覧・一時停止・優先・取り消し・ドレイン）のテスト"""
+import os
+import json
+import time
+import socket
+import threading
+import tempfile
+import pytest
+from unittest.mock import patch, MagicMock
+from main import KoemojiProcessor, ControlServer, FileQueue, QueueEntry
+
+
+def write_config(temp_dir, **overrides):
+    config_path = os.path.join(temp_dir, "config.json")
+    config = {
+        "input_folder": os.path.join(temp_dir, "input"),
+        "output_folder": os.path.join(temp_dir, "output"),
+        "archive_folder": os.path.join(temp_dir, "archive"),
+        "job_store_path": os.path.join(temp_dir, "jobs.db"),
+        "metrics_path": os.path.join(temp_dir, "metrics.prom"),
+        "pid_file": os.path.join(temp_dir, "koemoji.pid"),
+        "heartbeat_path": os.path.join(temp_dir, "heartbeat.json"),
+        "control_socket": os.path.join(temp_dir, "koemoji.sock"),
+        "whisper_model": "tiny",
+        "language": "ja",
+        "max_concurrent_files": 1,
+        "preload_model": False,
+        "long_file_mode": False,
+        "silence_prepass": False,
+        "transcript_cache": False,
+        "prefetch_memory_mb": 0
+    }
+    config.update(overrides)
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    return config_path
+
+
+def make_input(processor, name):
+    path = os.path.join(processor.config["input_folder"], name)
+    with open(path, 'w') as f:
+        f.write("dummy content")
+    return path
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestControl:
+    def test_prioritize_moves_entry_to_front(self):
+        """優先したエントリが方式にかかわらず先頭になり、後から優先したものほど先になるテスト"""
+        queue = FileQueue("sjf")
+        queue.push(QueueEntry("/path/short.mp3", duration=10))
+        queue.push(QueueEntry("/path/long.mp3", duration=600))
+        queue.push(QueueEntry("/path/final.mp3", duration=5, stage="final"))
+
+        assert queue.prioritize("/path/long.mp3")
+        assert queue.prioritize("/path/final.mp3")
+        assert [entry.name for entry in queue] == ["final.mp3", "long.mp3", "short.mp3"]
+        assert not queue.prioritize("/path/missing.mp3")
+
+        assert queue.popleft().name == "final.mp3"
+        assert len(queue) == 2
+
+    def test_cancel_queued_job(self):
+        """キュー内のジョブを取り消すと、スキャンでは再投入せず置き直せば追加されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            path = make_input(processor, "a.mp3")
+            processor.open_job_store()
+            try:
+                assert processor.queue_file(path)
+                assert processor.cancel_job(path) == "queued"
+                assert path not in processor.processing_queue
+                assert processor.cancel_job(path) is None
+
+                # 再起動後も取り消しは残る（ジョブストアから判定）
+                processor._cancelled.clear()
+                assert processor.job_store.get(path)[0] == "cancelled"
+                assert not processor.queue_file(path)
+
+                # 監視で置き直しを検出した場合は追加する
+                assert processor.queue_file(path, redetected=True)
+            finally:
+                processor.close_job_store()
+
+    def test_cancel_running_job(self):
+        """実行中のジョブの進捗が一覧に出て、取り消すと次のセグメントで中断されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            path = make_input(processor, "a.mp3")
+            observed = []
+
+            def segments():
+                yield MagicMock(text="最初のセグメント", start=0.0, end=15.0)
+                observed.append(processor.list_jobs())
+                observed.append(processor.cancel_job(path))
+                yield MagicMock(text="次のセグメント", start=15.0, end=30.0)
+                observed.append("取り消されずに続行")
+
+            mock_model = MagicMock()
+            mock_model.transcribe.return_value = (segments(), MagicMock())
+            try:
+                with patch("main.probe_media", return_value=(60.0, "mp3")), \
+                     patch.object(processor._controller, "cpu_average", return_value=0.0), \
+                     patch.object(processor, "_get_whisper_model", return_value=mock_model), \
+                     patch.object(processor, "send_notification"):
+                    assert processor.queue_file(path)
+                    processor.process_queued_files()
+                    processor.wait_for_jobs(timeout=5)
+            finally:
+                processor.shutdown_workers()
+
+            listing, state = observed
+            assert state == "running"
+            job = listing["in_flight"][0]
+            assert job["path"] == path and job["position"] == 15.0 and job["progress"] == 0.25
+            assert listing["queue"] == []
+
+            # 出力も.partも残らず、入力はアーカイブされずに残る
+            output_file = os.path.join(processor.config["output_folder"], "a.txt")
+            assert not os.path.exists(output_file) and not os.path.exists(output_file + ".part")
+            assert os.path.exists(path)
+            assert processor.files_in_process == set() and processor._active_jobs == {}
+            assert processor.metrics.get("koemoji_jobs_total", result="cancelled") == 1
+            assert not processor.queue_file(path)
+
+    def test_pause_and_drain(self):
+        """一時停止中はディスパッチせず、ドレインで実行中のジョブの完了後にメインループが終了するテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            make_input(processor, "a.mp3")
+            make_input(processor, "b.mp3")
+            started = []
+            release = threading.Event()
+
+            def process_file(path, *args):
+                started.append(path)
+                release.wait(5)
+                with processor._state_lock:
+                    processor.files_in_process.discard(path)
+
+            processor.pause_dispatch()
+            with patch.object(processor, "process_file", side_effect=process_file), \
+                 patch.object(processor._controller, "cpu_average", return_value=0.0), \
+                 patch.object(processor, "send_notification"):
+                thread = threading.Thread(target=processor.run, daemon=True)
+                thread.start()
+                assert wait_until(lambda: len(processor.processing_queue) == 2)
+                time.sleep(0.1)
+                assert started == []
+
+                processor.resume_dispatch()
+                assert wait_until(lambda: len(started) == 1)
+                processor.drain()
+                time.sleep(0.1)
+                # 実行中のジョブが終わるまでは停止しない
+                assert thread.is_alive()
+                release.set()
+                thread.join(5)
+                assert not thread.is_alive()
+
+            # 残りのファイルは次回の起動時に復元される
+            assert len(started) == 1
+            with open(processor.config["heartbeat_path"]) as f:
+                assert json.load(f)["state"] == "stopped"
+
+    @pytest.mark.skipif(not ControlServer.is_supported(), reason="Unixドメインソケットが必要")
+    def test_socket_round_trip_and_webui(self):
+        """制御ソケット経由でwebuiからキューの一覧・優先・停止（ドレイン）を操作できるテスト"""
+        import webui
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            first = make_input(processor, "a.mp3")
+            second = make_input(processor, "b.mp3")
+            processor.pause_dispatch()
+            assert processor.queue_file(first) and processor.queue_file(second)
+            assert processor.start_control_server()
+            try:
+                assert oct(os.stat(processor.config["control_socket"]).st_mode & 0o777) == "0o600"
+                client = webui.app.test_client()
+                with patch.object(webui, "load_config", return_value=processor.config), \
+                     patch("subprocess.run", side_effect=AssertionError("スクリプトを起動しない")):
+                    listing = client.get("/queue").get_json()
+                    assert listing["paused"] and [job["name"] for job in listing["queue"]] == ["a.mp3", "b.mp3"]
+                    
+                    # 先頭だけを返し、全件数はqueuedで返す
+                    listing = client.get("/queue?limit=1").get_json()
+                    assert [job["name"] for job in listing["queue"]] == ["a.mp3"] and listing["queued"] == 2
+
+                    response = client.post("/queue/prioritize", json={"path": second})
+                    assert response.status_code == 200
+                    assert processor.processing_queue.first().path == second
+                    assert client.post("/queue/cancel", json={"path": "/path/missing.mp3"}).status_code == 400
+                    assert client.post("/queue/unknown").status_code == 404
+
+                    assert client.post("/stop").get_json() == {"status": "draining", "in_flight": 0}
+                    assert processor._draining
+
+                # 不正なリクエストにはエラーを返す
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(processor.config["control_socket"])
+                    sock.sendall(b"not json\n")
+                    assert json.loads(sock.makefile('rb').readline())["ok"] is False
+                assert processor.handle_control({"command": "list", "limit": "all"})["ok"] is False
+                assert len(processor.handle_control({"command": "list", "limit": None})["queue"]) == 2
+            finally:
+                processor.stop_control_server()
+
+            assert not os.path.exists(processor.config["control_socket"])
+            # 接続できなければwebuiは503を返す
+            with patch.object(webui, "load_config", return_value=processor.config):
+                assert webui.app.test_client().get("/queue").status_code == 503
@@ -0,0 +1,205 @@
+"""イベント駆動のメインループのテスト"""
+import os
+import json
+import time
+import threading
+import tempfile
+import pytest
+from unittest.mock import patch
+from main import KoemojiProcessor, InotifyWatcher, QueueEntry
+
+
+def write_config(temp_dir, **overrides):
+    config_path = os.path.join(temp_dir, "config.json")
+    config = {
+        "input_folder": os.path.join(temp_dir, "input"),
+        "output_folder": os.path.join(temp_dir, "output"),
+        "archive_folder": os.path.join(temp_dir, "archive"),
+        "job_store_path": os.path.join(temp_dir, "jobs.db"),
+        "metrics_path": os.path.join(temp_dir, "metrics.prom"),
+        "pid_file": os.path.join(temp_dir, "koemoji.pid"),
+        "heartbeat_path": os.path.join(temp_dir, "heartbeat.json"),
+        "whisper_model": "tiny",
+        "language": "ja",
+        "max_concurrent_files": 1,
+        "preload_model": False
+    }
+    config.update(overrides)
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    return config_path
+
+
+def start_loop(processor):
+    """メインループを別スレッドで起動"""
+    thread = threading.Thread(target=processor.run, daemon=True)
+    thread.start()
+    # 初回スキャンまで待つ
+    deadline = time.time() + 5
+    while processor.job_store is None and time.time() < deadline:
+        time.sleep(0.01)
+    return thread
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestEventLoop:
+    def test_dispatch_on_job_done_and_shutdown(self):
+        """ジョブ完了の通知で待たずに次のファイルを投入し、停止要求で即座に終了するテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            for name in ("a.mp3", "b.mp3", "c.mp3"):
+                with open(os.path.join(temp_dir, "input", name), 'w') as f:
+                    f.write("dummy content")
+            
+            finished = []
+            
+            def process_file(path, *args):
+                time.sleep(0.05)
+                finished.append(path)
+                with processor._state_lock:
+                    processor.files_in_process.discard(path)
+            
+            with patch.object(processor, "process_file", side_effect=process_file), \
+                 patch.object(processor._controller, "cpu_average", return_value=0.0), \
+                 patch.object(processor, "send_notification"):
+                start = time.time()
+                thread = start_loop(processor)
+                # 1並列でも完了ごとに即座に次を投入する（以前の5秒待機なし）
+                assert wait_until(lambda: len(finished) == 3)
+                assert time.time() - start < 3
+                
+                # 何もなければ次の起床は安全網のスキャンかハートビートの更新まで
+                assert processor._next_wakeup(time.time()) > 30
+                
+                processor.request_shutdown()
+                thread.join(timeout=5)
+                assert not thread.is_alive()
+    
+    @pytest.mark.skipif(not InotifyWatcher.is_supported(), reason="inotifyはLinux専用")
+    def test_config_change_is_applied(self):
+        """設定ファイルの書き換えでメインループが起き、再起動なしで反映されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = write_config(temp_dir)
+            processor = KoemojiProcessor(config_path)
+            with patch.object(processor, "send_notification"):
+                thread = start_loop(processor)
+                try:
+                    assert processor.processing_queue.policy == "aging"
+                    assert wait_until(lambda: processor._config_watcher is not None)
+                    write_config(temp_dir, scheduler_policy="sjf", max_concurrent_files=2)
+                    assert wait_until(lambda: processor.config.get("scheduler_policy") == "sjf")
+                    assert wait_until(lambda: processor.processing_queue.policy == "sjf")
+                    assert processor.config["max_concurrent_files"] == 2
+                finally:
+                    processor.request_shutdown()
+                    thread.join(timeout=5)
+    
+    def test_reload_config_keeps_current_on_error(self):
+        """書きかけ・必須項目不足の設定ファイルでは現在の設定を維持するテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = write_config(temp_dir)
+            processor = KoemojiProcessor(config_path)
+            
+            with open(config_path, 'w') as f:
+                f.write('{"input_folder": ')
+            assert not processor.reload_config()
+            assert processor.config["whisper_model"] == "tiny"
+            
+            with open(config_path, 'w') as f:
+                json.dump({"input_folder": os.path.join(temp_dir, "input")}, f)
+            assert not processor.reload_config()
+            assert processor.config["whisper_model"] == "tiny"
+            
+            # 変更がなければ何もしない、変更があれば反映
+            write_config(temp_dir)
+            assert not processor.reload_config()
+            write_config(temp_dir, whisper_model="base")
+            assert processor.reload_config()
+            assert processor.config["whisper_model"] == "base"
+    
+    def test_shutdown_waits_for_running_jobs(self):
+        """停止要求後も実行中のジョブの完了を待ち、結果を記録してからロックを外すテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            path = os.path.join(temp_dir, "input", "a.mp3")
+            with open(path, 'w') as f:
+                f.write("dummy content")
+            
+            started = threading.Event()
+            release = threading.Event()
+            
+            def process_file(file_path, *args):
+                started.set()
+                release.wait(5)
+                processor.job_store.mark_finished(file_path, "done")
+                with processor._state_lock:
+                    processor.files_in_process.discard(file_path)
+            
+            with patch.object(processor, "process_file", side_effect=process_file), \
+                 patch.object(processor._controller, "cpu_average", return_value=0.0), \
+                 patch.object(processor, "send_notification"):
+                thread = start_loop(processor)
+                assert started.wait(5)
+                processor.request_shutdown()
+                time.sleep(0.2)
+                # ジョブの実行中は終了せず、PIDファイルも残す
+                assert thread.is_alive()
+                assert os.path.exists(processor.config["pid_file"])
+                
+                release.set()
+                thread.join(timeout=5)
+                assert not thread.is_alive()
+            
+            assert not os.path.exists(processor.config["pid_file"])
+            processor.open_job_store()
+            try:
+                assert processor.job_store.get(path) is None
+            finally:
+                processor.close_job_store()
+    
+    def test_draft_done_keeps_requeued_final(self):
+        """下書きの完了通知が、先に投入された同じファイルの本番のジョブを待機対象から外さないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir, draft_model="tiny"))
+            path = os.path.join(temp_dir, "input", "a.mp3")
+            requeued = threading.Event()
+            dispatched = threading.Event()
+            release = threading.Event()
+            
+            def process_file(file_path, model_size=None, stage=None):
+                with processor._state_lock:
+                    processor.files_in_process.discard(file_path)
+                if stage == "draft":
+                    # 本番を再投入してから戻るまでの間に、メインループが本番を投入する
+                    with processor._state_lock:
+                        processor.processing_queue.push(QueueEntry(file_path, 100, duration=60.0, stage="final"))
+                    requeued.set()
+                    dispatched.wait(5)
+                else:
+                    release.wait(5)
+            
+            try:
+                with patch.object(processor, "process_file", side_effect=process_file), \
+                     patch.object(processor._controller, "cpu_average", return_value=0.0):
+                    processor.processing_queue.push(QueueEntry(path, 100, duration=60.0, stage="draft"))
+                    processor.process_queued_files()
+                    assert requeued.wait(5)
+                    processor.process_queued_files()
+                    dispatched.set()
+                    time.sleep(0.1)
+                    
+                    # 本番の実行中は完了扱いにしない
+                    assert not processor.wait_for_jobs(timeout=0.2)
+                    release.set()
+                    assert processor.wait_for_jobs(timeout=5)
+            finally:
+                release.set()
+                processor.shutdown_workers()
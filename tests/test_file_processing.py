@@ -1,9 +1,11 @@
 """ファイル処理のテスト"""
 import os
+import json
 import tempfile
 import pytest
+import main
 from unittest.mock import patch, MagicMock
-from main import KoemojiProcessor
+from main import KoemojiProcessor, QueueEntry, TranscriptCache, TranscriptWriter
 
 
 class TestFileProcessing:
@@ -123,11 +125,7 @@ class TestFileProcessing:
         processor.config["max_cpu_percent"] = 95
         
         # キューにファイルを追加
-        processor.processing_queue.append({
-            "path": "/path/test.mp3",
-            "name": "test.mp3",
-            "priority": 0
-        })
+        processor.processing_queue.push(QueueEntry("/path/test.mp3"))
         
         # 処理を試みる
         processor.process_queued_files()
@@ -164,4 +162,415 @@ class TestFileProcessing:
             
             assert "第1セグメント" in content
             assert "第2セグメント" in content
-            assert "第3セグメント" in content
\ No newline at end of file
+            assert "第3セグメント" in content
+    
+    def test_transcript_cache_skips_identical_audio(self):
+        """同じ内容のファイルはキャッシュから出力されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            archive_dir = os.path.join(temp_dir, "archive")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": archive_dir,
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache_folder": os.path.join(temp_dir, "cache")
+                }, f)
+            
+            processor = KoemojiProcessor(config_path)
+            for name in ("original.mp3", "copy.mp3"):
+                with open(os.path.join(input_dir, name), 'wb') as f:
+                    f.write(b"same audio bytes")
+            
+            with patch.object(processor, "transcribe_audio", return_value="同じ内容") as mock_transcribe:
+                processor.process_file(os.path.join(input_dir, "original.mp3"))
+                processor.process_file(os.path.join(input_dir, "copy.mp3"))
+                
+                # 推論は1回だけ
+                assert mock_transcribe.call_count == 1
+            
+            with open(os.path.join(output_dir, "copy.txt"), 'r', encoding='utf-8') as f:
+                assert f.read() == "同じ内容"
+            assert sorted(os.listdir(archive_dir)) == ["copy.mp3", "original.mp3"]
+            assert processor._transcript_cache.stats() == (1, 1)
+            
+            # モデル設定が変わればキャッシュは使われない
+            processor.config["whisper_model"] = "small"
+            _, key_small = processor._lookup_transcript_cache(os.path.join(archive_dir, "copy.mp3"))
+            processor.config["whisper_model"] = "tiny"
+            _, key_tiny = processor._lookup_transcript_cache(os.path.join(archive_dir, "copy.mp3"))
+            assert key_small != key_tiny
+    
+    def test_transcript_cache_eviction(self):
+        """容量上限を超えると古いエントリから削除されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = TranscriptCache(temp_dir, max_bytes=25)
+            cache.put("old", "a" * 10)
+            os.utime(os.path.join(temp_dir, "old.txt"), (1, 1))
+            cache.put("mid", "b" * 10)
+            cache.put("new", "c" * 10)
+            
+            assert cache.get("old") is None
+            assert cache.get("mid") == "b" * 10
+            assert cache.get("new") == "c" * 10
+    
+    @patch('faster_whisper.vad.get_speech_timestamps')
+    @patch('faster_whisper.decode_audio')
+    def test_long_file_chunks_are_stitched_in_order(self, mock_decode, mock_vad):
+        """長時間ファイルがチャンクに分割され、時刻を補正して順に結合されるテスト"""
+        import numpy as np
+        from main import SAMPLE_RATE
+        
+        # 30秒の音声、10秒ごとに無音がある
+        mock_decode.return_value = np.zeros(30 * SAMPLE_RATE, dtype=np.float32)
+        mock_vad.return_value = [
+            {"start": 0, "end": 9 * SAMPLE_RATE},
+            {"start": 11 * SAMPLE_RATE, "end": 19 * SAMPLE_RATE},
+            {"start": 21 * SAMPLE_RATE, "end": 30 * SAMPLE_RATE},
+        ]
+        
+        processor = KoemojiProcessor()
+        processor.config["long_file_chunk_minutes"] = 10 / 60
+        processor.config["long_file_workers"] = 3
+        
+        model = MagicMock()
+        def fake_transcribe(audio, **kwargs):
+            segment = MagicMock(start=1.0, end=2.0, text=f"{len(audio) // SAMPLE_RATE}秒")
+            return ([segment], MagicMock())
+        model.transcribe.side_effect = fake_transcribe
+        
+        segments = list(processor._transcribe_long_file(model, "/path/to/long.mp3"))
+        
+        assert model.transcribe.call_count == 3
+        assert [s.text for s in segments] == ["10秒", "10秒", "10秒"]
+        assert [s.start for s in segments] == [1.0, 11.0, 21.0]
+        assert [s.end for s in segments] == [2.0, 12.0, 22.0]
+    
+    @patch('faster_whisper.WhisperModel')
+    def test_segments_are_streamed_to_part_file(self, mock_whisper_model):
+        """セグメントが.partファイルに逐次書き込まれ、完了時に置き換えられるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, "stream.txt")
+            part_file = output_file + ".part"
+            
+            processor = KoemojiProcessor()
+            processor.config["long_file_mode"] = False
+            
+            # 2つ目のセグメントのデコード時点で、1つ目は既に.partから読める
+            observed = []
+            def segments():
+                yield MagicMock(text=" 最初のセグメント ")
+                with open(part_file, 'r', encoding='utf-8') as f:
+                    observed.append(f.read())
+                yield MagicMock(text="次のセグメント")
+            
+            mock_model_instance = MagicMock()
+            mock_whisper_model.return_value = mock_model_instance
+            mock_model_instance.transcribe.return_value = (segments(), MagicMock())
+            
+            writer = TranscriptWriter(output_file, flush_interval=0)
+            assert processor.transcribe_audio("/path/to/test.mp3", writer=writer) is True
+            assert observed == ["最初のセグメント"]
+            assert not os.path.exists(output_file)
+            
+            writer.commit()
+            assert not os.path.exists(part_file)
+            with open(output_file, 'r', encoding='utf-8') as f:
+                assert f.read() == "最初のセグメント\n次のセグメント"
+    
+    @patch('faster_whisper.decode_audio')
+    @patch('faster_whisper.WhisperModel')
+    def test_resume_from_checkpoint(self, mock_whisper_model, mock_decode):
+        """中断されたファイルがチェックポイントの位置から再開されるテスト"""
+        import numpy as np
+        from main import SAMPLE_RATE
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache": False,
+                    "output_flush_seconds": 0
+                }, f)
+            processor = KoemojiProcessor(config_path)
+            
+            test_file = os.path.join(input_dir, "meeting.wav")
+            with open(test_file, 'wb') as f:
+                f.write(b"dummy audio")
+            
+            # 前回の実行：2セグメント書いたところで強制終了
+            params = processor._transcription_params()
+            key = json.dumps([os.path.getsize(test_file), params], sort_keys=True, ensure_ascii=False)
+            output_file = os.path.join(output_dir, "meeting.txt")
+            interrupted = TranscriptWriter(output_file, flush_interval=0, checkpoint_key=key)
+            interrupted.write_segment("前半1", end=10.0)
+            interrupted.write_segment("前半2", end=60.0)
+            interrupted._file.close()
+            
+            # 再開：60秒以降の音声だけが推論される
+            mock_decode.return_value = np.full(90 * SAMPLE_RATE, 0.1, dtype=np.float32)
+            mock_model_instance = MagicMock()
+            mock_whisper_model.return_value = mock_model_instance
+            mock_model_instance.transcribe.return_value = (
+                [MagicMock(start=5.0, end=20.0, text="後半")], MagicMock()
+            )
+            
+            processor.process_file(test_file)
+            
+            audio = mock_model_instance.transcribe.call_args[0][0]
+            assert len(audio) == 30 * SAMPLE_RATE
+            with open(output_file, 'r', encoding='utf-8') as f:
+                assert f.read() == "前半1\n前半2\n後半"
+            assert not os.path.exists(output_file + ".ckpt")
+            assert not os.path.exists(output_file + ".part")
+    
+    def test_cache_hit_replaces_checkpointed_part(self):
+        """チェックポイントが残っていてもキャッシュヒット時は全文だけを出力するテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache_folder": os.path.join(temp_dir, "cache"),
+                    "output_flush_seconds": 0
+                }, f)
+            processor = KoemojiProcessor(config_path)
+            
+            test_file = os.path.join(input_dir, "meeting.wav")
+            with open(test_file, 'wb') as f:
+                f.write(b"dummy audio")
+            cache, cache_key = processor._lookup_transcript_cache(test_file)
+            cache.put(cache_key, "前半\n後半")
+            
+            # 前回の実行：1セグメント書いたところで強制終了
+            key = json.dumps([os.path.getsize(test_file), processor._transcription_params()],
+                             sort_keys=True, ensure_ascii=False)
+            output_file = os.path.join(output_dir, "meeting.txt")
+            interrupted = TranscriptWriter(output_file, flush_interval=0, checkpoint_key=key)
+            interrupted.write_segment("前半", end=10.0)
+            interrupted._file.close()
+            
+            with patch.object(processor, "transcribe_audio") as mock_transcribe:
+                processor.process_file(test_file)
+            mock_transcribe.assert_not_called()
+            
+            with open(output_file, 'r', encoding='utf-8') as f:
+                assert f.read() == "前半\n後半"
+            assert not os.path.exists(output_file + ".ckpt")
+            assert not os.path.exists(output_file + ".part")
+    
+    @patch('faster_whisper.BatchedInferencePipeline')
+    @patch('faster_whisper.WhisperModel')
+    def test_batched_inference_mode(self, mock_whisper_model, mock_pipeline):
+        """batchedモードではキャッシュ済みモデルを包んだパイプラインで推論するテスト"""
+        mock_model_instance = MagicMock()
+        mock_whisper_model.return_value = mock_model_instance
+        pipeline_instance = MagicMock()
+        mock_pipeline.return_value = pipeline_instance
+        pipeline_instance.transcribe.return_value = ([MagicMock(text="バッチ")], MagicMock())
+        
+        processor = KoemojiProcessor()
+        processor.config.update({"inference_mode": "batched", "batch_size": 16, "long_file_mode": False})
+        
+        assert processor.transcribe_audio("/path/to/a.mp3") == "バッチ"
+        assert processor.transcribe_audio("/path/to/b.mp3") == "バッチ"
+        
+        # モデルもパイプラインも1回だけ作られる
+        assert mock_whisper_model.call_count == 1
+        mock_pipeline.assert_called_once_with(model=mock_model_instance)
+        assert pipeline_instance.transcribe.call_args.kwargs["batch_size"] == 16
+        mock_model_instance.transcribe.assert_not_called()
+    
+    def test_video_audio_track_is_extracted_once(self):
+        """動画は音声トラックだけを抜き出してキャッシュし、それを文字起こしに使うテスト"""
+        av = pytest.importorskip("av")
+        np = pytest.importorskip("numpy")
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            video_path = os.path.join(temp_dir, "recording.mp4")
+            try:
+                with av.open(video_path, "w") as output:
+                    video = output.add_stream("mpeg4", rate=10)
+                    video.width, video.height, video.pix_fmt = 64, 64, "yuv420p"
+                    audio = output.add_stream("aac", rate=16000)
+                    audio.layout = "mono"
+                    for _ in range(20):
+                        frame = av.VideoFrame.from_ndarray(np.zeros((64, 64, 3), dtype=np.uint8), format="rgb24")
+                        for packet in video.encode(frame):
+                            output.mux(packet)
+                    tone = 0.3 * np.sin(2 * np.pi * 440 * np.arange(32000, dtype=np.float32) / 16000)
+                    samples = av.AudioFrame.from_ndarray(tone.reshape(1, -1), format="fltp", layout="mono")
+                    samples.sample_rate = 16000
+                    samples.pts = 0
+                    for stream, frame in ((audio, samples), (audio, None), (video, None)):
+                        for packet in stream.encode(frame):
+                            output.mux(packet)
+            except Exception as e:
+                pytest.skip(f"テスト用の動画を作成できません: {e}")
+            
+            processor = KoemojiProcessor()
+            processor.config["audio_cache_folder"] = os.path.join(temp_dir, "audio_cache")
+            processor.config["long_file_mode"] = False
+            
+            mock_model = MagicMock()
+            mock_model.transcribe.return_value = ([MagicMock(text="動画の音声")], MagicMock())
+            with patch('main.extract_audio_track', wraps=main.extract_audio_track) as mock_extract, \
+                 patch.object(processor, "_get_whisper_model", return_value=mock_model):
+                assert processor.transcribe_audio(video_path) == "動画の音声"
+                assert processor.transcribe_audio(video_path) == "動画の音声"
+            
+            # コンテナからの抜き出しは1回だけで、小さい音声ファイルとしてキャッシュされる
+            assert mock_extract.call_count == 1
+            cached = os.listdir(processor.config["audio_cache_folder"])
+            assert len(cached) == 1
+            audio_path = os.path.join(processor.config["audio_cache_folder"], cached[0])
+            assert os.path.getsize(audio_path) < os.path.getsize(video_path)
+            with av.open(audio_path) as container:
+                assert not container.streams.video
+                assert container.streams.audio[0].codec_context.name == "aac"
+    
+    def test_draft_then_final_cascade(self):
+        """下書き（軽量モデル）を先に出力し、本番の結果で置き換えるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            archive_dir = os.path.join(temp_dir, "archive")
+            os.makedirs(input_dir)
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": archive_dir,
+                    "whisper_model": "large",
+                    "draft_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache": False
+                }, f)
+            test_file = os.path.join(input_dir, "memo.mp3")
+            with open(test_file, 'w') as f:
+                f.write("dummy")
+            
+            processor = KoemojiProcessor(config_path)
+            draft_file = os.path.join(output_dir, "memo.draft.txt")
+            final_file = os.path.join(output_dir, "memo.txt")
+            
+            def fake_transcribe(file_path, model_size=None, **kwargs):
+                return f"{model_size}の結果"
+            
+            with patch.object(processor, "transcribe_audio", side_effect=fake_transcribe):
+                processor.scan_and_queue_files()
+                assert processor.processing_queue.get(test_file).stage == "draft"
+                
+                # 下書き：入力は残り、本番の処理がキューに戻る
+                entry = processor.processing_queue.popleft()
+                processor.process_file(entry.path, "large", entry.stage)
+                with open(draft_file, 'r', encoding='utf-8') as f:
+                    assert f.read() == "tinyの結果"
+                assert os.path.exists(test_file)
+                assert not os.path.exists(final_file)
+                assert processor.processing_queue.get(test_file).stage == "final"
+                
+                # 本番：下書きを置き換えてアーカイブ
+                entry = processor.processing_queue.popleft()
+                processor.process_file(entry.path, "large", entry.stage)
+            
+            with open(final_file, 'r', encoding='utf-8') as f:
+                assert f.read() == "largeの結果"
+            assert not os.path.exists(draft_file)
+            assert os.listdir(archive_dir) == ["memo.mp3"]
+            assert not processor.processing_queue
+    
+    def test_decode_profile_selection(self):
+        """ファイル名のパターン・サブフォルダごとにデコードプロファイルが選ばれるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_dir = os.path.join(temp_dir, "input")
+            processor = KoemojiProcessor()
+            processor.config.update({
+                "input_folder": input_dir,
+                "long_file_mode": False,
+                "silence_prepass": False,
+                "decode_profile": "balanced",
+                "decode_profile_folders": {"voicemail": "fast", "lectures": "accurate"},
+                "decode_profile_patterns": {"*_draft.*": "fast"},
+                "decode_profiles": {"fast": {"beam_size": 2, "best_of": 1, "vad_filter": False}}
+            })
+            
+            assert processor._decode_profile_name(os.path.join(input_dir, "meeting.mp3")) == "balanced"
+            assert processor._decode_profile_name(os.path.join(input_dir, "voicemail", "a.m4a")) == "fast"
+            assert processor._decode_profile_name(os.path.join(input_dir, "lectures", "a_draft.mp3")) == "fast"
+            assert processor._decode_profile_name(os.path.join(input_dir, "lectures", "b.mp3")) == "accurate"
+            
+            # 組み込みのプロファイルはconfig.jsonで上書きできる
+            mock_model = MagicMock()
+            mock_model.transcribe.return_value = ([MagicMock(text="留守電")], MagicMock())
+            with patch.object(processor, "_get_whisper_model", return_value=mock_model):
+                processor.transcribe_audio(os.path.join(input_dir, "voicemail", "a.m4a"))
+                kwargs = mock_model.transcribe.call_args.kwargs
+                assert (kwargs["beam_size"], kwargs["best_of"], kwargs["vad_filter"]) == (2, 1, False)
+                
+                processor.transcribe_audio(os.path.join(input_dir, "lectures", "b.mp3"))
+                kwargs = mock_model.transcribe.call_args.kwargs
+                assert kwargs["beam_size"] == 10
+                assert kwargs["condition_on_previous_text"] is True
+                assert kwargs["vad_parameters"]["speech_pad_ms"] == 600
+            
+            # プロファイルが違えばキャッシュのキーも変わる
+            params = [processor._transcription_params("large", os.path.join(input_dir, name))
+                      for name in ("a.mp3", os.path.join("voicemail", "a.mp3"))]
+            assert params[0]["decode_options"] != params[1]["decode_options"]
+    
+    def test_subfolder_files_keep_their_folder(self):
+        """別のサブフォルダにある同名のファイルが出力・アーカイブで上書きし合わないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            archive_dir = os.path.join(temp_dir, "archive")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": archive_dir,
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache": False
+                }, f)
+            processor = KoemojiProcessor(config_path)
+            
+            paths = []
+            for folder in ("voicemail", "lectures"):
+                os.makedirs(os.path.join(input_dir, folder))
+                paths.append(os.path.join(input_dir, folder, "rec.mp3"))
+                with open(paths[-1], 'w') as f:
+                    f.write(folder)
+            
+            with patch.object(processor, "transcribe_audio",
+                              side_effect=lambda path, *args, **kwargs: os.path.basename(os.path.dirname(path))):
+                for path in paths:
+                    processor.process_file(path)
+            
+            for folder in ("voicemail", "lectures"):
+                with open(os.path.join(output_dir, folder, "rec.txt"), 'r', encoding='utf-8') as f:
+                    assert f.read() == folder
+                assert os.path.exists(os.path.join(archive_dir, folder, "rec.mp3"))
+            
+            # 入力フォルダの外のファイルはファイル名だけを使う
+            assert processor._relative_name(os.path.join(temp_dir, "other", "a.mp3")) == "a.mp3"
@@ -1,9 +1,11 @@
 """ファイルスキャン機能のテスト"""
 import os
+import json
 import tempfile
+import time
 import pytest
 from unittest.mock import patch, MagicMock
-from main import KoemojiProcessor
+from main import KoemojiProcessor, InotifyWatcher
 
 
 class TestFileScanning:
@@ -167,4 +169,84 @@ class TestFileScanning:
             
             # ファイルのみがキューに追加されたことを確認
             assert len(processor.processing_queue) == 1
-            assert os.path.basename(processor.processing_queue[0]["path"]) == "test.mp3"
\ No newline at end of file
+            assert os.path.basename(processor.processing_queue[0]["path"]) == "test.mp3"
+    
+    @pytest.mark.skipif(not InotifyWatcher.is_supported(), reason="inotifyはLinux専用")
+    def test_watcher_queues_file_on_close_write(self):
+        """書き込み完了・移動されたファイルが即座にキューに追加されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": os.path.join(temp_dir, "output"),
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja"
+                }, f)
+            
+            processor = KoemojiProcessor(config_path)
+            assert processor.start_watcher()
+            try:
+                # 書き込み中のファイルはまだキューに入らない
+                file_path = os.path.join(input_dir, "recording.mp3")
+                with open(file_path, 'w') as f:
+                    f.write("dummy content")
+                    f.flush()
+                    assert len(processor.processing_queue) == 0
+                
+                assert processor._wake_event.wait(5)
+                assert [f["path"] for f in processor.processing_queue] == [file_path]
+                
+                # 別の場所から移動されたファイルも検出される
+                processor._wake_event.clear()
+                outside = os.path.join(temp_dir, "moved.wav")
+                with open(outside, 'w') as f:
+                    f.write("dummy content")
+                os.rename(outside, os.path.join(input_dir, "moved.wav"))
+                
+                assert processor._wake_event.wait(5)
+                assert len(processor.processing_queue) == 2
+            finally:
+                processor.stop_watcher()
+    
+    def test_scan_profile_subfolders(self):
+        """デコードプロファイルを割り当てたサブフォルダのファイルもキューに追加されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_dir = os.path.join(temp_dir, "input")
+            for folder in ("voicemail", "other"):
+                os.makedirs(os.path.join(input_dir, folder))
+                with open(os.path.join(input_dir, folder, f"{folder}.mp3"), 'w') as f:
+                    f.write("dummy content")
+            
+            processor = KoemojiProcessor(os.path.join(temp_dir, "config.json"))
+            processor.config["input_folder"] = input_dir
+            processor.config["decode_profile_folders"] = {"voicemail": "fast", "missing": "accurate"}
+            processor.scan_and_queue_files()
+            
+            # 割り当てのないサブフォルダは従来どおり無視
+            assert [entry.path for entry in processor.processing_queue] == [
+                os.path.join(input_dir, "voicemail", "voicemail.mp3")
+            ]
+    
+    @pytest.mark.skipif(not InotifyWatcher.is_supported(), reason="inotifyはLinux専用")
+    def test_watcher_watches_profile_subfolders(self):
+        """プロファイルを割り当てたサブフォルダへの書き込みも検出されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            voicemail_dir = os.path.join(temp_dir, "voicemail")
+            os.makedirs(voicemail_dir)
+            detected = []
+            watcher = InotifyWatcher(temp_dir, detected.append, lambda: None, ["voicemail", "missing"])
+            watcher.start()
+            try:
+                file_path = os.path.join(voicemail_dir, "message.m4a")
+                with open(file_path, 'w') as f:
+                    f.write("dummy content")
+                for _ in range(50):
+                    if detected:
+                        break
+                    time.sleep(0.1)
+                assert detected == [file_path]
+            finally:
+                watcher.stop()
@@ -0,0 +1,146 @@
+"""単一インスタンスのロック・PIDファイル・ハートビートのテスト"""
+import os
+import json
+import time
+import tempfile
+import psutil
+import pytest
+from unittest.mock import patch
+from main import KoemojiProcessor, InstanceLock, IS_WINDOWS
+
+
+def write_config(temp_dir):
+    config_path = os.path.join(temp_dir, "config.json")
+    with open(config_path, 'w') as f:
+        json.dump({
+            "input_folder": os.path.join(temp_dir, "input"),
+            "output_folder": os.path.join(temp_dir, "output"),
+            "archive_folder": os.path.join(temp_dir, "archive"),
+            "whisper_model": "tiny",
+            "language": "ja",
+            "pid_file": os.path.join(temp_dir, "koemoji.pid"),
+            "heartbeat_path": os.path.join(temp_dir, "heartbeat.json"),
+            "metrics_path": os.path.join(temp_dir, "metrics.prom")
+        }, f)
+    return config_path
+
+
+def write_pid_file(path, pid):
+    with open(path, 'w') as f:
+        f.write(f"{pid}\n{psutil.Process(pid).create_time()}\n")
+
+
+class TestInstanceLock:
+    @pytest.mark.skipif(IS_WINDOWS, reason="同一プロセス内でのロック競合はflockの動作")
+    def test_lock_is_exclusive(self):
+        """ロック中は別のロックを取得できず、解放するとPIDファイルが消えるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.pid")
+            lock = InstanceLock(path)
+            assert lock.acquire()
+            assert InstanceLock.running_pid(path) == os.getpid()
+            assert not InstanceLock(path).acquire()
+            
+            lock.release()
+            assert not os.path.exists(path)
+            assert InstanceLock.running_pid(path) is None
+            
+            other = InstanceLock(path)
+            assert other.acquire()
+            other.release()
+    
+    def test_stale_pid_file(self):
+        """異常終了で残ったPIDファイル（ロックなし・開始時刻が異なる）は実行中とみなさないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.pid")
+            with open(path, 'w') as f:
+                f.write(f"{os.getpid()}\n12345.0\n")
+            assert InstanceLock.running_pid(path) is None
+            
+            lock = InstanceLock(path)
+            assert lock.acquire()
+            lock.release()
+    
+    @pytest.mark.skipif(IS_WINDOWS, reason="同一プロセス内でのロック競合はflockの動作")
+    def test_lock_after_concurrent_release(self):
+        """開いた直後に前の保持者が解放（削除）しても、削除されたファイルをロックしたままにしないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.pid")
+            first = InstanceLock(path)
+            assert first.acquire()
+            
+            real_open = os.open
+            opened = []
+            
+            def open_then_release(*args, **kwargs):
+                fd = real_open(*args, **kwargs)
+                if not opened:
+                    first.release()
+                opened.append(fd)
+                return fd
+            
+            second = InstanceLock(path)
+            with patch("os.open", side_effect=open_then_release):
+                assert second.acquire()
+            assert len(opened) == 2
+            try:
+                # パスのファイルをロックしているので、3つ目のロックは取得できない
+                assert not InstanceLock(path).acquire()
+                assert InstanceLock.running_pid(path) == os.getpid()
+            finally:
+                second.release()
+    
+    def test_is_already_running_reads_pid_file(self):
+        """起動時の確認はPIDファイルを読むだけでプロセス一覧を走査しないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            with patch("psutil.process_iter", side_effect=AssertionError("走査しない")):
+                assert not processor.is_already_running()
+                
+                # 別のプロセス（親プロセス）が実行中のPIDファイル
+                write_pid_file(processor.config["pid_file"], os.getppid())
+                assert processor.is_already_running()
+                
+                # 自分自身のPIDファイルは対象外
+                write_pid_file(processor.config["pid_file"], os.getpid())
+                assert not processor.is_already_running()
+    
+    @pytest.mark.skipif(IS_WINDOWS, reason="同一プロセス内でのロック競合はflockの動作")
+    def test_run_exits_when_locked(self):
+        """ロックを取得できなければ即座に終了し、実行中のプロセスのファイルを上書きしないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            lock = InstanceLock(processor.config["pid_file"])
+            assert lock.acquire()
+            try:
+                with patch.object(processor, "send_notification") as mock_notify:
+                    processor.run()
+                mock_notify.assert_called_once()
+                assert not os.path.exists(processor.config["heartbeat_path"])
+                assert InstanceLock.running_pid(processor.config["pid_file"]) == os.getpid()
+            finally:
+                lock.release()
+    
+    def test_webui_status(self):
+        """/statusがPIDファイルとハートビートだけで状態を返すテスト"""
+        import webui
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = KoemojiProcessor(write_config(temp_dir))
+            client = webui.app.test_client()
+            with patch.object(webui, "load_config", return_value=processor.config), \
+                 patch("psutil.process_iter", side_effect=AssertionError("走査しない")):
+                assert client.get("/status").get_json() == {"running": False, "pid": None}
+                
+                lock = InstanceLock(processor.config["pid_file"])
+                assert lock.acquire()
+                try:
+                    assert processor.publish_heartbeat()
+                    data = client.get("/status").get_json()
+                    assert data["running"] and data["pid"] == os.getpid()
+                    assert data["responsive"] and data["queue"] == 0 and data["in_flight"] == 0
+                    
+                    # ハートビートが途絶えたら応答なし
+                    with patch("time.time", return_value=time.time() + 3600):
+                        assert client.get("/status").get_json()["responsive"] is False
+                finally:
+                    lock.release()
@@ -0,0 +1,100 @@
+"""ジョブストア（永続キュー）のテスト"""
+import os
+import json
+import sqlite3
+import tempfile
+import pytest
+from main import KoemojiProcessor, JobStore
+
+
+def make_processor(temp_dir):
+    """一時ディレクトリ内で完結する設定のプロセッサーを作成"""
+    config_path = os.path.join(temp_dir, "config.json")
+    with open(config_path, 'w') as f:
+        json.dump({
+            "input_folder": os.path.join(temp_dir, "input"),
+            "output_folder": os.path.join(temp_dir, "output"),
+            "archive_folder": os.path.join(temp_dir, "archive"),
+            "whisper_model": "tiny",
+            "language": "ja",
+            "job_store_path": os.path.join(temp_dir, "jobs.db"),
+            "max_attempts": 2
+        }, f)
+    return KoemojiProcessor(config_path)
+
+
+class TestJobStore:
+    def test_resume_queue_after_restart(self):
+        """再起動後に前回のキューと処理中ジョブが復元されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = make_processor(temp_dir)
+            processor.open_job_store()
+            
+            input_dir = processor.config["input_folder"]
+            for name in ("first.mp3", "second.mp3", "third.mp3"):
+                with open(os.path.join(input_dir, name), 'w') as f:
+                    f.write("dummy")
+                processor.queue_file(os.path.join(input_dir, name))
+            
+            # 1件目は処理中のまま強制終了されたとする
+            first = processor.processing_queue.popleft().path
+            processor.job_store.mark_running(first)
+            processor.job_store.flush()
+            processor.job_store.close()
+            
+            restarted = make_processor(temp_dir)
+            assert restarted.open_job_store() == 3
+            try:
+                names = [entry.name for entry in restarted.processing_queue]
+                assert names == ["first.mp3", "second.mp3", "third.mp3"]
+                assert restarted.job_store.get(first) == ("running", 1, 5)
+            finally:
+                restarted.close_job_store()
+    
+    def test_failed_file_is_not_requeued_after_max_attempts(self):
+        """失敗上限に達したファイルはスキャンで再投入されないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            processor = make_processor(temp_dir)
+            processor.open_job_store()
+            try:
+                file_path = os.path.join(processor.config["input_folder"], "broken.mp3")
+                with open(file_path, 'w') as f:
+                    f.write("dummy")
+                
+                for _ in range(2):
+                    assert processor.queue_file(file_path)
+                    processor.processing_queue.remove(file_path)
+                    processor.job_store.mark_running(file_path)
+                    processor.job_store.mark_finished(file_path, "failed", "文字起こし失敗")
+                
+                assert not processor.queue_file(file_path)
+                
+                # 内容が変わったファイルは再び処理対象になる
+                with open(file_path, 'a') as f:
+                    f.write("more")
+                assert processor.queue_file(file_path)
+            finally:
+                processor.close_job_store()
+    
+    def test_writes_are_batched_in_wal_mode(self):
+        """状態はWALモードのDBにまとめて書き込まれるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "jobs.db")
+            store = JobStore(db_path, flush_interval=60)
+            store.open()
+            try:
+                store.mark_queued("/in/a.mp3", 10, 1.0)
+                store.mark_running("/in/a.mp3")
+                store.mark_finished("/in/a.mp3", "done")
+                store.flush()
+                
+                conn = sqlite3.connect(db_path)
+                try:
+                    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+                    row = conn.execute("SELECT state, attempts FROM jobs WHERE path = ?", ("/in/a.mp3",)).fetchone()
+                finally:
+                    conn.close()
+                assert row == ("done", 1)
+                assert store.get("/in/a.mp3") is None
+            finally:
+                store.close()
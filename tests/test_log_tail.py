@@ -0,0 +1,66 @@
+"""WebUIのログ末尾読み込み・ログストリームのテスト"""
+import os
+import tempfile
+from unittest.mock import patch
+import webui
+
+
+def write_lines(path, lines, mode='a'):
+    with open(path, mode, encoding='utf-8') as f:
+        f.writelines(f"{line}\n" for line in lines)
+
+
+class TestLogTail:
+    def test_tail_reads_last_lines(self):
+        """大きなログでも末尾の行だけを返し、書き込み途中の行は含めないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.log")
+            write_lines(path, [f"行{i} 処理中" for i in range(10000)], 'w')
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("書き込み途中")
+            
+            text, offset = webui.tail_log(path, lines=3, block_size=64)
+            assert text == "行9997 処理中\n行9998 処理中\n行9999 処理中\n"
+            assert offset == os.path.getsize(path) - len("書き込み途中".encode('utf-8'))
+            
+            # 続きは書き込み途中の行から
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("の行\n")
+            assert webui.read_log_from(path, offset) == ("書き込み途中の行\n", os.path.getsize(path))
+    
+    def test_read_from_after_truncate(self):
+        """ログが切り詰められた場合は先頭から読み直すテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.log")
+            write_lines(path, ["古いログ"] * 100, 'w')
+            _, offset = webui.tail_log(path)
+            
+            write_lines(path, ["新しいログ"], 'w')
+            assert webui.read_log_from(path, offset) == ("新しいログ\n", os.path.getsize(path))
+    
+    def test_log_events_stream(self):
+        """最初に末尾の行をresetで送り、その後は追記分だけをオフセット付きで送るテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.log")
+            write_lines(path, ["開始", "ファイル検出"], 'w')
+            
+            with patch.object(webui, "LOG_POLL_SECONDS", 0):
+                events = webui.log_events(path)
+                first = next(events)
+                assert first == f"event: reset\nid: {os.path.getsize(path)}\ndata: 開始\ndata: ファイル検出\n\n"
+                
+                write_lines(path, ["文字起こし完了"])
+                assert next(events) == f"id: {os.path.getsize(path)}\ndata: 文字起こし完了\n\n"
+                
+                # 再接続時（Last-Event-IDのオフセット）は続きだけを送る
+                resumed = webui.log_events(path, offset=len("開始\n".encode('utf-8')))
+                assert next(resumed) == f"id: {os.path.getsize(path)}\ndata: ファイル検出\ndata: 文字起こし完了\n\n"
+    
+    def test_log_route(self):
+        """/logが末尾の行を返すテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "koemoji.log")
+            write_lines(path, [f"行{i}" for i in range(100)], 'w')
+            with patch.object(webui, "LOG_FILE", path):
+                text = webui.app.test_client().get("/log").get_data(as_text=True)
+            assert text.splitlines() == [f"行{i}" for i in range(70, 100)]
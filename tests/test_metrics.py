@@ -0,0 +1,103 @@
+"""メトリクスのテスト"""
+import os
+import json
+import tempfile
+import pytest
+from unittest.mock import patch
+from main import KoemojiProcessor, MetricsRegistry
+
+
+class TestMetrics:
+    def test_registry_render(self):
+        """カウンター・ゲージ・ヒストグラムがPrometheusのテキスト形式で出力されるテスト"""
+        metrics = MetricsRegistry()
+        metrics.counter("jobs_total", "ジョブ数")
+        metrics.gauge("queue_depth", "キュー")
+        metrics.histogram("rtf", "RTF", (0.5, 1))
+        
+        metrics.inc("jobs_total", result="completed")
+        metrics.inc("jobs_total", result="completed")
+        metrics.set("queue_depth", 3)
+        for value in (0.2, 0.7, 2.0):
+            metrics.observe("rtf", value, model='la"rge')
+        
+        text = metrics.render()
+        assert "# TYPE jobs_total counter" in text
+        assert 'jobs_total{result="completed"} 2' in text
+        assert "queue_depth 3" in text
+        # バケットは累積、ラベル値はエスケープされる
+        assert 'rtf_bucket{model="la\\"rge",le="0.5"} 1' in text
+        assert 'rtf_bucket{model="la\\"rge",le="1"} 2' in text
+        assert 'rtf_bucket{model="la\\"rge",le="+Inf"} 3' in text
+        assert 'rtf_count{model="la\\"rge"} 3' in text
+        total, count = metrics.get("rtf", model='la"rge')
+        assert total == pytest.approx(2.9) and count == 3
+    
+    def test_process_file_records_metrics(self):
+        """ジョブの結果・音声の長さ・RTFが記録され、ファイルに公開されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": os.path.join(temp_dir, "output"),
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache": False,
+                    "metrics_path": os.path.join(temp_dir, "metrics.prom")
+                }, f)
+            
+            processor = KoemojiProcessor(config_path)
+            file_path = os.path.join(input_dir, "test.mp3")
+            with open(file_path, 'w') as f:
+                f.write("dummy audio content")
+            
+            with patch.object(processor, "transcribe_audio", return_value="テスト"), \
+                 patch("main.probe_duration", return_value=10.0), \
+                 patch.object(processor, "send_notification"):
+                processor.process_file(file_path)
+                processor.process_file(os.path.join(input_dir, "missing.mp3"))
+            processor.scan_and_queue_files()
+            
+            metrics = processor.metrics
+            assert metrics.get("koemoji_jobs_total", result="completed") == 1
+            assert metrics.get("koemoji_jobs_total", result="failed") == 1
+            assert metrics.get("koemoji_audio_seconds_total", model="tiny") == 10.0
+            assert metrics.get("koemoji_rtf", model="tiny")[1] == 1
+            assert metrics.get("koemoji_scan_duration_seconds")[1] == 1
+            
+            assert processor.publish_metrics()
+            with open(os.path.join(temp_dir, "metrics.prom"), 'r', encoding='utf-8') as f:
+                text = f.read()
+            assert "koemoji_queue_depth 0" in text
+            assert "koemoji_jobs_in_flight 0" in text
+            
+            # キュー投入時に取得した長さがあれば、完了後にファイルを読み直さない
+            queued_path = os.path.join(input_dir, "queued.mp3")
+            with open(queued_path, 'w') as f:
+                f.write("dummy audio content")
+            processor._active_jobs[queued_path] = {"stage": None, "started_at": None, "duration": 20.0, "writer": None}
+            with patch.object(processor, "transcribe_audio", return_value="テスト"), \
+                 patch("main.probe_duration", return_value=10.0) as mock_probe, \
+                 patch.object(processor, "send_notification"):
+                processor.process_file(queued_path)
+            mock_probe.assert_not_called()
+            assert metrics.get("koemoji_audio_seconds_total", model="tiny") == 30.0
+    
+    def test_webui_metrics_endpoint(self):
+        """webuiの/metricsが公開済みのスナップショットを返すテスト"""
+        import webui
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "metrics.prom")
+            client = webui.app.test_client()
+            with patch.object(webui, "load_config", return_value={"metrics_path": path}):
+                assert client.get("/metrics").status_code == 503
+                
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write("koemoji_queue_depth 2\n")
+                response = client.get("/metrics")
+                assert response.status_code == 200
+                assert response.mimetype == "text/plain"
+                assert response.get_data(as_text=True) == "koemoji_queue_depth 2\n"
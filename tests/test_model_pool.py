@@ -0,0 +1,225 @@
+"""モデルプールと事前ロードのテスト"""
+import os
+import threading
+import time
+import pytest
+from unittest.mock import patch, MagicMock
+from main import KoemojiProcessor, ModelPool, pin_threads_created_by
+
+
+class TestModelPool:
+    def test_lru_eviction_by_count(self):
+        """件数上限を超えると最も長く使われていないモデルが解放されるテスト"""
+        pool = ModelPool(max_models=2)
+        loader = MagicMock(side_effect=lambda: object())
+        
+        small = pool.get(("small", "int8", 4, 1), loader)
+        pool.get(("large", "int8", 4, 1), loader)
+        # smallを使うとlargeの方が古くなる
+        assert pool.get(("small", "int8", 4, 1), loader) is small
+        pool.get(("medium", "int8", 4, 1), loader)
+        
+        assert loader.call_count == 3
+        assert pool.keys() == [("small", "int8", 4, 1), ("medium", "int8", 4, 1)]
+    
+    def test_eviction_by_memory_budget(self):
+        """メモリ予算を超えると古いモデルが解放されるテスト"""
+        pool = ModelPool(max_models=5, memory_budget_bytes=150)
+        rss = iter([0, 100, 100, 200])
+        with patch.object(ModelPool, "_rss", side_effect=lambda: next(rss)):
+            pool.get(("tiny", "int8", 4, 1), object)
+            pool.get(("small", "int8", 4, 1), object)
+        
+        # 2つで200バイト > 予算150バイトなので古いtinyを解放
+        assert pool.keys() == [("small", "int8", 4, 1)]
+    
+    def test_hit_does_not_wait_for_other_load(self):
+        """別のモデルのロード中もロード済みのモデルはすぐに返り、同じモデルの要求はロードを共有するテスト"""
+        pool = ModelPool(max_models=3)
+        draft = pool.get(("tiny", "int8", 4, 1), object)
+        loading = threading.Event()
+        release = threading.Event()
+        large = object()
+        
+        def slow_load():
+            loading.set()
+            release.wait(5)
+            return large
+        
+        loader = MagicMock(side_effect=slow_load)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.get(("large", "int8", 4, 1), loader)))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        try:
+            assert loading.wait(5)
+            # ロード中のlargeに関係なく、ロード済みのtinyはすぐに返る
+            hit = []
+            hit_thread = threading.Thread(target=lambda: hit.append(pool.get(("tiny", "int8", 4, 1), object)))
+            hit_thread.start()
+            hit_thread.join(1)
+            assert hit == [draft]
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        
+        assert results == [large, large]
+        assert loader.call_count == 1
+    
+    @patch('faster_whisper.WhisperModel')
+    def test_preload_warms_up_and_reuses_model(self, mock_whisper_model):
+        """事前ロードしたモデルがジョブで再利用されるテスト"""
+        mock_model_instance = MagicMock()
+        mock_whisper_model.return_value = mock_model_instance
+        mock_model_instance.transcribe.return_value = ([], MagicMock())
+        
+        processor = KoemojiProcessor()
+        processor.config["long_file_mode"] = False
+        processor.preload_model()
+        
+        # ウォームアップで1回推論している
+        assert mock_model_instance.transcribe.call_count == 1
+        
+        processor.transcribe_audio("/path/to/test.mp3")
+        assert mock_whisper_model.call_count == 1
+        assert mock_model_instance.transcribe.call_count == 2
+    
+    @pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="CPUの固定はLinux専用")
+    def test_model_worker_threads_are_pinned(self):
+        """モデル生成時にロード中のスレッドから作られたワーカースレッドだけがそれぞれのCPUに固定されるテスト"""
+        started = threading.Barrier(4, timeout=5)
+        release = threading.Event()
+        workers = []
+        foreign = []
+        
+        # スレッドごとのアフィニティ（作成元のスレッドの値を引き継ぐカーネルの動作を再現）
+        masks = {}
+        default_mask = {0, 1, 2, 3}
+        
+        def getaffinity(tid):
+            return masks.get(tid or threading.get_native_id(), default_mask)
+        
+        def setaffinity(tid, cpus):
+            masks[tid or threading.get_native_id()] = set(cpus)
+        
+        def spawn(creator_mask, threads):
+            def run():
+                masks[threading.get_native_id()] = creator_mask
+                started.wait()
+                release.wait(5)
+            thread = threading.Thread(target=run)
+            thread.start()
+            threads.append(thread)
+        
+        def load():
+            # CTranslate2のようにワーカーごとのスレッドを作るローダー
+            for _ in range(2):
+                spawn(getaffinity(0), workers)
+            # 同じ時間に別のスレッド（先読みなど）が作ったスレッド
+            other = threading.Thread(target=lambda: spawn(default_mask, foreign))
+            other.start()
+            other.join()
+            started.wait()
+            return "model"
+        
+        with patch("os.sched_getaffinity", side_effect=getaffinity), \
+             patch("os.sched_setaffinity", side_effect=setaffinity) as mock_setaffinity:
+            assert pin_threads_created_by(load, [[0, 1], [2, 3]]) == "model"
+        release.set()
+        for thread in workers + foreign:
+            thread.join()
+        
+        pinned = {call.args[0]: call.args[1] for call in mock_setaffinity.call_args_list if call.args[0]}
+        assert pinned == {workers[0].native_id: [0, 1], workers[1].native_id: [2, 3]}
+        # ロードしたスレッドの割り当ては元に戻す
+        assert getaffinity(0) == default_mask
+    
+    @pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="CPUの固定はLinux専用")
+    def test_concurrent_loads_are_pinned_separately(self):
+        """2つのモデルを同時にロードしても、それぞれのワーカースレッドを個別に固定するテスト"""
+        release = threading.Event()
+        entered = []
+        workers = []
+        masks = {}
+        default_mask = {0, 1, 2, 3}
+        
+        def getaffinity(tid):
+            return masks.get(tid or threading.get_native_id(), default_mask)
+        
+        def setaffinity(tid, cpus):
+            masks[tid or threading.get_native_id()] = set(cpus)
+        
+        def load():
+            # もう一方のロードが始まるのを少し待ってからワーカーのスレッドを作る
+            entered.append(threading.get_native_id())
+            deadline = time.time() + 0.3
+            while len(entered) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            creator_mask = getaffinity(0)
+            for _ in range(2):
+                ready = threading.Event()
+                def run(ready=ready):
+                    masks[threading.get_native_id()] = creator_mask
+                    ready.set()
+                    release.wait(5)
+                thread = threading.Thread(target=run)
+                thread.start()
+                ready.wait(5)
+                workers.append(thread)
+            return "model"
+        
+        results = []
+        with patch("os.sched_getaffinity", side_effect=getaffinity), \
+             patch("os.sched_setaffinity", side_effect=setaffinity) as mock_setaffinity:
+            loaders = [threading.Thread(target=lambda: results.append(pin_threads_created_by(load, [[0, 1], [2, 3]])))
+                       for _ in range(2)]
+            for loader in loaders:
+                loader.start()
+            for loader in loaders:
+                loader.join(5)
+        release.set()
+        for thread in workers:
+            thread.join()
+        
+        assert results == ["model", "model"]
+        worker_ids = {thread.native_id for thread in workers}
+        pinned = [call.args[1] for call in mock_setaffinity.call_args_list if call.args[0] in worker_ids]
+        # 全体の範囲ではなく、ワーカーごとの割り当てに固定する
+        assert sorted(pinned) == [[0, 1], [0, 1], [2, 3], [2, 3]]
+    
+    @patch('main.release_memory_to_os', return_value=True)
+    @patch('faster_whisper.WhisperModel')
+    def test_idle_unload_and_reload_on_detection(self, mock_whisper_model, mock_release):
+        """アイドルが続くとモデルを解放し、ファイルを検出すると再ロードするテスト"""
+        mock_whisper_model.return_value.transcribe.return_value = ([], MagicMock())
+        
+        processor = KoemojiProcessor()
+        processor.config.update({"idle_unload_minutes": 10, "preload_model": True})
+        processor.preload_model()
+        assert len(processor._model_pool) == 1
+        
+        # アイドル時間に達していなければ解放しない
+        assert not processor.unload_idle_models()
+        
+        # キューにファイルがあれば解放しない
+        processor._last_activity -= 11 * 60
+        with patch.object(processor, "processing_queue", [object()]):
+            assert not processor.unload_idle_models()
+        
+        assert processor.unload_idle_models()
+        assert len(processor._model_pool) == 0
+        mock_release.assert_called_once()
+        
+        # ファイル検出時にバックグラウンドで再ロード
+        with patch.object(processor, "queue_file", return_value=True):
+            processor._on_file_detected("/path/to/new.mp3")
+        processor._preload_thread.join(timeout=5)
+        assert len(processor._model_pool) == 1
+        assert mock_whisper_model.call_count == 2
+        
+        # 0を指定すると解放しない
+        processor.config["idle_unload_minutes"] = 0
+        processor._last_activity -= 3600
+        assert not processor.unload_idle_models()
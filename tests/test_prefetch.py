@@ -0,0 +1,118 @@
+"""先読みデコードのテスト"""
+import threading
+import numpy as np
+import pytest
+from unittest.mock import patch, MagicMock
+from main import KoemojiProcessor, AudioPrefetcher, QueueEntry, SAMPLE_RATE
+
+
+def fake_audio(seconds):
+    return np.full(int(seconds * SAMPLE_RATE), 0.1, dtype=np.float32)
+
+
+def wait_until_idle(prefetcher):
+    """着手できる先読みがすべて終わるまで待つ"""
+    with prefetcher._cond:
+        while prefetcher._decoding is not None or prefetcher._can_start():
+            prefetcher._cond.wait(1)
+
+
+class TestAudioPrefetcher:
+    def test_prefetch_and_take(self):
+        """先読みした音声を取り出せるテスト（未着手のファイルはNone）"""
+        decode = MagicMock(side_effect=lambda path: fake_audio(1))
+        prefetcher = AudioPrefetcher(decode, 10 * AudioPrefetcher.BYTES_PER_SECOND)
+        try:
+            prefetcher.prefetch([("/path/a.mp3", AudioPrefetcher.BYTES_PER_SECOND)])
+            wait_until_idle(prefetcher)
+
+            audio = prefetcher.take("/path/a.mp3")
+            assert audio is not None and len(audio) == SAMPLE_RATE
+            assert prefetcher.memory_used() == 0
+            assert prefetcher.take("/path/b.mp3") is None
+            assert (prefetcher.hits, prefetcher.misses) == (1, 1)
+        finally:
+            prefetcher.stop()
+
+    def test_memory_budget_limits_decoding(self):
+        """予算を超える分は取り出されて空きができるまでデコードしないテスト"""
+        decoded = []
+        second_started = threading.Event()
+
+        def decode(path):
+            decoded.append(path)
+            if path.endswith("b.mp3"):
+                second_started.set()
+            return fake_audio(3)
+
+        prefetcher = AudioPrefetcher(decode, 5 * AudioPrefetcher.BYTES_PER_SECOND)
+        estimate = 3 * AudioPrefetcher.BYTES_PER_SECOND
+        try:
+            prefetcher.prefetch([("/path/a.mp3", estimate), ("/path/b.mp3", estimate)])
+            # 1件目（3秒分）がデコードされると2件目を入れる余裕はない
+            wait_until_idle(prefetcher)
+            assert decoded == ["/path/a.mp3"]
+            # 取り出して空きができると2件目に着手
+            assert prefetcher.take("/path/a.mp3") is not None
+            assert second_started.wait(5)
+            assert decoded == ["/path/a.mp3", "/path/b.mp3"]
+            assert prefetcher.take("/path/b.mp3") is not None
+        finally:
+            prefetcher.stop()
+
+        # 単体で予算を超えるファイルは先読みしない
+        prefetcher = AudioPrefetcher(decode, 5 * AudioPrefetcher.BYTES_PER_SECOND)
+        prefetcher.prefetch([("/path/huge.mp3", 10 * AudioPrefetcher.BYTES_PER_SECOND)])
+        assert prefetcher.take("/path/huge.mp3") is None
+        prefetcher.stop()
+
+    def test_underestimated_audio_is_not_kept(self):
+        """見積もりより大きくデコードされて予算を超える音声は保持しないテスト"""
+        prefetcher = AudioPrefetcher(lambda path: fake_audio(10), 5 * AudioPrefetcher.BYTES_PER_SECOND)
+        try:
+            # 長さを取得できず、実際より短く見積もったファイル
+            prefetcher.prefetch([("/path/low_bitrate.mp3", AudioPrefetcher.BYTES_PER_SECOND)])
+            wait_until_idle(prefetcher)
+            assert prefetcher.memory_used() == 0
+            assert prefetcher.take("/path/low_bitrate.mp3") is None
+        finally:
+            prefetcher.stop()
+
+    def test_dropped_from_queue_is_released(self):
+        """キューから外れたファイルの先読み音声が破棄されるテスト"""
+        prefetcher = AudioPrefetcher(lambda path: fake_audio(1), 10 * AudioPrefetcher.BYTES_PER_SECOND)
+        try:
+            prefetcher.prefetch([("/path/a.mp3", 1), ("/path/b.mp3", 1)])
+            wait_until_idle(prefetcher)
+            assert prefetcher.memory_used() == 2 * SAMPLE_RATE * 4
+
+            # a.mp3だけがキューに残った（処理中のb.mp3は保持）
+            prefetcher.prefetch([("/path/a.mp3", 1)], keep={"/path/b.mp3"})
+            assert prefetcher.memory_used() == 2 * SAMPLE_RATE * 4
+            prefetcher.prefetch([])
+            assert prefetcher.memory_used() == 0
+            assert prefetcher.take("/path/a.mp3") is None
+        finally:
+            prefetcher.stop()
+
+    def test_transcribe_uses_prefetched_audio(self):
+        """キューの先頭を先読みし、文字起こしでデコード済みの配列を使うテスト"""
+        processor = KoemojiProcessor()
+        processor.config["long_file_mode"] = False
+        processor.processing_queue.push(QueueEntry("/path/next.mp3", 100, duration=1.0))
+
+        audio = fake_audio(1)
+        mock_model = MagicMock()
+        mock_model.transcribe.return_value = ([MagicMock(text="テスト", start=0.0, end=1.0)], MagicMock())
+        try:
+            with patch.object(processor, "_decode_audio", return_value=audio) as mock_decode, \
+                 patch.object(processor, "_get_whisper_model", return_value=mock_model):
+                processor._schedule_prefetch()
+                wait_until_idle(processor._prefetcher)
+                result = processor.transcribe_audio("/path/next.mp3")
+
+            assert result == "テスト"
+            mock_decode.assert_called_once_with("/path/next.mp3")
+            assert mock_model.transcribe.call_args[0][0] is audio
+        finally:
+            processor.shutdown_workers()
@@ -0,0 +1,94 @@
+"""段階別プロファイルのテスト"""
+import os
+import json
+import time
+import tempfile
+from unittest.mock import patch
+from main import KoemojiProcessor, StageTimer, timed_stage, instrument_transcriber
+
+
+class FakeModel:
+    def encode(self, features):
+        time.sleep(0.02)
+        return features
+    
+    def generate_with_fallback(self, encoder_output):
+        time.sleep(0.01)
+        return encoder_output
+
+
+class TestStageProfiling:
+    def test_nested_stages_are_exclusive(self):
+        """入れ子の段階は内側の時間を外側から差し引き、計測外のスレッドでは何もしないテスト"""
+        with timed_stage("decode"):
+            pass
+        
+        timer = StageTimer()
+        with timer.bind():
+            with timed_stage("outer"):
+                time.sleep(0.02)
+                with timed_stage("inner"):
+                    time.sleep(0.05)
+        assert StageTimer.current() is None
+        assert 0.05 <= timer.durations["inner"] < 0.2
+        assert 0.02 <= timer.durations["outer"] < 0.05
+    
+    def test_instrument_transcriber(self):
+        """エンコーダとビームサーチの呼び出しが計測されるテスト（ラップは1回だけ）"""
+        model = FakeModel()
+        instrument_transcriber(model)
+        instrument_transcriber(model)
+        
+        timer = StageTimer()
+        with timer.bind():
+            model.generate_with_fallback(model.encode("features"))
+        assert set(timer.durations) == {"encoder", "beam"}
+        assert timer.durations["encoder"] >= 0.02
+        # 計測中でなければそのまま呼ばれる
+        assert model.encode("x") == "x"
+    
+    def test_process_file_records_profile(self):
+        """段階別の時間がジョブの記録に保存され、しきい値以上ならcProfileも保存されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": os.path.join(temp_dir, "output"),
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "transcript_cache": False,
+                    "job_store_path": os.path.join(temp_dir, "jobs.db"),
+                    "profile_stages": True,
+                    "profile_cprofile_seconds": 0.01,
+                    "profile_folder": os.path.join(temp_dir, "profiles")
+                }, f)
+            
+            processor = KoemojiProcessor(config_path)
+            processor.open_job_store()
+            file_path = os.path.join(input_dir, "test.mp3")
+            with open(file_path, 'w') as f:
+                f.write("dummy audio content")
+            processor.queue_file(file_path)
+            
+            def fake_transcribe(path, *args, **kwargs):
+                with timed_stage("encoder"):
+                    time.sleep(0.02)
+                return "テスト"
+            
+            try:
+                with patch.object(processor, "transcribe_audio", side_effect=fake_transcribe), \
+                     patch.object(processor, "send_notification"):
+                    processor.process_file(file_path)
+                processor.job_store.flush()
+                profile = processor.job_store.get_profile(file_path)
+            finally:
+                processor.close_job_store()
+            
+            assert profile["file"] == "test.mp3"
+            assert profile["state"] == "done"
+            assert {"encoder", "write", "archive"} <= set(profile["stages"])
+            assert profile["stages"]["encoder"] >= 0.02
+            assert os.path.exists(profile["cprofile"])
@@ -1,34 +1,106 @@
 """キュー管理のテスト"""
 import os
+import json
 import tempfile
+import threading
+import time
 import pytest
 from datetime import datetime
-from main import KoemojiProcessor
+from unittest.mock import patch, MagicMock
+from main import KoemojiProcessor, QueueEntry, FileQueue, ConcurrencyController
 
 
 class TestQueueManagement:
-    def test_queue_priority_ordering(self):
-        """優先度に基づくキューの並び替えテスト"""
+    def test_queue_fifo_ordering(self):
+        """fifo方式では追加順に取り出されるキューのテスト"""
         processor = KoemojiProcessor()
+        processor.config["scheduler_policy"] = "fifo"
+        processor.processing_queue = processor._create_queue()
         
-        # 異なる優先度のファイル情報を作成
+        # 異なるサイズのファイル情報を作成
         files = [
-            {"path": "/path/normal.mp3", "name": "normal.mp3", "size": 100000000, "priority": 0},
-            {"path": "/path/urgent.mp3", "name": "urgent.mp3", "size": 5000000, "priority": 8},
-            {"path": "/path/small.mp3", "name": "small.mp3", "size": 1000000, "priority": 3},
+            QueueEntry("/path/normal.mp3", 100000000),
+            QueueEntry("/path/urgent.mp3", 5000000),
+            QueueEntry("/path/small.mp3", 1000000),
         ]
         
-        # ランダムな順序でキューに追加
-        for file_info in files:
-            processor.processing_queue.append(file_info)
+        for entry in files:
+            assert processor.processing_queue.push(entry)
         
-        # 優先度でソート
-        processor.processing_queue.sort(key=lambda x: x["priority"], reverse=True)
+        # 同じパスは二重に追加されない
+        assert not processor.processing_queue.push(QueueEntry("/path/urgent.mp3", 5000000))
+        assert "/path/urgent.mp3" in processor.processing_queue
         
-        # 優先度の高い順に並んでいることを確認
-        assert processor.processing_queue[0]["name"] == "urgent.mp3"
-        assert processor.processing_queue[1]["name"] == "small.mp3"
-        assert processor.processing_queue[2]["name"] == "normal.mp3"
+        # 追加順に取り出されることを確認
+        assert processor.processing_queue[0]["name"] == "normal.mp3"
+        assert processor.processing_queue.popleft().name == "normal.mp3"
+        assert processor.processing_queue.popleft().name == "urgent.mp3"
+        assert processor.processing_queue.popleft().name == "small.mp3"
+        assert "/path/urgent.mp3" not in processor.processing_queue
+    
+    def test_queue_sjf_ordering(self):
+        """sjf方式では音声の短い順に取り出されるテスト"""
+        queue = FileQueue("sjf")
+        queue.push(QueueEntry("/path/lecture.mp3", 100, duration=3600.0))
+        queue.push(QueueEntry("/path/memo.m4a", 100, duration=45.0))
+        queue.push(QueueEntry("/path/meeting.mp4", 100, duration=900.0))
+        # 長さ不明のファイルはサイズから見積もる（1.6MB ≒ 100秒）
+        queue.push(QueueEntry("/path/unknown.mp3", 1600000))
+        
+        assert [entry.name for entry in queue] == ["memo.m4a", "unknown.mp3", "meeting.mp4", "lecture.mp3"]
+        
+        # 削除したエントリは取り出されない
+        assert queue.remove("/path/unknown.mp3").name == "unknown.mp3"
+        assert [queue.popleft().name for _ in range(len(queue))] == ["memo.m4a", "meeting.mp4", "lecture.mp3"]
+        assert not queue
+    
+    def test_queue_aging_prevents_starvation(self):
+        """aging方式では待ち続けた長いファイルが後から来た短いファイルより先になるテスト"""
+        queue = FileQueue("aging", aging_weight=1.0)
+        now = time.time()
+        queue.push(QueueEntry("/path/lecture.mp3", 100, queued_at=now, duration=600.0))
+        # 直後に来た短いファイルは先に処理される
+        queue.push(QueueEntry("/path/memo1.m4a", 100, queued_at=now + 10, duration=30.0))
+        # 十分待った後（長さの差以上）に来た短いファイルより長いファイルが優先される
+        queue.push(QueueEntry("/path/memo2.m4a", 100, queued_at=now + 700, duration=30.0))
+        
+        assert [entry.name for entry in queue] == ["memo1.m4a", "lecture.mp3", "memo2.m4a"]
+    
+    def test_queue_peek_reads_only_head(self):
+        """peekは削除済みの項目を飛ばして先頭の件数分だけを返し、キューを変えないテスト"""
+        queue = FileQueue("sjf")
+        for i in range(1000):
+            queue.push(QueueEntry(f"/path/{i:04d}.mp3", 100, duration=float(i)))
+        queue.remove("/path/0000.mp3")
+        queue.remove("/path/0002.mp3")
+        
+        with patch("heapq.nsmallest", side_effect=AssertionError("全体を走査しない")):
+            assert [entry.name for entry in queue.peek(3)] == ["0001.mp3", "0003.mp3", "0004.mp3"]
+            assert [entry.name for entry in queue.peek(3)] == ["0001.mp3", "0003.mp3", "0004.mp3"]
+        assert len(queue) == 998
+        assert queue.popleft().name == "0001.mp3"
+        assert [entry.name for entry in FileQueue().peek(2)] == []
+    
+    def test_queue_file_probes_duration_and_codec(self):
+        """キュー追加時に長さとコーデックが記録されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_dir = os.path.join(temp_dir, "input")
+            os.makedirs(input_dir)
+            file_path = os.path.join(input_dir, "memo.mp3")
+            with open(file_path, "w") as f:
+                f.write("dummy content")
+            
+            processor = KoemojiProcessor(os.path.join(temp_dir, "config.json"))
+            processor.config["input_folder"] = input_dir
+            
+            with patch('main.probe_media', return_value=(42.0, "mp3")) as mock_probe:
+                processor.scan_and_queue_files()
+            
+            mock_probe.assert_called_once_with(file_path)
+            entry = processor.processing_queue.get(file_path)
+            assert entry.duration == 42.0
+            assert entry.codec == "mp3"
+            assert entry.size == len("dummy content")
     
     def test_add_file_to_queue(self):
         """ファイルをキューに追加するテスト"""
@@ -62,21 +134,23 @@ class TestQueueManagement:
         processor = KoemojiProcessor()
         
         # テスト用ファイル情報
-        file1 = {"path": "/path/file1.mp3", "name": "file1.mp3"}
-        file2 = {"path": "/path/file2.mp3", "name": "file2.mp3"}
-        file3 = {"path": "/path/file3.mp3", "name": "file3.mp3"}
+        file1 = QueueEntry("/path/file1.mp3")
+        file2 = QueueEntry("/path/file2.mp3")
+        file3 = QueueEntry("/path/file3.mp3")
         
         # キューに追加
-        processor.processing_queue = [file1, file2, file3]
+        for entry in (file1, file2, file3):
+            processor.processing_queue.push(entry)
         
         # file2を削除
-        processor.processing_queue = [f for f in processor.processing_queue if f["path"] != file2["path"]]
+        assert processor.processing_queue.remove(file2.path) is file2
         
         # file2が削除されたことを確認
         assert len(processor.processing_queue) == 2
-        assert file1 in processor.processing_queue
-        assert file2 not in processor.processing_queue
-        assert file3 in processor.processing_queue
+        assert file1.path in processor.processing_queue
+        assert file2.path not in processor.processing_queue
+        assert file3.path in processor.processing_queue
+        assert list(processor.processing_queue) == [file1, file3]
     
     def test_concurrent_processing_limit(self):
         """同時処理数の制限テスト"""
@@ -85,11 +159,7 @@ class TestQueueManagement:
         
         # 3つのファイルをキューに追加
         for i in range(3):
-            processor.processing_queue.append({
-                "path": f"/path/file{i}.mp3",
-                "name": f"file{i}.mp3",
-                "priority": 0
-            })
+            processor.processing_queue.push(QueueEntry(f"/path/file{i}.mp3"))
         
         # 2つのファイルを処理中にする
         processor.files_in_process.add("/path/file0.mp3")
@@ -136,14 +206,179 @@ class TestQueueManagement:
         assert len(processor.processing_queue) == 0
         
         # ファイルを追加
-        processor.processing_queue.append({
-            "path": "/path/test.mp3",
-            "name": "test.mp3"
-        })
+        processor.processing_queue.push(QueueEntry("/path/test.mp3"))
         
         assert len(processor.processing_queue) == 1
         
         # ファイルを削除
         processor.processing_queue.clear()
         
-        assert len(processor.processing_queue) == 0
\ No newline at end of file
+        assert len(processor.processing_queue) == 0
+    
+    def test_concurrent_workers_run_in_parallel(self):
+        """max_concurrent_filesまで並列に処理されるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_path = os.path.join(temp_dir, "config.json")
+            input_dir = os.path.join(temp_dir, "input")
+            output_dir = os.path.join(temp_dir, "output")
+            os.makedirs(input_dir, exist_ok=True)
+            with open(config_path, 'w') as f:
+                json.dump({
+                    "input_folder": input_dir,
+                    "output_folder": output_dir,
+                    "archive_folder": os.path.join(temp_dir, "archive"),
+                    "whisper_model": "tiny",
+                    "language": "ja",
+                    "max_concurrent_files": 3,
+                    "max_cpu_percent": 100
+                }, f)
+            
+            for i in range(3):
+                with open(os.path.join(input_dir, f"file{i}.mp3"), 'w') as f:
+                    f.write("dummy")
+            
+            processor = KoemojiProcessor(config_path)
+            
+            # 3ファイルが同時に実行中でなければバリアを通過できない
+            barrier = threading.Barrier(3, timeout=5)
+            def fake_transcribe(file_path, model_size=None, **kwargs):
+                barrier.wait()
+                return "ok"
+            
+            with patch.object(processor, "transcribe_audio", side_effect=fake_transcribe):
+                processor.scan_and_queue_files()
+                processor.process_queued_files()
+                
+                # ディスパッチは完了を待たずに戻る
+                assert len(processor.processing_queue) == 0
+                processor.wait_for_jobs(timeout=10)
+            
+            processor.shutdown_workers()
+            assert sorted(os.listdir(output_dir)) == ["file0.txt", "file1.txt", "file2.txt"]
+            assert len(processor.files_in_process) == 0
+    
+    def test_final_passes_do_not_starve_drafts(self):
+        """下書きは本番より先に取り出され、本番は下書き用のスロットを残すテスト"""
+        queue = FileQueue("sjf")
+        queue.push(QueueEntry("/path/short.mp3", 100, duration=10.0, stage="final"))
+        queue.push(QueueEntry("/path/long.mp3", 100, duration=3600.0, stage="draft"))
+        assert [entry.name for entry in queue] == ["long.mp3", "short.mp3"]
+        
+        processor = KoemojiProcessor()
+        processor.config.update({"max_concurrent_files": 2, "max_cpu_percent": 100})
+        for i in range(3):
+            processor.processing_queue.push(QueueEntry(f"/path/final{i}.mp3", 100, duration=60.0, stage="final"))
+        
+        started = []
+        release = threading.Event()
+        def fake_process(file_path, model_size=None, stage=None):
+            started.append((os.path.basename(file_path), stage))
+            release.wait(5)
+            with processor._state_lock:
+                processor.files_in_process.discard(file_path)
+        
+        with patch.object(processor, "process_file", side_effect=fake_process), \
+             patch.object(processor._controller, "update", return_value=2), \
+             patch.object(processor._controller, "cpu_average", return_value=10.0):
+            # 空きが2つあっても本番は1つだけ実行
+            processor.process_queued_files()
+            assert len(processor.files_in_process) == 1
+            
+            # 後から来た下書きは空けておいたスロットですぐに実行される
+            processor.processing_queue.push(QueueEntry("/path/new.mp3", 100, duration=30.0, stage="draft"))
+            processor.process_queued_files()
+            assert len(processor.files_in_process) == 2
+            
+            release.set()
+            processor.wait_for_jobs(timeout=10)
+        processor.shutdown_workers()
+        
+        assert sorted(started) == [("final0.mp3", "final"), ("new.mp3", "draft")]
+        assert processor._running_finals == 0
+    
+    def test_draft_runs_beside_final_when_limit_is_one(self):
+        """同時実行数が1でも、本番の処理中に来た下書きは待たずに実行されるテスト"""
+        processor = KoemojiProcessor()
+        processor.config.update({"max_concurrent_files": 1, "max_cpu_percent": 100, "draft_model": "tiny"})
+        processor.processing_queue.push(QueueEntry("/path/final.mp3", 100, duration=3600.0, stage="final"))
+        
+        started = set()
+        release = threading.Event()
+        def fake_process(file_path, model_size=None, stage=None):
+            started.add(file_path)
+            release.wait(5)
+            with processor._state_lock:
+                processor.files_in_process.discard(file_path)
+        
+        def wait_started(file_path, timeout=2):
+            deadline = time.time() + timeout
+            while file_path not in started and time.time() < deadline:
+                time.sleep(0.01)
+            return file_path in started
+        
+        try:
+            with patch.object(processor, "process_file", side_effect=fake_process), \
+                 patch.object(processor._controller, "update", return_value=1), \
+                 patch.object(processor._controller, "cpu_average", return_value=10.0):
+                processor.process_queued_files()
+                assert wait_started("/path/final.mp3")
+                
+                # 2件目の本番は待たせるが、下書きは空けておいたスロットで実行する
+                processor.processing_queue.push(QueueEntry("/path/final2.mp3", 100, duration=60.0, stage="final"))
+                processor.process_queued_files()
+                assert processor.files_in_process == {"/path/final.mp3"}
+                processor.processing_queue.push(QueueEntry("/path/new.mp3", 100, duration=30.0, stage="draft"))
+                processor.process_queued_files()
+                # 本番の処理が終わる前に下書きの処理が始まっている
+                assert wait_started("/path/new.mp3")
+                assert not release.is_set()
+                
+                # 下書きの実行中は上限どおり
+                processor.processing_queue.push(QueueEntry("/path/new2.mp3", 100, duration=30.0, stage="draft"))
+                processor.process_queued_files()
+                assert len(processor.files_in_process) == 2
+                assert not wait_started("/path/new2.mp3", timeout=0.2)
+        finally:
+            release.set()
+            processor.wait_for_jobs(timeout=5)
+            processor.shutdown_workers()
+    
+    @patch('os.getloadavg', return_value=(0.1, 0.1, 0.1))
+    @patch('psutil.swap_memory')
+    @patch('psutil.virtual_memory')
+    @patch('psutil.cpu_percent')
+    def test_controller_backs_off_on_memory_pressure(self, mock_cpu, mock_memory, mock_swap, mock_load):
+        """空きメモリが不足すると同時実行数を減らすテスト"""
+        mock_cpu.return_value = 50.0
+        mock_swap.return_value = MagicMock(sin=0, sout=0)
+        controller = ConcurrencyController(max_workers=4, min_free_memory_mb=1024)
+        
+        mock_memory.return_value = MagicMock(available=512 * 1024 * 1024)
+        controller.sample()
+        assert controller.update(running=4, queued=5) == 3
+        
+        # メモリに余裕が戻り、バックログがあれば再び増やす
+        mock_memory.return_value = MagicMock(available=8 * 1024 * 1024 * 1024)
+        controller.sample()
+        assert controller.update(running=3, queued=5) == 4
+    
+    @patch('os.getloadavg', return_value=(0.1, 0.1, 0.1))
+    @patch('psutil.swap_memory')
+    @patch('psutil.virtual_memory')
+    @patch('psutil.cpu_percent')
+    def test_controller_uses_measured_throughput(self, mock_cpu, mock_memory, mock_swap, mock_load):
+        """並列数を増やしてもスループットが伸びない場合は減らすテスト"""
+        mock_cpu.return_value = 60.0
+        mock_swap.return_value = MagicMock(sin=0, sout=0)
+        mock_memory.return_value = MagicMock(available=8 * 1024 * 1024 * 1024)
+        controller = ConcurrencyController(max_workers=3)
+        controller.sample()
+        
+        # 2並列では各ジョブRTF 0.2（全体10倍速）、3並列では各ジョブRTF 0.5（全体6倍速）
+        assert controller.record_job(2, 100.0, 20.0) == pytest.approx(0.2)
+        controller.record_job(3, 100.0, 50.0)
+        
+        assert controller.update(running=3, queued=10) == 2
+        # 3並列の方が遅いと分かっているので増やさない
+        controller.sample()
+        assert controller.update(running=2, queued=10) == 2
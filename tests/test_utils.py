@@ -2,7 +2,8 @@
 import os
 import tempfile
 import pytest
-from main import KoemojiProcessor
+from main import (KoemojiProcessor, plan_chunks, detect_speech_bounds, detect_cpu_topology,
+                  plan_cpu_allocation, SAMPLE_RATE)
 
 
 class TestUtilityFunctions:
@@ -117,4 +118,110 @@ class TestUtilityFunctions:
         unsupported_extensions = ('.txt', '.pdf', '.doc', '.jpg')
         
         for ext in unsupported_extensions:
-            assert ext not in supported_extensions
\ No newline at end of file
+            assert ext not in supported_extensions
+    
+    def test_plan_chunks_cuts_at_silence(self):
+        """チャンク境界が無音区間の中央に置かれるテスト"""
+        # 発話: 0-90, 110-190, 210-290, 310-400（サンプル単位）
+        speech = [
+            {"start": 0, "end": 90},
+            {"start": 110, "end": 190},
+            {"start": 210, "end": 290},
+            {"start": 310, "end": 400},
+        ]
+        chunks = plan_chunks(speech, 400, 210)
+        
+        # 無音の中央（100, 200, 300）のうち目標長に収まる位置で区切られる
+        assert chunks == [(0, 200), (200, 400)]
+        
+        # 全体を隙間なく覆う
+        assert chunks[0][0] == 0 and chunks[-1][1] == 400
+        assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    
+    def test_plan_chunks_without_silence(self):
+        """無音がなければ1チャンクのままになるテスト"""
+        assert plan_chunks([{"start": 0, "end": 1000}], 1000, 100) == [(0, 1000)]
+        assert plan_chunks([], 50, 100) == [(0, 50)]
+    
+    def test_detect_speech_bounds(self):
+        """前後の無音を除いた範囲（余白付き）が求まるテスト"""
+        import numpy as np
+        
+        # 10秒の無音 + 5秒の音 + 20秒の無音
+        audio = np.zeros(35 * SAMPLE_RATE, dtype=np.float32)
+        audio[10 * SAMPLE_RATE:15 * SAMPLE_RATE] = 0.1
+        start, end = detect_speech_bounds(audio, padding_seconds=0.5)
+        
+        assert abs(start / SAMPLE_RATE - 9.5) < 0.05
+        assert abs(end / SAMPLE_RATE - 15.5) < 0.05
+        
+        # 全体が無音（閾値未満の雑音）ならNone
+        noise = np.random.default_rng(0).normal(0, 1e-4, 10 * SAMPLE_RATE).astype(np.float32)
+        assert detect_speech_bounds(noise) is None
+        assert detect_speech_bounds(np.zeros(0, dtype=np.float32)) is None
+    
+    def test_silent_file_gets_marker_without_inference(self):
+        """無音だけのファイルは推論せずに目印を出力し、前後の無音は切り落とすテスト"""
+        import numpy as np
+        from unittest.mock import patch, MagicMock
+        
+        processor = KoemojiProcessor()
+        processor.config["long_file_mode"] = False
+        mock_model = MagicMock()
+        mock_model.transcribe.return_value = ([MagicMock(start=1.0, end=2.0, text="発話")], MagicMock())
+        
+        silent = np.zeros(60 * SAMPLE_RATE, dtype=np.float32)
+        with patch.object(processor, "_decode_audio", return_value=silent), \
+             patch.object(processor, "_get_whisper_model", return_value=mock_model):
+            assert processor.transcribe_audio("/path/to/silent.mp3") == "[無音]"
+        mock_model.transcribe.assert_not_called()
+        assert processor.silence_skipped_seconds == 60
+        
+        # 先頭30秒・末尾20秒の無音を切り落とし、時刻は元の位置に補正される
+        audio = np.zeros(60 * SAMPLE_RATE, dtype=np.float32)
+        audio[30 * SAMPLE_RATE:40 * SAMPLE_RATE] = 0.1
+        writer = MagicMock()
+        with patch.object(processor, "_decode_audio", return_value=audio), \
+             patch.object(processor, "_get_whisper_model", return_value=mock_model):
+            assert processor.transcribe_audio("/path/to/memo.mp3", writer=writer) is True
+        
+        # 音のある10秒と前後0.5秒ずつの余白（フレーム境界の分だけ誤差がある）
+        assert abs(len(mock_model.transcribe.call_args[0][0]) / SAMPLE_RATE - 11) < 0.05
+        writer.write_segment.assert_called_once_with("発話", 2.0 + 29.5)
+        assert abs(processor.silence_skipped_seconds - (60 + 49)) < 0.05
+    
+    def test_plan_cpu_allocation(self):
+        """物理コアがNUMAノードをまたがないようワーカーに分割されるテスト"""
+        # 2ノード × 4コア（SMTで各2スレッド）
+        topology = {
+            0: [[0, 8], [1, 9], [2, 10], [3, 11]],
+            1: [[4, 12], [5, 13], [6, 14], [7, 15]],
+        }
+        assert plan_cpu_allocation(topology, 4) == [[0, 1], [2, 3], [4, 5], [6, 7]]
+        assert plan_cpu_allocation(topology, 2, use_smt=True) == [
+            [0, 1, 2, 3, 8, 9, 10, 11], [4, 5, 6, 7, 12, 13, 14, 15]
+        ]
+        # 割り切れない場合は先頭のワーカーから1コアずつ多く割り当てる
+        assert [len(cpus) for cpus in plan_cpu_allocation(topology, 3)] == [3, 3, 2]
+        # コアがワーカーより少なければ共有する
+        assert plan_cpu_allocation({0: [[0], [1]]}, 3) == [[0], [1], [0]]
+    
+    def test_cpu_threads_follow_allocation(self):
+        """cpu_threadsが未指定なら割り当てた物理コア数になり、cpu_listで使うCPUを絞れるテスト"""
+        processor = KoemojiProcessor()
+        processor._cpu_topology = {0: [[0, 4], [1, 5], [2, 6], [3, 7]]}
+        processor.config.update({"max_concurrent_files": 2, "long_file_workers": 2, "cpu_threads": 0})
+        
+        assert processor._get_cpu_allocation() == [[0, 1], [2, 3]]
+        assert processor._get_cpu_threads() == 2
+        
+        processor.config["cpu_list"] = [2, 3, 6, 7]
+        assert processor._get_cpu_allocation() == [[2], [3]]
+        assert processor._get_cpu_threads() == 1
+        
+        processor.config["cpu_threads"] = 6
+        assert processor._get_cpu_threads() == 6
+        
+        # 実機のトポロジも検出できる
+        topology = detect_cpu_topology()
+        assert sum(len(core) for cores in topology.values() for core in cores) >= 1
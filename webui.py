@@ -1,26 +1,137 @@
 #!/usr/bin/env python3
-from flask import Flask, jsonify, render_template_string, request, send_from_directory
+from flask import Flask, Response, jsonify, render_template_string, request, send_from_directory
 import subprocess
 import os
+import socket
 import json
+import time
 import psutil
 from datetime import datetime
 
 app = Flask(__name__, static_folder='static')
 
+LOG_FILE = 'koemoji.log'
+LOG_LINES = 30              # 画面に表示するログの行数
+LOG_POLL_SECONDS = 1.0      # ログストリームで追記を確認する間隔（秒）
+LOG_KEEPALIVE_SECONDS = 15  # 追記がないときに接続確認を送る間隔（秒）
+CONTROL_TIMEOUT_SECONDS = 5 # 制御ソケットの応答を待つ時間（秒）
+QUEUE_LIMIT = 20            # 画面に表示するキューの件数
+QUEUE_ACTIONS = ('pause', 'resume', 'prioritize', 'cancel')
+
+def running_pid(config=None):
+    """実行中のKoeMojiAutoのPID（PIDファイルを読むだけでプロセス一覧は走査しない）"""
+    config = load_config() if config is None else config
+    try:
+        with open(config.get('pid_file', 'koemoji.pid'), 'r') as f:
+            pid, started_at = (float(value) for value in f.read().split()[:2])
+        # PIDが再利用された別のプロセスと区別するため開始時刻も照合
+        if abs(psutil.Process(int(pid)).create_time() - started_at) < 1:
+            return int(pid)
+    except (OSError, ValueError, TypeError, psutil.Error):
+        pass
+    return None
+
 def is_running():
     """KoeMojiAutoが実行中か確認"""
-    for proc in psutil.process_iter(['pid', 'cmdline']):
+    return running_pid() is not None
+
+def read_heartbeat(config=None):
+    """KoeMojiAutoが書き出したハートビート（なければNone）"""
+    config = load_config() if config is None else config
+    try:
+        with open(config.get('heartbeat_path', 'koemoji_heartbeat.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError, TypeError):
+        return None
+
+def control_request(command, config=None, **params):
+    """KoeMojiAutoの制御ソケットにコマンドを送り応答を返す（接続できなければNone）"""
+    config = load_config() if config is None else config
+    path = config.get('control_socket', 'koemoji.sock')
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    request_line = json.dumps(dict(params, command=command), ensure_ascii=False) + '\n'
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONTROL_TIMEOUT_SECONDS)
+            sock.connect(path)
+            sock.sendall(request_line.encode('utf-8'))
+            with sock.makefile('rb') as reader:
+                response = json.loads(reader.readline())
+    except (OSError, ValueError, TypeError):
+        return None
+    return response if isinstance(response, dict) else None
+
+def tail_log(path, lines=LOG_LINES, block_size=8192):
+    """ファイルの末尾から必要な分だけ読んで最後のlines行を返す
+    
+    (テキスト, 読み終えた位置のバイトオフセット)を返す。書き込み途中の最後の行は含めない。
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position = end
+        data = b''
+        while position > 0 and data.count(b'\n') <= lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    # 改行で終わっていない最後の行は次回の読み込みに回す
+    complete = data[:data.rfind(b'\n') + 1]
+    offset = end - (len(data) - len(complete))
+    text = b''.join(complete.splitlines(keepends=True)[-lines:])
+    return text.decode('utf-8', errors='replace'), offset
+
+def read_log_from(path, offset):
+    """offset以降に追記された行を返す
+    
+    (テキスト, 新しいオフセット)を返す。ファイルが切り詰められた・置き換えられた場合は先頭から読み直す。
+    """
+    size = os.path.getsize(path)
+    if size < offset:
+        offset = 0
+    if size == offset:
+        return '', offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size - offset)
+    complete = data[:data.rfind(b'\n') + 1]
+    return complete.decode('utf-8', errors='replace'), offset + len(complete)
+
+def log_events(path, offset=None):
+    """ログの追記をServer-Sent Eventsとして送り続けるジェネレーター
+    
+    各イベントのidに読み終えた位置のバイトオフセットを入れるため、再接続したブラウザは
+    Last-Event-IDで続きから受け取る。offsetがなければ末尾のLOG_LINES行をresetイベントで送る。
+    """
+    def event(text, offset, name=None):
+        lines = [f'event: {name}'] if name else []
+        lines.append(f'id: {offset}')
+        lines.extend(f'data: {line}' for line in text.rstrip('\n').split('\n'))
+        return '\n'.join(lines) + '\n\n'
+    
+    if offset is None:
+        try:
+            text, offset = tail_log(path)
+        except OSError:
+            text, offset = '', 0
+        yield event(text, offset, 'reset')
+    
+    last_sent = time.time()
+    while True:
         try:
-            cmdline = proc.info.get('cmdline')
-            if cmdline and len(cmdline) > 1:
-                if 'python' in cmdline[0].lower() or 'python3' in cmdline[0].lower():
-                    for arg in cmdline[1:]:
-                        if arg == 'main.py' or arg.endswith('/main.py'):
-                            return True
-        except:
-            pass
-    return False
+            text, offset = read_log_from(path, offset)
+        except OSError:
+            text = ''
+        if text:
+            yield event(text, offset)
+            last_sent = time.time()
+        elif time.time() - last_sent >= LOG_KEEPALIVE_SECONDS:
+            # 切断されたクライアントはここでの送信失敗で検出される
+            yield ': keepalive\n\n'
+            last_sent = time.time()
+        time.sleep(LOG_POLL_SECONDS)
 
 def load_config():
     """設定ファイルを読み込む"""
@@ -212,6 +323,26 @@ def index():
         .log::-webkit-scrollbar-thumb:hover {
             background: #a8a8a8;
         }
+        .queue-item {
+            display: flex;
+            align-items: center;
+            gap: 12px;
+            padding: 8px 0;
+            border-bottom: 1px solid #e4e5e7;
+        }
+        .queue-item .name {
+            flex: 1;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            white-space: nowrap;
+        }
+        .queue-item progress {
+            width: 160px;
+        }
+        .queue-item button, #pauseBtn {
+            padding: 6px 12px;
+            font-size: 13px;
+        }
         select, input {
             padding: 10px 14px;
             margin: 0;
@@ -252,6 +383,15 @@ def index():
             </button>
         </div>
         
+        <div id="queuePanel" class="config" style="display: none;">
+            <h3>
+                <i class="fas fa-list"></i> キュー
+                <button id="pauseBtn" onclick="togglePause()"><i class="fas fa-pause"></i> 一時停止</button>
+            </h3>
+            <div id="inFlight"></div>
+            <div id="queue"></div>
+        </div>
+        
         <div class="config">
                 <h3><i class="fas fa-cog"></i> 設定</h3>
             <div class="config-item">
@@ -289,12 +429,24 @@ def index():
                     const stopBtn = document.getElementById('stopBtn');
                     
                     if (data.running) {
+                        let detail = '';
+                        if (data.queue !== undefined) {
+                            detail = ' / 待機: ' + data.queue + '件 / 処理中: ' + data.in_flight + '件';
+                        }
+                        if (data.draining) {
+                            detail += ' / 停止処理中（実行中のジョブの完了待ち）';
+                        } else if (data.paused) {
+                            detail += ' / 一時停止中';
+                        }
+                        if (data.responsive === false) {
+                            detail += ' / 応答なし（' + Math.round(data.heartbeat_age) + '秒）';
+                        }
                         statusDiv.className = 'status running';
-                        statusDiv.innerHTML = '<i class="fas fa-check-circle"></i> <span>ステータス: 実行中 (PID: ' + data.pid + ')</span>';
+                        statusDiv.innerHTML = '<i class="fas fa-check-circle"></i> <span>ステータス: 実行中 (PID: ' + data.pid + ')' + detail + '</span>';
                         
-                        // 実行中は開始ボタンを無効化、停止ボタンを有効化
-                        startBtn.disabled = true;
-                        stopBtn.disabled = false;
+                        // 実行中は開始ボタンを無効化、停止ボタンを有効化（一時停止・ドレイン中は開始で再開できる）
+                        startBtn.disabled = !(data.paused || data.draining);
+                        stopBtn.disabled = !!data.draining;
                     } else {
                         statusDiv.className = 'status stopped';
                         statusDiv.innerHTML = '<i class="fas fa-times-circle"></i> <span>ステータス: 停止中</span>';
@@ -380,13 +532,121 @@ def index():
                 });
         }
         
+        let paused = false;
+        
+        function queueRow(job, running) {
+            // ファイル名はtextContentで設定する（HTMLとして解釈させない）
+            const row = document.createElement('div');
+            row.className = 'queue-item';
+            const name = document.createElement('span');
+            name.className = 'name';
+            name.textContent = job.name + (job.stage ? ' (' + (job.stage === 'draft' ? '下書き' : '本番') + ')' : '');
+            name.title = job.path;
+            row.appendChild(name);
+            
+            if (running) {
+                const progress = document.createElement('progress');
+                progress.max = 1;
+                if (job.progress !== null) {
+                    progress.value = job.progress;
+                }
+                row.appendChild(progress);
+                const label = document.createElement('span');
+                label.textContent = job.cancelling ? '取り消し中' :
+                    (job.progress !== null ? Math.round(job.progress * 100) + '%' : Math.round(job.position) + '秒');
+                row.appendChild(label);
+            } else {
+                const prioritize = document.createElement('button');
+                prioritize.innerHTML = '<i class="fas fa-arrow-up"></i> 優先';
+                prioritize.onclick = () => queueAction('prioritize', job.path);
+                row.appendChild(prioritize);
+            }
+            
+            const cancel = document.createElement('button');
+            cancel.className = 'stop';
+            cancel.innerHTML = '<i class="fas fa-times"></i> 取消';
+            cancel.disabled = !!job.cancelling;
+            cancel.onclick = () => {
+                if (confirm(job.name + ' を取り消しますか？')) {
+                    queueAction('cancel', job.path);
+                }
+            };
+            row.appendChild(cancel);
+            return row;
+        }
+        
+        function updateQueue() {
+            fetch('/queue')
+                .then(response => response.ok ? response.json() : null)
+                .then(data => {
+                    const panel = document.getElementById('queuePanel');
+                    if (!data) {
+                        panel.style.display = 'none';
+                        return;
+                    }
+                    panel.style.display = '';
+                    paused = data.paused;
+                    const pauseBtn = document.getElementById('pauseBtn');
+                    pauseBtn.innerHTML = paused ? '<i class="fas fa-play"></i> 再開' : '<i class="fas fa-pause"></i> 一時停止';
+                    pauseBtn.disabled = data.draining;
+                    
+                    const inFlight = document.getElementById('inFlight');
+                    const queue = document.getElementById('queue');
+                    inFlight.replaceChildren(...data.in_flight.map(job => queueRow(job, true)));
+                    queue.replaceChildren(...data.queue.map(job => queueRow(job, false)));
+                    if (!data.in_flight.length && !data.queue.length) {
+                        queue.textContent = '待機中のファイルはありません';
+                    } else if (data.queued > data.queue.length) {
+                        const more = document.createElement('div');
+                        more.className = 'queue-item';
+                        more.textContent = '他 ' + (data.queued - data.queue.length) + '件';
+                        queue.appendChild(more);
+                    }
+                })
+                .catch(() => {});
+        }
+        
+        function queueAction(action, path) {
+            fetch('/queue/' + action, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(path ? {path: path} : {})
+            }).then(() => {
+                updateQueue();
+                updateStatus();
+            });
+        }
+        
+        function togglePause() {
+            queueAction(paused ? 'resume' : 'pause');
+        }
+        
+        const LOG_LINES = 30;
+        let logLines = [];
+        
+        function showLog(lines) {
+            logLines = lines.slice(-LOG_LINES);
+            const logDiv = document.getElementById('log');
+            logDiv.textContent = logLines.join('\\n');
+            logDiv.scrollTop = logDiv.scrollHeight;
+        }
+        
         function updateLog() {
             fetch('/log')
                 .then(response => response.text())
-                .then(data => {
-                    const logDiv = document.getElementById('log');
-                    logDiv.textContent = data;
-                });
+                .then(data => showLog(data.replace(/\\n$/, '').split('\\n')));
+        }
+        
+        function startLogStream() {
+            // 追記された行だけがサーバーから届く（再接続時は前回の位置から再開）
+            if (!window.EventSource) {
+                updateLog();
+                setInterval(updateLog, 5000);
+                return;
+            }
+            const source = new EventSource('/log/stream');
+            source.addEventListener('reset', event => showLog(event.data.split('\\n')));
+            source.onmessage = event => showLog(logLines.concat(event.data.split('\\n')));
         }
         
         function updateStatusManual() {
@@ -395,6 +655,7 @@ def index():
             btn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 更新中';
             
             updateStatus();
+            updateQueue();
             updateLog();
             
             setTimeout(() => {
@@ -405,12 +666,13 @@ def index():
         
         // 初期化
         updateStatus();
+        updateQueue();
         loadConfig();
-        updateLog();
+        startLogStream();
         
-        // 定期更新
+        // 定期更新（ログはストリームで受信）
         setInterval(updateStatus, 2000);  // 2秒ごとにステータス更新
-        setInterval(updateLog, 5000);     // 5秒ごとにログ更新
+        setInterval(updateQueue, 2000);   // 2秒ごとにキューと進捗を更新
     </script>
 </body>
 </html>
@@ -419,22 +681,25 @@ def index():
 @app.route('/status')
 
 def status():
-    """ステータス取得"""
-    running = is_running()
-    pid = None
-    if running:
-        for proc in psutil.process_iter(['pid', 'cmdline']):
-            try:
-                cmdline = proc.info.get('cmdline')
-                if cmdline and len(cmdline) > 1:
-                    if 'python' in cmdline[0].lower() or 'python3' in cmdline[0].lower():
-                        for arg in cmdline[1:]:
-                            if arg == 'main.py' or arg.endswith('/main.py'):
-                                pid = proc.pid
-                                break
-            except:
-                pass
-    return jsonify({"running": running, "pid": pid})
+    """ステータス取得（PIDファイルとハートビートを読むだけ）"""
+    config = load_config()
+    pid = running_pid(config)
+    result = {"running": pid is not None, "pid": pid}
+    
+    heartbeat = read_heartbeat(config)
+    if pid is not None and heartbeat and heartbeat.get("pid") == pid:
+        age = max(0.0, time.time() - heartbeat.get("updated_at", 0))
+        interval = heartbeat.get("interval") or 0
+        result.update({
+            "heartbeat_age": round(age, 1),
+            # ハートビートが3回分途絶えていればメインループが止まっている
+            "responsive": not interval or age < interval * 3,
+            "queue": heartbeat.get("queue"),
+            "in_flight": heartbeat.get("in_flight"),
+            "paused": heartbeat.get("paused", False),
+            "draining": heartbeat.get("draining", False)
+        })
+    return jsonify(result)
 
 @app.route('/config', methods=['GET', 'POST'])
 
@@ -452,7 +717,12 @@ def config():
 @app.route('/start', methods=['POST'])
 
 def start():
-    """KoemojiAuto開始"""
+    """KoemojiAuto開始（実行中なら制御ソケットで一時停止・ドレインを解除するだけ）"""
+    config = load_config()
+    if running_pid(config) is not None:
+        response = control_request('resume', config)
+        if response and response.get('ok'):
+            return jsonify({"status": "resumed"})
     script = './start_koemoji.sh' if os.name != 'nt' else 'start_koemoji.bat'
     subprocess.run([script])
     return jsonify({"status": "started"})
@@ -460,7 +730,12 @@ def start():
 @app.route('/stop', methods=['POST'])
 
 def stop():
-    """KoemojiAuto停止"""
+    """KoemojiAuto停止（制御ソケットでドレインを要求し、実行中のジョブの完了後に停止させる）"""
+    response = control_request('drain')
+    if response and response.get('ok'):
+        return jsonify({"status": "draining", "in_flight": response.get("in_flight", 0)})
+    
+    # 制御ソケットが使えない場合は停止スクリプトにフォールバック
     script = './stop_koemoji.sh' if os.name != 'nt' else 'stop_koemoji.bat'
     result = subprocess.run([script], capture_output=True, text=True)
     
@@ -473,17 +748,63 @@ def stop():
         "error": result.stderr
     })
 
+@app.route('/queue')
+
+def queue():
+    """キューの先頭と実行中のジョブの一覧（進捗付き。queuedにキューの全件数）"""
+    limit = max(0, min(request.args.get('limit', QUEUE_LIMIT, type=int), 1000))
+    response = control_request('list', limit=limit)
+    if response is None:
+        return jsonify({"error": "KoeMojiAutoに接続できません"}), 503
+    return jsonify(response)
+
+@app.route('/queue/<action>', methods=['POST'])
+
+def queue_action(action):
+    """ディスパッチの一時停止・再開、ジョブの優先・取り消し"""
+    if action not in QUEUE_ACTIONS:
+        return jsonify({"ok": False, "error": f"不明な操作です: {action}"}), 404
+    params = {}
+    if action in ('prioritize', 'cancel'):
+        params['path'] = (request.get_json(silent=True) or {}).get('path')
+    response = control_request(action, **params)
+    if response is None:
+        return jsonify({"ok": False, "error": "KoeMojiAutoに接続できません"}), 503
+    return jsonify(response), 200 if response.get('ok') else 400
+
 @app.route('/log')
 
 def log():
-    """ログ取得（最新30行）"""
+    """ログ取得（最新30行。ファイルの末尾だけを読む）"""
     try:
-        with open('koemoji.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            return ''.join(lines[-30:])
-    except:
+        text, _ = tail_log(LOG_FILE)
+        return text
+    except OSError:
         return "ログファイルが見つかりません"
 
+@app.route('/log/stream')
+
+def log_stream():
+    """ログの追記をServer-Sent Eventsで配信"""
+    last_event_id = request.headers.get('Last-Event-ID')
+    offset = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return Response(
+        log_events(LOG_FILE, offset),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/metrics')
+
+def metrics():
+    """Prometheus形式のメトリクス（KoemojiAutoが書き出したスナップショットを返す）"""
+    path = load_config().get('metrics_path', 'koemoji_metrics.prom')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return Response(f.read(), mimetype='text/plain; version=0.0.4')
+    except (OSError, TypeError):
+        return Response("# メトリクスがまだ公開されていません\n", status=503, mimetype='text/plain')
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file